@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+import time
+import timeit
+from twisted.test.proto_helpers import StringTransport
+
+from skyline.horizon.cache import MetricCache
+from skyline.horizon.protocols import MetricLineReceiver
+
+"""
+Compare parsing a chunk of graphite plaintext one line at a time (the
+original lineReceived path) against parsing the whole chunk as a batch.
+"""
+
+LINES = 10000
+NUMBER = 20
+
+now = int(time.time())
+chunk = ''.join("horizon.bench.metric{0} {1} {2}\n".format(i % 100, i, now + i) for i in xrange(LINES))
+lines = chunk.splitlines()
+
+protocol = MetricLineReceiver()
+protocol.makeConnection(StringTransport())
+
+
+def line_at_a_time():
+    for line in lines:
+        protocol.lineReceived(line)
+    MetricCache.configure()
+
+
+def bulk():
+    protocol.dataReceived(chunk)
+    MetricCache.configure()
+
+
+if __name__ == '__main__':
+    for name in ("line_at_a_time", "bulk"):
+        elapsed = timeit.timeit("{0}()".format(name), setup="from __main__ import {0}".format(name), number=NUMBER)
+        print("{0}: {1:.0f} lines/sec".format(name, LINES * NUMBER / elapsed))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+import timeit
+import numpy
+
+from skyline.codecs import CODECS
+
+"""
+Compare the size and decode speed of the storage formats on a day of
+10 second datapoints with a little timestamp jitter, published one datapoint
+at a time. A gorilla metric is a v2 tail until Roomba seals it, so it is
+shown both before and after a Roomba pass. Decode speed is measured in
+megabytes of decoded (timestamp, value) float64 pairs per second.
+"""
+
+random = numpy.random.RandomState(0)
+points = 8640
+timestamps = 1420070400 + numpy.arange(points) * 10.0 + (random.rand(points) < 0.05)
+values = numpy.round(100 + random.randn(points) * 5, 2)
+datapoints = numpy.column_stack((timestamps, values))
+
+gorilla = CODECS['gorilla']
+sealed, tail = gorilla.seal(datapoints)
+encoded = {
+    'v1 (msgpack)': ('v1', ''.join(CODECS['v1'].encode(datapoints[i:i + 1]) for i in xrange(points)), 0),
+    'v2 (float64)': ('v2', ''.join(CODECS['v2'].encode(datapoints[i:i + 1]) for i in xrange(points)), 0),
+    'gorilla (unsealed)': ('gorilla', ''.join(gorilla.encode(datapoints[i:i + 1]) for i in xrange(points)), 0),
+    'gorilla (sealed)': ('gorilla', sealed + tail, len(sealed)),
+}
+
+
+def decode(storage_format, data, sealed):
+    if storage_format == 'gorilla':
+        return gorilla.decode(data, sealed)
+    return CODECS[storage_format].decode(data)
+
+
+if __name__ == '__main__':
+    number = 20
+    for name, (storage_format, data, sealed) in sorted(encoded.items()):
+        seconds = timeit.timeit(lambda: decode(storage_format, data, sealed), number=number) / number
+        print("{0:<20} {1:6.2f} bytes/point {2:8.1f} MB/s".format(
+            name, len(data) / float(points), datapoints.nbytes / seconds / 1e6))
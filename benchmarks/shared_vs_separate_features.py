@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import time
+import timeit
+import warnings
+import numpy
+from argparse import Namespace
+from mock import Mock
+
+from skyline.analyzer import algorithms
+from skyline.analyzer.analyzer import Analyzer
+
+"""
+Time the algorithm ensemble on a day of 1 second datapoints, both as the
+Analyzer runs it, with every algorithm sharing one Features of the series,
+and with every algorithm building its own from the raw timeseries. Each
+is measured on a v1 style list of datapoints and on the (N, 2) array the
+other storage formats decode to.
+"""
+
+random = numpy.random.RandomState(0)
+now = int(time.time())
+points = 86400
+timestamps = numpy.arange(now - points + 1, now + 1, dtype=float)
+values = numpy.round(numpy.cumsum(random.randn(points)), 2)
+series = {
+    'list': map(list, zip(timestamps, values)),
+    'array': numpy.column_stack((timestamps, values)),
+}
+
+args = Namespace(min_tolerable_length=1, stale_period=500, max_tolerable_boredom=100, boredom_set_size=1,
+                 full_duration=86400, consensus=6, enable_second_order=False, short_circuit=False, adf_ttl=0)
+analyzer = Analyzer(Mock(), args)
+
+
+def shared(timeseries):
+    analyzer.is_anomalous(timeseries, "benchmark")
+
+
+def separate(timeseries):
+    for algorithm in algorithms.ALGORITHMS:
+        getattr(algorithms, algorithm)(timeseries, args)
+
+
+if __name__ == '__main__':
+    warnings.simplefilter("ignore")
+    number = 10
+    for name, timeseries in sorted(series.items()):
+        for run in (shared, separate):
+            seconds = timeit.timeit(lambda: run(timeseries), number=number) / number
+            print("{0:<6} {1:<9} {2:8.1f} ms/series".format(name, run.__name__, seconds * 1000))
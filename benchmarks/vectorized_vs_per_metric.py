@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import time
+import timeit
+import warnings
+import numpy
+from argparse import Namespace
+
+from skyline.analyzer import algorithms, batch
+from skyline.analyzer.features import Features
+
+"""
+Compare the throughput of the algorithm ensemble run one metric at a time
+with the vectorized batch engine, on batches of 100 metrics of a few
+lengths.
+"""
+
+random = numpy.random.RandomState(0)
+now = int(time.time())
+args = Namespace(full_duration=86400, adf_ttl=0)
+
+
+def batch_of(points, metrics=100):
+    """Noisy metrics sampled every 10 seconds, a few of which drift."""
+    timestamps = numpy.arange(now - (points - 1) * 10, now + 1, 10, dtype=float)
+    return [numpy.column_stack((timestamps, numpy.round(100 + random.randn(points) * 5 +
+                                                        (numpy.cumsum(random.randn(points)) if i % 10 == 0 else 0), 2)))
+            for i in xrange(metrics)]
+
+
+def per_metric(timeseries):
+    for series in timeseries:
+        features = Features(series)
+        for algorithm in algorithms.ALGORITHMS:
+            getattr(algorithms, algorithm)(features, args)
+
+
+def vectorized(timeseries):
+    batch.ensembles(timeseries, args)
+
+
+if __name__ == '__main__':
+    warnings.simplefilter("ignore")
+    for points in (60, 1440, 8640):
+        timeseries = batch_of(points)
+        for run in (per_metric, vectorized):
+            seconds = timeit.timeit(lambda: run(timeseries), number=3) / 3
+            print("{0:>5} points {1:<10} {2:8.0f} metrics/s".format(points, run.__name__, len(timeseries) / seconds))
@@ -2,17 +2,17 @@
 
 import configargparse
 import sys
-from skyline.api import SkylineRedisApi
 from skyline.agents import run_agent
-from skyline.utils import check_alert, check_anomalies, check_metric, settings
-from skyline.seed import seed_data
 
 
 if __name__ == "__main__":
     parser = configargparse.ArgumentParser(description="Anomaly detection.")
-    parser.add_argument("-r", "--redis", default="redis://localhost:6379/", env_var='REDIS', help="Redis instance to connect to")
+    parser.add_argument("-r", "--redis", default="redis://localhost:6379/", env_var='REDIS', help="Redis instance to connect to. Separate several urls with commas to shard the metrics across them, the settings are kept on the first one")
     parser.add_argument("--identifier", default="", env_var='IDENTIFIER', help="Identifier for the process")
     parser.add_argument("-v", "--verbose", action='store_true', default=False, help="Verbose mode")
+    parser.add_argument("--storage-format", default="v1", choices=["v1", "v2", "ring", "gorilla"], env_var="STORAGE_FORMAT", help="The format new metrics are stored in: v1 (msgpack), v2 (packed float64), ring (a fixed number of packed float64 slots) or gorilla (packed float64 sealed into delta-of-delta and XOR compressed chunks by Roomba). When Horizon runs with anything but v1, metrics in other formats are migrated the first time they are published")
+    parser.add_argument("--redis-connections", type=int, default=4, env_var="REDIS_CONNECTIONS", help="The number of connections to each redis instance used by --publish-concurrency and --concurrency")
+    parser.add_argument("--ring-capacity", type=int, default=8640, env_var="RING_CAPACITY", help="The number of datapoints kept per metric in the ring storage format (8640 is a day at a 10 second resolution)")
 
     subparsers = parser.add_subparsers(title='commands', description='Specify the specific command to run', help='process to run')
 
@@ -23,6 +23,20 @@ if __name__ == "__main__":
     horizon_parser.add_argument("-l", "--line-port", type=int, default=0, env_var="LINE_PORT", help="Listen for graphite line data (e.g. 2023)")
     horizon_parser.add_argument("-p", "--pickle-port", type=int, default=0, env_var="PICKLE_PORT", help="Listen for graphite pickle data (e.g. 2024)")
     horizon_parser.add_argument("-u", "--udp-port", type=int, default=0, env_var="UDP_PORT", help="Listen for graphite udp data (e.g. 2025)")
+    horizon_parser.add_argument("-b", "--binary-port", type=int, default=0, env_var="BINARY_PORT", help="Listen for length-prefixed binary data (e.g. 2026)")
+    horizon_parser.add_argument("-w", "--workers", type=int, default=1, env_var="HORIZON_WORKERS", help="The number of Horizon processes to run. Each worker shares the listening ports using SO_REUSEPORT and publishes its own MetricCache")
+    horizon_parser.add_argument("--coalesce-resolution", type=int, default=0, env_var="COALESCE_RESOLUTION", help="Merge the datapoints of each metric into buckets of this many seconds before they are published (0 disables coalescing)")
+    horizon_parser.add_argument("--coalesce-aggregation", default="avg", choices=["last", "avg", "sum", "max"], env_var="COALESCE_AGGREGATION", help="How the datapoints in a coalesced bucket are combined")
+    horizon_parser.add_argument("--spool-dir", default="", env_var="SPOOL_DIR", help="Spool datapoints to this directory while redis is unreachable or the MetricCache is over --spool-threshold (disabled by default). With several --workers, each worker spools to its own numbered subdirectory")
+    horizon_parser.add_argument("--spool-threshold", type=int, default=0, env_var="SPOOL_THRESHOLD", help="Spool the MetricCache once it holds more than this many datapoints (0 only spools while redis is unreachable)")
+    horizon_parser.add_argument("--spool-segment-size", type=int, default=64 * 1024 * 1024, env_var="SPOOL_SEGMENT_SIZE", help="The size in bytes of each spool segment file")
+    horizon_parser.add_argument("--spool-replay-rate", type=int, default=100000, env_var="SPOOL_REPLAY_RATE", help="The number of spooled datapoints replayed to redis per second. New datapoints are spooled behind older ones until the spool is empty, so this should be higher than the ingest rate")
+    horizon_parser.add_argument("--cache-shards", type=int, default=16, env_var="CACHE_SHARDS", help="The number of independently locked shards the MetricCache is split into")
+    horizon_parser.add_argument("--publish-concurrency", type=int, default=0, env_var="PUBLISH_CONCURRENCY", help="Publish from the reactor with up to this many batches in flight at once, instead of one at a time from a thread (0, the default)")
+    horizon_parser.add_argument("--publish-batch-size", type=int, default=500, env_var="PUBLISH_BATCH_SIZE", help="The number of metrics written to redis in a single pipeline")
+    horizon_parser.add_argument("--publish-batch-timeout", type=float, default=1.0, env_var="PUBLISH_BATCH_TIMEOUT", help="The maximum number of seconds a metric waits in a partial pipeline before it is flushed")
+    horizon_parser.add_argument("--max-cache-size", type=int, default=0, env_var="MAX_CACHE_SIZE", help="The number of datapoints the MetricCache may hold before TCP receivers are paused and UDP datapoints are dropped (0 is unlimited)")
+    horizon_parser.add_argument("--cache-low-watermark", type=int, default=None, env_var="CACHE_LOW_WATERMARK", help="Receivers resume once the MetricCache is drained below this many datapoints (defaults to 95%% of --max-cache-size)")
 
     analyzer_parser = subparsers.add_parser("analyzer", help="Analyze metrics and detect anomalies.")
     analyzer_parser.set_defaults(which="analyzer")
@@ -32,6 +46,17 @@ if __name__ == "__main__":
     analyzer_parser.add_argument("--max-tolerable-boredom", type=int, default=100, env_var="MAX_TOLERABLE_BOREDOM", help="Sometimes a metric will continually transmit the same number. There's no need to analyze metrics that remain boring like this, so this setting determines the amount of boring datapoints that will be allowed to accumulate before the analyzer skips over the metric. If the metric becomes noisy again, the analyzer will stop ignoring it.")
     analyzer_parser.add_argument("--boredom-set-size", type=int, default=1, env_var="BOREDOM_SET_SIZE", help="By default, the analyzer skips a metric if it it has transmitted a single number MAX_TOLERABLE_BOREDOM times. Change this setting if you wish the size of the ignored set to be higher (ie, ignore the metric if there have only been two different values for the past MAX_TOLERABLE_BOREDOM datapoints). This is useful for timeseries that often oscillate between two values.")
     analyzer_parser.add_argument("--stale-period", type=int, default=500, env_var="SLEEP_TIMEOUT", help="The duration, in seconds, for a metric to become 'stale' and for the analyzer to ignore it until new datapoints are added. 'Staleness' means that a datapoint has not been added for STALE_PERIOD seconds")
+    analyzer_parser.add_argument("--concurrency", type=int, default=0, env_var="ANALYZER_CONCURRENCY", help="Analyze up to this many metrics at once from the reactor, overlapping the redis round trips with the algorithms. By default (0) metrics are analyzed one at a time")
+    analyzer_parser.add_argument("-w", "--workers", type=int, default=1, env_var="ANALYZER_WORKERS", help="The number of Analyzer processes to run. Each worker claims its own metrics from the skyline:metricset:queue work queue, so analysis scales with the number of cores")
+    analyzer_parser.add_argument("--anomalous-boost", type=int, default=60, env_var="ANALYZER_ANOMALOUS_BOOST", help="Metrics are claimed for analysis in the order they were updated, but metrics in skyline:metricset:anomalous are claimed as if they had been updated this many seconds earlier")
+    analyzer_parser.add_argument("--batch-size", type=int, default=None, env_var="ANALYZER_BATCH_SIZE", help="The number of metrics claimed from the skyline:metricset:queue work queue, fetched and written back at once (100 by default). Not available with --concurrency, which claims one metric at a time")
+    analyzer_parser.add_argument("--streaming", action='store_true', default=False, env_var="ANALYZER_STREAMING", help="Only run the algorithms that can be updated incrementally (mean_subtraction_cumulation, stddev_from_average and stddev_from_moving_average), keeping their running statistics in redis and fetching only the datapoints appended since the last analysis")
+    analyzer_parser.add_argument("--vectorized", action='store_true', default=False, env_var="ANALYZER_VECTORIZED", help="Run the algorithms on each batch of metrics at once, stacked into 2D arrays, instead of one metric at a time. Not available with --concurrency")
+    analyzer_parser.add_argument("--short-circuit", action='store_true', default=False, env_var="ANALYZER_SHORT_CIRCUIT", help="Run the algorithms cheapest first, as timed when the analyzer starts, and stop as soon as the consensus is reached or out of reach. The algorithms that didn't need to run are recorded as skipped")
+    analyzer_parser.add_argument("--adf-ttl", type=int, default=0, env_var="ANALYZER_ADF_TTL", help="How many seconds ks_test keeps a metric's Augmented Dickey-Fuller verdict, as long as its reference window holds as many datapoints. 0 runs the test every time")
+    analyzer_parser.add_argument("--max-latency", type=int, default=0, env_var="ANALYZER_MAX_LATENCY", help="Schedule the analysis of every metric: a metric updated sooner than it is scheduled is deferred, waiting at most this many seconds. Calm metrics wait longer and longer, up to this, while anomalous ones wait --min-interval. By default (0) every update is analyzed")
+    analyzer_parser.add_argument("--min-interval", type=int, default=10, env_var="ANALYZER_MIN_INTERVAL", help="With --max-latency, the shortest time, in seconds, between two analyses of a metric")
+    analyzer_parser.add_argument("--stats-interval", type=int, default=60, env_var="ANALYZER_STATS_INTERVAL", help="How often, in seconds, each Analyzer worker logs how many metrics it analyzed")
     analyzer_parser.add_argument("--enable-second-order", action='store_true', default=False, env_var="ENABLE_SECOND_ORDER", help="Enables second order analysis of metrics. This is EXPERIMENTAL!")
 
     roomba_parser = subparsers.add_parser("roomba", help="Cleanup old metric and anomaly data.")
@@ -39,6 +64,7 @@ if __name__ == "__main__":
     roomba_parser.add_argument("--full-duration", type=int, default=86400 + 3600, env_var="FULL_DURATION", help="The length of a full timeseries length")
     roomba_parser.add_argument("--clean-timeout", type=int, default=3600, env_var="CLEAN_TIMEOUT", help="This is the amount of extra data to allow")
     roomba_parser.add_argument("--sleep-timeout", type=int, default=3600, env_var="SLEEP_TIMEOUT", help="This is the amount of time roomba will sleep between runs")
+    roomba_parser.add_argument("--scan-count", type=int, default=1000, env_var="SCAN_COUNT", help="The number of metrics Roomba reads with each SSCAN, and cleans with one pipelined HMGET of their info")
 
     settings_parser = subparsers.add_parser("settings", help="Import and export settings.")
     settings_parser.set_defaults(which="settings")
@@ -52,6 +78,7 @@ if __name__ == "__main__":
     seed_parser.add_argument("-p", "--prefix", default="horizon", help="A metric prefix for seed data")
     seed_parser.add_argument("-l", "--line-port", type=int, default=0, help="Listen for graphite line data (e.g. 2023)")
     seed_parser.add_argument("-u", "--udp-port", type=int, default=0, help="Listen for graphite udp data (e.g. 2025)")
+    seed_parser.add_argument("-b", "--binary-port", type=int, default=0, help="Listen for length-prefixed binary data (e.g. 2026)")
 
     check_metric_parser = subparsers.add_parser("check_metric", help="Check a metric in skyline.")
     check_metric_parser.set_defaults(which="check_metric")
@@ -66,28 +93,47 @@ if __name__ == "__main__":
     check_anomalies_parser = subparsers.add_parser("check_anomalies", help="List the anomalies currently in the system.")
     check_anomalies_parser.set_defaults(which="check_anomalies")
 
+    check_queue_parser = subparsers.add_parser("check_queue", help="Show how many metrics wait for analysis, and for how long.")
+    check_queue_parser.set_defaults(which="check_queue")
+
+    migrate_parser = subparsers.add_parser("migrate", help="Convert every metric to another storage format. Only run this once every Horizon process uses the target --storage-format.")
+    migrate_parser.set_defaults(which="migrate")
+    migrate_parser.add_argument("-f", "--format", required=True, choices=["v1", "v2", "ring", "gorilla"], help="The storage format to convert metrics to")
+
     flush_data_parser = subparsers.add_parser("flush_data", help="DANGER ZONE: Flushes all data in the system. Configuration settings are not removed.")
     flush_data_parser.add_argument("--force", action='store_true', required=True, help="Required to force deletion")
     flush_data_parser.set_defaults(which="flush_data")
 
     args = parser.parse_args()
-    api = SkylineRedisApi(args.redis)
 
     if len(sys.argv) < 2:
         parser.print_usage()
         sys.exit(1)
 
+    if args.which in ["horizon", "analyzer", "roomba"]:
+        # The agents connect to redis, and install the twisted reactor, in
+        # each of their worker processes
+        run_agent(parser, args.which, args)
+        sys.exit(0)
+
+    from skyline.api import SkylineRedisApi
+    from skyline.utils import check_alert, check_anomalies, check_metric, check_queue, migrate, settings
+    from skyline.seed import seed_data
+    api = SkylineRedisApi(args.redis, args.storage_format, args.ring_capacity)
+
     if args.which == "settings":
         settings(api, args.import_file)
     if args.which == "seed_data":
-        seed_data(api, args.data, args.max_resolution, args.host, args.prefix, args.line_port, args.udp_port)
+        seed_data(api, args.data, args.max_resolution, args.host, args.prefix, args.line_port, args.udp_port, args.binary_port)
     if args.which == "check_metric":
         check_metric(api, args.metric, args.interval)
     if args.which == "check_alert":
         check_alert(api, args, args.metric, args.trigger)
     if args.which == "check_anomalies":
         check_anomalies(api)
+    if args.which == "check_queue":
+        check_queue(api)
+    if args.which == "migrate":
+        migrate(api, args.format)
     if args.which == "flush_data" and args.force:
         api.flush_data()
-    if args.which in ["horizon", "analyzer", "roomba"]:
-        run_agent(parser, api, args.which, args)
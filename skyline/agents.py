@@ -1,10 +1,21 @@
+import errno
+import os
+import signal
+import socket
 import sys
 import time
 from twisted.python import log
-from twisted.internet import reactor
+
+# twisted.internet.reactor is only imported once the worker processes have
+# forked: installing it creates an epoll file descriptor that would otherwise
+# be shared by all the workers
+
+# Not exposed by the socket module on python 2, this is the Linux value
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
 
 
 def run_forever(agent):
+    from twisted.internet import reactor
     while reactor.running:
         try:
             agent.run()
@@ -13,58 +24,210 @@ def run_forever(agent):
     time.sleep(1)
 
 
-def horizon_agent(parser, api, args):
+def reuseport_socket(type, port, interface=''):
+    """
+    Create a bound, non-blocking socket with SO_REUSEPORT set so several
+    processes can share the same port and let the kernel balance between them.
+    """
+    sock = socket.socket(socket.AF_INET, type)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.setblocking(False)
+    sock.bind((interface, port))
+    return sock
+
+
+def listen_tcp(port, factory, interface='', reuse_port=False):
+    from twisted.internet import reactor
+    if not reuse_port:
+        return reactor.listenTCP(port, factory, interface=interface)
+    sock = reuseport_socket(socket.SOCK_STREAM, port, interface)
+    sock.listen(50)
+    listener = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    sock.close()  # the reactor has its own copy of the file descriptor
+    return listener
+
+
+def listen_udp(port, protocol, interface='', reuse_port=False):
+    from twisted.internet import reactor
+    if not reuse_port:
+        return reactor.listenUDP(port, protocol, interface=interface)
+    sock = reuseport_socket(socket.SOCK_DGRAM, port, interface)
+    listener = reactor.adoptDatagramPort(sock.fileno(), socket.AF_INET, protocol)
+    sock.close()
+    return listener
+
+
+def run_workers(count, target):
+    """
+    Fork count worker processes, each calling target(worker), and restart any
+    that die until the supervisor receives SIGTERM or SIGINT, which is passed
+    on to the workers.
+    """
+    workers = {}
+    state = {"running": True}
+
+    def spawn(worker):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 0
+            try:
+                target(worker)
+            except:
+                log.err()
+                status = 1
+            os._exit(status)
+        log.msg("started worker {0} (pid {1})".format(worker, pid))
+        workers[pid] = worker
+
+    def stop(signum, frame):
+        state["running"] = False
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for worker in xrange(count):
+        spawn(worker)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        worker = workers.pop(pid, None)
+        if worker is None:
+            continue
+        log.msg("worker {0} (pid {1}) exited with status {2}".format(worker, pid, status))
+        if state["running"]:
+            time.sleep(1)  # Avoid spinning when a worker can't start
+            spawn(worker)
+
+
+def blocking_api(args):
+    """A SkylineRedisApi for the agent, made once the worker processes have forked."""
+    from skyline.api import SkylineRedisApi
+    return SkylineRedisApi(args.redis, args.storage_format, args.ring_capacity)
+
+
+def async_api(args):
+    """An AsyncSkylineRedisApi for the agent, made once the worker processes have forked."""
+    from skyline.api import AsyncSkylineRedisApi
+    return AsyncSkylineRedisApi(args.redis, args.storage_format, args.ring_capacity, args.redis_connections)
+
+
+def horizon_agent(parser, api, args, worker=None):
     """
     Start the Horizon agent.
     """
-    from skyline.horizon.protocols import MetricLineFactory, MetricPickleFactory, MetricDatagramReceiver
-    from skyline.horizon.publishers import Publisher
+    from twisted.internet import reactor
+    from skyline.horizon.cache import MetricCache
+    from skyline.horizon.protocols import MetricLineFactory, MetricPickleFactory, MetricBinaryFactory, MetricDatagramReceiver
+    from skyline.horizon.publishers import AsyncPublisher, Publisher
 
-    if not any((args.line_port, args.pickle_port, args.udp_port)):
-        parser.error("specify at least one port to listen on")
+    MetricCache.configure(args.cache_shards, args.max_cache_size, args.cache_low_watermark)
+
+    # Workers share the listening ports
+    reuse_port = worker is not None
 
     if args.line_port:
-        reactor.listenTCP(args.line_port, MetricLineFactory(), interface=args.interface)
+        listen_tcp(args.line_port, MetricLineFactory(), args.interface, reuse_port)
     if args.pickle_port:
-        reactor.listenTCP(args.pickle_port, MetricPickleFactory())
+        listen_tcp(args.pickle_port, MetricPickleFactory(), args.interface, reuse_port)
+    if args.binary_port:
+        listen_tcp(args.binary_port, MetricBinaryFactory(), args.interface, reuse_port)
     if args.udp_port:
-        reactor.listenUDP(args.udp_port, MetricDatagramReceiver())
+        listen_udp(args.udp_port, MetricDatagramReceiver(), args.interface, reuse_port)
 
-    reactor.callInThread(run_forever, Publisher(api, args))
+    if args.publish_concurrency:
+        AsyncPublisher(async_api(args), args).start()
+    else:
+        reactor.callInThread(run_forever, Publisher(api, args, worker))
 
 
-def analyzer_agent(parser, api, args):
+def analyzer_agent(parser, api, args, worker=None):
     """
     Start the Analyzer agent.
     """
+    from twisted.internet import reactor
     from skyline.analyzer import check_algorithms
-    from skyline.analyzer.analyzer import Analyzer
-    check_algorithms(api, args)
-    reactor.callInThread(run_forever, Analyzer(api, args))
+    from skyline.analyzer.analyzer import Analyzer, AsyncAnalyzer
+    args.algorithm_costs = check_algorithms(api, args)
+    if args.concurrency:
+        analyzer = AsyncAnalyzer(async_api(args), args, worker)
+        reactor.callWhenRunning(analyzer.start)
+    else:
+        analyzer = Analyzer(api, args, worker)
+        reactor.callInThread(run_forever, analyzer)
+    reactor.addSystemEventTrigger("after", "shutdown", analyzer.log_stats, True)
 
 
 def roomba_agent(parser, api, args):
     """
     Start the Roomba agent.
     """
+    from twisted.internet import reactor
     from skyline.roomba import Roomba
     reactor.callInThread(run_forever, Roomba(api, args))
 
 
-def run_agent(parser, api, which, args):
+def start_agent(parser, which, args, worker=None):
     """
-    Runs a specific agent.
+    Starts a specific agent and runs the reactor until it stops.
     """
+    from twisted.internet import reactor
+    if worker is not None:
+        log.msg("{0} worker {1} running in pid {2}".format(which, worker, os.getpid()))
+
+    # Every worker has its own connections to redis
+    api = blocking_api(args)
+
     if which == "horizon":
-        horizon_agent(parser, api, args)
+        horizon_agent(parser, api, args, worker)
     elif which == "analyzer":
-        analyzer_agent(parser, api, args)
+        analyzer_agent(parser, api, args, worker)
     elif which == "roomba":
         roomba_agent(parser, api, args)
 
+    reactor.run()
+
+
+def run_agent(parser, which, args):
+    """
+    Runs a specific agent, optionally in several supervised worker processes.
+    """
+    if which == "horizon" and not any((args.line_port, args.pickle_port, args.binary_port, args.udp_port)):
+        parser.error("specify at least one port to listen on")
+    if which == "horizon" and args.publish_concurrency and args.spool_dir:
+        parser.error("--spool-dir can't be used with --publish-concurrency")
+    if which == "analyzer" and args.streaming and args.concurrency:
+        parser.error("--streaming can't be used with --concurrency")
+    if which == "analyzer" and args.max_latency and args.concurrency:
+        parser.error("--max-latency can't be used with --concurrency")
+    if which == "analyzer" and args.vectorized and args.concurrency:
+        parser.error("--vectorized can't be used with --concurrency")
+    if which == "analyzer" and args.batch_size is not None and args.concurrency:
+        parser.error("--batch-size can't be used with --concurrency, which claims one metric at a time")
+    if which == "analyzer" and args.batch_size is None:
+        args.batch_size = 100
+    if which == "analyzer" and args.max_latency and args.max_latency < args.min_interval:
+        parser.error("--max-latency can't be shorter than --min-interval")
+
     log.startLogging(sys.stdout)
     log.msg("Starting {} with the following arguments:".format(args.which))
     for a, v in vars(args).items():
         log.msg("   {0}={1}".format(a, v))
 
-    reactor.run()
+    workers = getattr(args, "workers", 1)
+    if workers > 1:
+        run_workers(workers, lambda worker: start_agent(parser, which, args, worker))
+    else:
+        start_agent(parser, which, args)
@@ -1,3 +1,4 @@
+import numpy as np
 import sys
 import time
 import traceback
@@ -5,15 +6,32 @@ from twisted.python import log
 
 from skyline.analyzer.algorithms import *
 from skyline.analyzer.analyzer import Analyzer
+from skyline.analyzer.features import Features
+import skyline.analyzer.algorithms
 
 
 def check_algorithms(api, args):
-    # Make sure we can run all the algorithms
+    """
+    Make sure we can run all the algorithms, and return how many seconds
+    each of them takes on a day of datapoints.
+    """
     try:
         log.msg("checking algorithms...")
         timeseries = map(list, zip(map(float, range(int(time.time()) - 86400, int(time.time()) + 1)), xrange(86401)))
         ensemble = Analyzer(api, args).is_anomalous(timeseries, "dummy")
         log.msg("passed.")
+
+        # Time every algorithm on its own, without the statistics the others share
+        costs = {}
+        array = np.asarray(timeseries, dtype=float)
+        for algorithm in skyline.analyzer.algorithms.ALGORITHMS:
+            features = Features(array)
+            started = time.time()
+            getattr(skyline.analyzer.algorithms, algorithm)(features, args)
+            costs[algorithm] = time.time() - started
+        log.msg("algorithm costs: {0}".format(", ".join("{0}={1:.1f}ms".format(algorithm, cost * 1000)
+                                                         for algorithm, cost in sorted(costs.items(), key=lambda c: c[1]))))
+        return costs
     except KeyError as e:
         log.msg("Algorithm {} deprecated or not defined".format(e))
         sys.exit(1)
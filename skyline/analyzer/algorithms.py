@@ -1,8 +1,9 @@
 import pandas
 import numpy as np
 import scipy
-import statsmodels.api as sm
 import time
+from skyline.analyzer.features import Features, features
+from skyline.analyzer.memo import adf_stationary, grubbs_score
 
 """
 This is no man's land. Do anything you want in here,
@@ -10,6 +11,10 @@ as long as you return a boolean that determines whether the input
 timeseries is anomalous or not.
 
 To add an algorithm, define it here, and add its name to ALGORITHMS.
+The Analyzer passes every algorithm the same Features of the timeseries,
+which holds its timestamps and values as numpy arrays and computes the
+statistics they share only once. It can still be used as a plain list of
+(timestamp, value) datapoints.
 """
 
 ALGORITHMS = [
@@ -32,6 +37,8 @@ def tail_avg(timeseries, args):
     It reduces noise, but it also reduces sensitivity and increases the delay
     to detection.
     """
+    if isinstance(timeseries, Features):
+        return timeseries.tail_avg
     try:
         t = (timeseries[-1][1] + timeseries[-2][1] + timeseries[-3][1]) / 3
         return t
@@ -44,10 +51,9 @@ def median_absolute_deviation(timeseries, args):
     A timeseries is anomalous if the deviation of its latest datapoint with
     respect to the median is X times larger than the median of deviations.
     """
-    series = pandas.Series([x[1] for x in timeseries])
-    median = series.median()
-    demedianed = np.abs(series - median)
-    median_deviation = demedianed.median()
+    timeseries = features(timeseries)
+    demedianed = timeseries.demedianed
+    median_deviation = timeseries.mad
 
     # The test statistic is infinite when the median is zero,
     # so it becomes super sensitive. We play it safe and skip when this happens.
@@ -68,17 +74,13 @@ def grubbs(timeseries, args):
     """
     A timeseries is anomalous if the Z score is greater than the Grubb's score.
     """
-    series = scipy.array([x[1] for x in timeseries])
-    stdDev = scipy.std(series)
-    mean = np.mean(series)
-    tail_average = tail_avg(timeseries, args)
+    timeseries = features(timeseries)
+    stdDev = timeseries.pstd
+    mean = timeseries.mean
+    tail_average = timeseries.tail_avg
     z_score = (tail_average - mean) / stdDev
-    len_series = len(series)
-    threshold = scipy.stats.t.isf(.05 / (2 * len_series), len_series - 2)
-    threshold_squared = threshold * threshold
-    grubbs_score = ((len_series - 1) / np.sqrt(len_series)) * np.sqrt(threshold_squared / (len_series - 2 + threshold_squared))
 
-    return z_score > grubbs_score
+    return z_score > grubbs_score(len(timeseries.values))
 
 
 def first_hour_average(timeseries, args):
@@ -87,11 +89,12 @@ def first_hour_average(timeseries, args):
     A timeseries is anomalous if the average of the last three datapoints
     are outside of three standard deviations of this value.
     """
+    timeseries = features(timeseries)
     last_hour_threshold = time.time() - (args.full_duration - 3600)
-    series = pandas.Series([x[1] for x in timeseries if x[0] < last_hour_threshold])
+    series = pandas.Series(timeseries.values[timeseries.timestamps < last_hour_threshold])
     mean = (series).mean()
     stdDev = (series).std()
-    t = tail_avg(timeseries, args)
+    t = timeseries.tail_avg
 
     return abs(t - mean) > 3 * stdDev
 
@@ -103,10 +106,10 @@ def stddev_from_average(timeseries, args):
     deviations of the average. This does not exponentially weight the MA and so
     is better for detecting anomalies with respect to the entire series.
     """
-    series = pandas.Series([x[1] for x in timeseries])
-    mean = series.mean()
-    stdDev = series.std()
-    t = tail_avg(timeseries, args)
+    timeseries = features(timeseries)
+    mean = timeseries.mean
+    stdDev = timeseries.std
+    t = timeseries.tail_avg
 
     return abs(t - mean) > 3 * stdDev
 
@@ -118,11 +121,11 @@ def stddev_from_moving_average(timeseries, args):
     deviations of the moving average. This is better for finding anomalies with
     respect to the short term trends.
     """
-    series = pandas.Series([x[1] for x in timeseries])
-    expAverage = pandas.stats.moments.ewma(series, com=50)
-    stdDev = pandas.stats.moments.ewmstd(series, com=50)
+    timeseries = features(timeseries)
+    expAverage = timeseries.ewma(50)
+    stdDev = timeseries.ewmstd(50)
 
-    return abs(series.iget(-1) - expAverage.iget(-1)) > 3 * stdDev.iget(-1)
+    return abs(timeseries.values[-1] - expAverage.iget(-1)) > 3 * stdDev.iget(-1)
 
 
 def mean_subtraction_cumulation(timeseries, args):
@@ -132,10 +135,9 @@ def mean_subtraction_cumulation(timeseries, args):
     after subtracting the mean from each data point.
     """
 
-    series = pandas.Series([x[1] if x[1] else 0 for x in timeseries])
+    series = features(timeseries).series
     series = series - series[0:len(series) - 1].mean()
     stdDev = series[0:len(series) - 1].std()
-    expAverage = pandas.stats.moments.ewma(series, com=15)
 
     return abs(series.iget(-1)) > 3 * stdDev
 
@@ -145,17 +147,12 @@ def least_squares(timeseries, args):
     A timeseries is anomalous if the average of the last three datapoints
     on a projected least squares model is greater than three sigma.
     """
-    x = np.array([t[0] for t in timeseries])
-    y = np.array([t[1] for t in timeseries])
+    timeseries = features(timeseries)
+    x = timeseries.timestamps
+    y = timeseries.values
     A = np.vstack([x, np.ones(len(x))]).T
-    results = np.linalg.lstsq(A, y)
-    residual = results[1]
     m, c = np.linalg.lstsq(A, y)[0]
-    errors = []
-    for i, value in enumerate(y):
-        projected = m * x[i] + c
-        error = value - projected
-        errors.append(error)
+    errors = y - (m * x + c)
 
     if len(errors) < 3:
         return False
@@ -175,9 +172,9 @@ def histogram_bins(timeseries, args):
     Returns: the size of the bin which contains the tail_avg. Smaller bin size
     means more anomalous.
     """
-    series = scipy.array([x[1] for x in timeseries])
-    t = tail_avg(timeseries, args)
-    h = np.histogram(series, bins=15)
+    timeseries = features(timeseries)
+    t = timeseries.tail_avg
+    h = timeseries.histogram
     bins = h[1]
     for index, bin_size in enumerate(h[0]):
         if bin_size <= 20:
@@ -199,10 +196,12 @@ def ks_test(timeseries, args):
     It produces false positives on non-stationary series so Augmented
     Dickey-Fuller test applied to check for stationarity.
     """
+    timeseries = features(timeseries)
     hour_ago = time.time() - 3600
     ten_minutes_ago = time.time() - 600
-    reference = scipy.array([x[1] for x in timeseries if x[0] >= hour_ago and x[0] < ten_minutes_ago])
-    probe = scipy.array([x[1] for x in timeseries if x[0] >= ten_minutes_ago])
+    timestamps = timeseries.timestamps
+    reference = timeseries.values[(timestamps >= hour_ago) & (timestamps < ten_minutes_ago)]
+    probe = timeseries.values[timestamps >= ten_minutes_ago]
 
     if reference.size < 20 or probe.size < 20:
         return False
@@ -210,8 +209,7 @@ def ks_test(timeseries, args):
     ks_d, ks_p_value = scipy.stats.ks_2samp(reference, probe)
 
     if ks_p_value < 0.05 and ks_d > 0.5:
-        adf = sm.tsa.stattools.adfuller(reference, 10)
-        if adf[1] < 0.05:
+        if adf_stationary(timeseries.metric, reference, args.adf_ttl):
             return True
 
     return False
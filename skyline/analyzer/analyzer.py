@@ -1,10 +1,20 @@
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.internet.threads import deferToThread
 from twisted.python import log
+from skyline.analyzer.features import Features
+from skyline.analyzer.streaming import STREAMING_ALGORITHMS, StreamState
 import collections
+import numpy as np
+import pandas
 import re
 import time
 import skyline.analyzer.alerts
 import skyline.analyzer.algorithms
+import skyline.analyzer.batch
+import skyline.analyzer.memo
+import skyline.analyzer.streaming
 
 
 class TooShort(Exception):
@@ -19,16 +29,55 @@ class Boring(Exception):
     pass
 
 
+# The result of the algorithms --short-circuit didn't need to run
+SKIPPED = 'skipped'
+
+# How long the analyzer sleeps between polls while there is nothing to do
+MIN_IDLE = 0.01
+MAX_IDLE = 1
+
+
 def emit(metric, value):
     log.msg(metric + " " + value)
 
 
 class Analyzer(object):
-    def __init__(self, api, arguments, *args, **kwargs):
+    def __init__(self, api, arguments, worker=None, *args, **kwargs):
         self.api = api
         self.args = arguments
+        self.worker = worker
         self.alerts_rules = self.api.get_alerts_rules()
         self.alerts_settings = self.api.get_alerts_settings()
+        self.stats = collections.Counter()
+        self.stats_started = time.time()
+        self.queue_ages = []
+
+    def log_stats(self, force=False):
+        """
+        Log how many metrics were analyzed since the last time, at most every
+        --stats-interval seconds unless forced.
+        """
+        now = time.time()
+        elapsed = now - self.stats_started
+        if elapsed <= 0 or (elapsed < self.args.stats_interval and not force):
+            return
+        stats, self.stats = self.stats, collections.Counter()
+        self.stats_started = now
+        name = "analyzer" if self.worker is None else "analyzer worker {0}".format(self.worker)
+        log.msg("{0}: analyzed {1} metrics in {2:.0f}s ({3:.1f}/s, {4:.0f}% busy), {5} anomalous, {6} skipped, {7} errors".format(
+            name, stats["analyzed"], elapsed, stats["analyzed"] / elapsed, 100 * stats["busy"] / elapsed,
+            stats["anomalous"], stats["skipped"], stats["errors"]))
+        log.msg("{0}: memo hits/misses: adf {1}/{2}, grubbs {3}/{4}".format(
+            name, *(skyline.analyzer.memo.ADF.pop_stats() + skyline.analyzer.memo.GRUBBS.pop_stats())))
+        queue_ages, self.queue_ages = self.queue_ages, []
+        if queue_ages:
+            log.msg("{0}: queue age p50 {1:.1f}s, p90 {2:.1f}s, p99 {3:.1f}s, max {4:.1f}s".format(
+                name, *(np.percentile(queue_ages, [50, 90, 99]).tolist() + [max(queue_ages)])))
+
+    def queued(self, claimed):
+        """Record how long the claimed (metric, queued_at) waited in the work queue."""
+        now = time.time()
+        self.queue_ages.extend(now - queued_at for metric, queued_at in claimed)
 
     def alert(self, metric, datapoint, ensemble, check=False, trigger=True):
         triggers = []
@@ -49,9 +98,9 @@ class Analyzer(object):
                     log.err("could not send alert {} for metric {}: {}".format(strategy, metric, e))
         return triggers
 
-    def is_anomalous(self, timeseries, metric_name):
+    def check(self, timeseries):
         """
-        Filter timeseries and run selected algorithm.
+        Raise TooShort, Stale or Boring for timeseries not worth analyzing.
         """
         # Get rid of short series
         if len(timeseries) < self.args.min_tolerable_length:
@@ -62,20 +111,72 @@ class Analyzer(object):
             raise Stale()
 
         # Get rid of boring series
-        if len(set(item[1] for item in timeseries[-self.args.max_tolerable_boredom:])) == self.args.boredom_set_size:
+        tail = np.asarray(timeseries[-self.args.max_tolerable_boredom:], dtype=float).reshape(-1, 2)
+        if len(np.unique(tail[:, 1])) == self.args.boredom_set_size:
             raise Boring()
 
-        ensemble = {algorithm: getattr(skyline.analyzer.algorithms, algorithm)(timeseries, self.args) for algorithm in skyline.analyzer.algorithms.ALGORITHMS}
+    def is_anomalous(self, timeseries, metric_name):
+        """
+        Filter timeseries and run selected algorithm.
+        """
+        self.check(timeseries)
+
+        # Every algorithm shares the arrays and statistics of the series
+        features = Features(timeseries, metric_name)
+        if self.args.short_circuit:
+            ensemble = self.short_circuit(features)
+        else:
+            ensemble = {algorithm: getattr(skyline.analyzer.algorithms, algorithm)(features, self.args) for algorithm in skyline.analyzer.algorithms.ALGORITHMS}
+        return self.verdict(metric_name, ensemble, timeseries[-1], self.args.consensus)
+
+    def algorithms(self):
+        """The algorithms, cheapest first according to check_algorithms."""
+        costs = getattr(self.args, "algorithm_costs", None) or {}
+        return sorted(skyline.analyzer.algorithms.ALGORITHMS, key=lambda algorithm: costs.get(algorithm, float('inf')))
+
+    def short_circuit(self, features):
+        """
+        Run the algorithms cheapest first until the consensus is reached or
+        out of reach. The algorithms that didn't run are SKIPPED.
+        """
+        algorithms = self.algorithms()
+        ensemble = dict.fromkeys(algorithms, SKIPPED)
+        anomalous = 0
+        for remaining, algorithm in zip(xrange(len(algorithms), 0, -1), algorithms):
+            if anomalous >= self.args.consensus or anomalous + remaining < self.args.consensus:
+                break
+            ensemble[algorithm] = getattr(skyline.analyzer.algorithms, algorithm)(features, self.args)
+            if ensemble[algorithm]:
+                anomalous += 1
+        return ensemble
+
+    def is_anomalous_stream(self, state, metric_name):
+        """
+        Filter a StreamState and run the streaming algorithms, which must all
+        agree unless --consensus is lower.
+        """
+        if state.count < self.args.min_tolerable_length:
+            raise TooShort()
+
+        if (time.time() - state.last_timestamp) > self.args.stale_period:
+            raise Stale()
+
+        if len(np.unique(state.tail[-self.args.max_tolerable_boredom:])) == self.args.boredom_set_size:
+            raise Boring()
+
+        ensemble = {algorithm: getattr(skyline.analyzer.streaming, algorithm)(state, self.args) for algorithm in STREAMING_ALGORITHMS}
+        return self.verdict(metric_name, ensemble, state.datapoint, min(self.args.consensus, len(ensemble)))
 
-        if collections.Counter(ensemble.values())[True] >= self.args.consensus:
-            return True, ensemble, timeseries[-1]
+    def verdict(self, metric_name, ensemble, datapoint, consensus):
+        if collections.Counter(ensemble.values())[True] >= consensus:
+            return True, ensemble, datapoint
 
         # Check for second order anomalies
         if self.args.enable_second_order:
-            if self.is_anomalously_anomalous(metric_name, ensemble, timeseries[-1]):
-                return True, ensemble, timeseries[-1]
+            if self.is_anomalously_anomalous(metric_name, ensemble, datapoint):
+                return True, ensemble, datapoint
 
-        return False, ensemble, timeseries[-1]
+        return False, ensemble, datapoint
 
     def is_anomalously_anomalous(self, metric_name, ensemble, datapoint):
         """
@@ -86,20 +187,18 @@ class Analyzer(object):
         new_trigger = [time.time(), datapoint[1]]
 
         # Get the old history
-        raw_trigger_history = redis_conn.get('trigger_history:' + metric_name)
-        if not raw_trigger_history:
-            redis_conn.set('trigger_history:' + metric_name, packb([(time.time(), datapoint[1])]))
+        trigger_history = self.api.get_trigger_history(metric_name)
+        if not trigger_history:
+            self.api.set_trigger_history(metric_name, [new_trigger])
             return True
 
-        trigger_history = unpackb(raw_trigger_history)
-
         # Are we (probably) triggering on the same data?
         if (new_trigger[1] == trigger_history[-1][1] and new_trigger[0] - trigger_history[-1][0] <= 300):
             return False
 
         # Update the history
         trigger_history.append(new_trigger)
-        redis_conn.set('trigger_history.' + metric_name, packb(trigger_history))
+        self.api.set_trigger_history(metric_name, trigger_history)
 
         # Should we surface the anomaly?
         trigger_times = [x[0] for x in trigger_history]
@@ -113,19 +212,122 @@ class Analyzer(object):
         return abs(intervals[-1] - series.mean()) > 3 * series.std()
 
     def run(self):
+        idle = 0
         while reactor.running:
             self.api.waitfor_connection()
-            # Check existence of a newly updated metic
-            metric = self.api.pop_metricset_updated()
-            if metric:
-                self.process(metric)
+            # Claim the metrics that waited longest for analysis
+            claimed = self.api.claim_metrics(self.args.batch_size, self.args.anomalous_boost, bool(self.args.max_latency))
+            if claimed:
+                self.queued(claimed)
+                self.process_many([metric for metric, queued_at in claimed])
+                idle = 0
                 # TODO trim metric
             else:
                 if int(time.time()) % 60 == 0:
                     log.msg("nothing to do")
-                time.sleep(1)
+                # Poll quickly while metrics trickle in, backing off to a second
+                idle = min(max(idle * 2, MIN_IDLE), MAX_IDLE)
+                time.sleep(idle)
+            self.log_stats()
             # TODO send codahale metrics
 
+    def analyze(self, metric, timeseries):
+        """
+        Run the algorithms on the timeseries of a metric, or the streaming
+        algorithms on its StreamState, returning (anomalous, ensemble,
+        datapoint) or None if it can't be analyzed.
+        """
+        started = time.time()
+        try:
+            if isinstance(timeseries, StreamState):
+                anomalous, ensemble, datapoint = self.is_anomalous_stream(timeseries, metric)
+            else:
+                anomalous, ensemble, datapoint = self.is_anomalous(timeseries, metric)
+        except (TooShort, Stale, Boring) as e:
+            self.skipped(metric, e)
+            return None
+        finally:
+            self.stats["busy"] += time.time() - started
+        return self.record(metric, anomalous, ensemble, datapoint)
+
+    def analyze_many(self, metrics, timeseries):
+        """
+        analyze() a batch of metrics at once, with the vectorized algorithms
+        of skyline.analyzer.batch.
+        """
+        started = time.time()
+        results = [None] * len(metrics)
+        kept = []
+        for i, metric in enumerate(metrics):
+            try:
+                self.check(timeseries[i])
+                kept.append(i)
+            except (TooShort, Stale, Boring) as e:
+                self.skipped(metric, e)
+
+        try:
+            if self.args.short_circuit:
+                algorithms = self.algorithms()
+                ensembles = skyline.analyzer.batch.ensembles([timeseries[i] for i in kept], self.args, algorithms, self.args.consensus,
+                                                             [metrics[i] for i in kept])
+                for ensemble in ensembles:
+                    for algorithm in algorithms:
+                        ensemble.setdefault(algorithm, SKIPPED)
+            else:
+                ensembles = skyline.analyzer.batch.ensembles([timeseries[i] for i in kept], self.args, metrics=[metrics[i] for i in kept])
+            for i, ensemble in zip(kept, ensembles):
+                results[i] = self.verdict(metrics[i], ensemble, timeseries[i][-1], self.args.consensus)
+        finally:
+            self.stats["busy"] += time.time() - started
+
+        for i in kept:
+            self.record(metrics[i], *results[i])
+        return results
+
+    def skipped(self, metric, e):
+        emit("skyline.analyzer.exception.{}".format(e.__class__.__name__), metric)
+        self.stats["skipped"] += 1
+
+    def record(self, metric, anomalous, ensemble, datapoint):
+        self.stats["analyzed"] += 1
+        if anomalous:
+            self.stats["anomalous"] += 1
+
+        # Get the anomaly breakdown - who returned True?
+        for algorithm, result in ensemble.iteritems():
+            if result is not SKIPPED and result:
+                emit("skyline.analyzer.anomaly.{}".format(algorithm), metric)
+        return anomalous, ensemble, datapoint
+
+    def interval(self, info, results):
+        """
+        How many seconds to wait before analyzing a metric again: the
+        --min-interval while it is anomalous, halving while some algorithms
+        flag it, and doubling while none do or it is skipped, up to
+        --max-latency. A metric that was anomalous recently is thus analyzed
+        more often than one that has been calm for a while.
+        """
+        interval = float(info.get("analysis_interval") or self.args.min_interval)
+        if results is None:
+            interval *= 2
+        else:
+            anomalous, ensemble, datapoint = results
+            if anomalous:
+                interval = self.args.min_interval
+            elif any(result is not SKIPPED and result for result in ensemble.itervalues()):
+                interval /= 2
+            else:
+                interval *= 2
+        return min(max(interval, self.args.min_interval, 1), self.args.max_latency)
+
+    def report(self, metric, anomalous, ensemble, datapoint):
+        """Send out the alerts of an analyzed metric."""
+        if anomalous:
+            emit("skyline.analyzer.metric.anomalous", metric)
+            return self.alert(metric, datapoint, ensemble)
+        else:
+            emit("skyline.analyzer.metric.ok", metric)
+
     def process(self, metric):
         """
         Assign a bunch of metrics for a process to analyze.
@@ -134,41 +336,165 @@ class Analyzer(object):
             # Fetch the metric metadata and data
             try:
                 timeseries = self.api.get_metric_data(metric)
-                anomalous, ensemble, datapoint = self.is_anomalous(timeseries, metric)
-
-                # Get the anomaly breakdown - who returned True?
-                for algorithm, result in ensemble.iteritems():
-                    if result:
-                        emit("skyline.analyzer.anomaly.{}".format(algorithm), metric)
+                results = self.analyze(metric, timeseries)
+                if results is None:
+                    return
 
                 # Update the datastore with the results
-                with self.api.pipeline() as pipe:
-                    now = time.time()
-                    # Update the anomalous results
-                    if anomalous:
-                        pipe.zadd("skyline:metricset:anomalous", now, metric)
-                        pipe.hset("skyline:metric:{0}:info".format(metric), "last_anomaly_at", now)
-                        pipe.hset("skyline:metric:{0}:info".format(metric), "last_anomaly_timestamp", datapoint[0])
-                        pipe.hset("skyline:metric:{0}:info".format(metric), "last_anomaly_value", datapoint[1])
-                        pipe.hmset("skyline:metric:{0}:last_anomaly_results".format(metric), ensemble)
-
-                    # Update the current results
-                    pipe.hset("skyline:metric:{0}:info".format(metric), "is_anomalous", anomalous)
-                    pipe.hset("skyline:metric:{0}:info".format(metric), "last_analyzed_at", now)
-                    pipe.hset("skyline:metric:{0}:info".format(metric), "last_analyzed_timestamp", datapoint[0])
-                    pipe.hset("skyline:metric:{0}:info".format(metric), "last_analyzed_value", datapoint[1])
-                    pipe.hmset("skyline:metric:{0}:last_analyzed_results".format(metric), ensemble)
-                    pipe.execute()
+                self.api.set_analyzed_results(metric, *results)
 
                 # Send out alerts
-                if anomalous:
-                    emit("skyline.analyzer.metric.anomalous", metric)
-                    return self.alert(metric, datapoint, ensemble)
-                else:
-                    emit("skyline.analyzer.metric.ok", metric)
+                return self.report(metric, *results)
+            except Exception as e:
+                emit("skyline.analyzer.exception.Other", metric)
+                self.stats["errors"] += 1
+                log.err(e)
 
-            except (TooShort, Stale, Boring) as e:
-                emit("skyline.analyzer.exception.{}".format(e.__class__.__name__), metric)
+    def process_many(self, metrics):
+        """
+        Analyze a batch of metrics, fetching their data in one pipeline and
+        writing all their results in another. With --streaming only the
+        datapoints appended since the last analysis are fetched, and folded
+        into the saved StreamState of each metric. With --max-latency the
+        next analysis of every metric is scheduled along with its results.
+        """
+        try:
+            if self.args.streaming:
+                fetched = self.api.get_metrics_stream(metrics)
+            else:
+                fetched = self.api.get_metrics_data(metrics)
+        except Exception as e:
+            self.stats["errors"] += len(metrics)
+            log.err(e)
+            return
+
+        infos = dict((metric, data[1]) for metric, data in zip(metrics, fetched))
+        analyzed = []
+        skipped = []
+        states = []
+        if self.args.vectorized and not self.args.streaming:
+            try:
+                batch = self.analyze_many(metrics, [timeseries for timeseries, info in fetched])
+                analyzed = [(metric, results) for metric, results in zip(metrics, batch) if results is not None]
+                skipped = [metric for metric, results in zip(metrics, batch) if results is None]
+                fetched = []  # Nothing left to analyze one at a time
+            except Exception as e:
+                # Fall back to analyzing them one at a time
+                log.err(e, "vectorized analysis failed")
+        for metric, data in zip(metrics, fetched):
+            try:
+                if self.args.streaming:
+                    datapoints, info, fields = data
+                    timeseries = StreamState.load(fields, self.args.max_tolerable_boredom)
+                    timeseries.update(datapoints)
+                    states.append((metric, timeseries))
+                else:
+                    timeseries, info = data
+                results = self.analyze(metric, timeseries)
+                if results is not None:
+                    analyzed.append((metric, results))
+                else:
+                    skipped.append(metric)
             except Exception as e:
                 emit("skyline.analyzer.exception.Other", metric)
+                self.stats["errors"] += 1
                 log.err(e)
+        if not analyzed and not states and not (skipped and self.args.max_latency):
+            return
+
+        # Update the datastore with the results
+        try:
+            with self.api.pipeline(transaction=False) as pipe:
+                for metric, state in states:
+                    self.api.set_stream_state(metric, state.dump(), pipe)
+                for metric, results in analyzed:
+                    self.api.set_analyzed_results(metric, *results, pipe=pipe)
+                if self.args.max_latency:
+                    for metric, results in analyzed + [(metric, None) for metric in skipped]:
+                        self.api.schedule_analysis(metric, self.interval(infos[metric], results), pipe)
+                pipe.execute()
+        except Exception as e:
+            log.err(e)
+
+        # Send out alerts
+        for metric, results in analyzed:
+            try:
+                self.report(metric, *results)
+            except Exception as e:
+                emit("skyline.analyzer.exception.Other", metric)
+                self.stats["errors"] += 1
+                log.err(e)
+
+
+class AsyncAnalyzer(Analyzer):
+    """
+    Analyze up to --concurrency metrics at a time from the reactor, claiming
+    them one at a time. Claiming and fetching metrics and writing their results go through an
+    AsyncSkylineRedisApi, so they overlap with the algorithms and alerts,
+    which run in the reactor's thread pool with the blocking api.
+    """
+    def __init__(self, api, arguments, worker=None, *args, **kwargs):
+        Analyzer.__init__(self, api.blocking, arguments, worker)
+        self.async_api = api
+        self.stopping = False
+        self.in_flight = 0
+        self.drained = None
+
+    def start(self):
+        reactor.suggestThreadPoolSize(max(10, self.args.concurrency))
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+        LoopingCall(self.log_stats).start(self.args.stats_interval, now=False)
+        for i in xrange(self.args.concurrency):
+            self.next()
+
+    def stop(self):
+        """Stop claiming metrics, returning a Deferred that fires once the ones in flight are done."""
+        self.stopping = True
+        if self.in_flight:
+            self.drained = Deferred()
+            return self.drained
+
+    def next(self, result=None):
+        if self.stopping or not reactor.running:
+            return
+        d = self.async_api.claim_metrics(1, self.args.anomalous_boost)
+        d.addCallback(self.fetch)
+        d.addErrback(self.failed)
+        d.addCallback(self.next)
+
+    def fetch(self, claimed):
+        if not claimed:
+            return deferLater(reactor, 1, lambda: None)
+        self.queued(claimed)
+        metric, queued_at = claimed[0]
+        self.in_flight += 1
+        d = self.async_api.get_metric_data(metric)
+        d.addCallback(lambda timeseries: deferToThread(self.analyze, metric, timeseries))
+        d.addCallback(self.analyzed, metric)
+        d.addErrback(self.error, metric)
+        d.addBoth(self.done)
+        return d
+
+    def analyzed(self, results, metric):
+        if results is None:
+            return
+        # Don't wait for the results to be written before moving on
+        d = self.async_api.set_analyzed_results(metric, *results)
+        d.addErrback(self.error, metric)
+        return deferToThread(self.report, metric, *results)
+
+    def error(self, failure, metric):
+        emit("skyline.analyzer.exception.Other", metric)
+        self.stats["errors"] += 1
+        log.err(failure)
+
+    def done(self, result):
+        self.in_flight -= 1
+        if self.drained is not None and not self.in_flight:
+            self.drained, drained = None, self.drained
+            drained.callback(None)
+        return result
+
+    def failed(self, failure):
+        log.err(failure, "can't claim a metric")
+        return deferLater(reactor, 1, lambda: None)
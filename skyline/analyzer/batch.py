@@ -0,0 +1,265 @@
+import numpy as np
+import scipy.stats
+import time
+import skyline.analyzer.algorithms
+from skyline.analyzer.features import Features
+from skyline.analyzer.memo import grubbs_score
+from skyline.analyzer.streaming import COM
+
+"""
+Vectorized versions of the algorithms, evaluated on many metrics at once.
+The timeseries are stacked into 2D arrays, aligned on their last datapoint
+and padded with NaN, and every algorithm becomes a few operations on whole
+rows that leave the padding out. ks_test only runs its Augmented
+Dickey-Fuller test per metric, and algorithms without a vectorized
+version, like any added to ALGORITHMS, run on each metric as usual. The
+verdicts are the same as the per metric algorithms'.
+"""
+
+# The most datapoints stacked in one block, bounding the memory used
+MAX_BLOCK_SIZE = 1 << 21
+
+
+class Block(object):
+    """
+    Timeseries stacked into (metrics, width) arrays of their timestamps and
+    values, aligned on their last datapoint. valid masks out the padding.
+    metrics names the rows, if known.
+    """
+    def __init__(self, arrays, metrics=None):
+        self.arrays = arrays
+        self.metrics = metrics or [None] * len(arrays)
+        self.features_of = {}
+        self.lengths = np.array([len(array) for array in arrays])
+        self.width = self.lengths.max()
+        self.rows = np.arange(len(arrays))
+        self.valid = np.arange(self.width) >= (self.width - self.lengths)[:, None]
+        self.timestamps = np.full((len(arrays), self.width), np.nan)
+        self.values = np.full((len(arrays), self.width), np.nan)
+        for row, array in enumerate(arrays):
+            self.timestamps[row, self.width - len(array):] = array[:, 0]
+            self.values[row, self.width - len(array):] = array[:, 1]
+
+    def sum(self, values, mask=None):
+        return np.where(self.valid if mask is None else mask, values, 0.0).sum(axis=1)
+
+    def mean(self, values, mask=None):
+        count = self.lengths if mask is None else mask.sum(axis=1)
+        return self.sum(values, mask) / count
+
+    def std(self, values, ddof=0, mask=None):
+        count = self.lengths if mask is None else mask.sum(axis=1)
+        mean = self.mean(values, mask)
+        return np.sqrt(self.sum(np.square(values - mean[:, None]), mask) / (count - ddof))
+
+    def median(self, values):
+        """The median of every row, with the padding moved last as infinity."""
+        middle = np.unique(np.concatenate(((self.lengths - 1) // 2, self.lengths // 2)))
+        values = np.where(self.valid, values, np.inf)
+        if len(middle) <= 16:
+            # Rows of the same length only need the middle values in place
+            ordered = np.partition(values, middle, axis=1)
+        else:
+            ordered = np.sort(values, axis=1)
+        return (ordered[self.rows, (self.lengths - 1) // 2] + ordered[self.rows, self.lengths // 2]) / 2
+
+    def tail_avg(self):
+        last = self.values[:, -1]
+        return np.where(self.lengths >= 3, (last + self.values[:, -2] + self.values[:, -3]) / 3, last)
+
+    def features(self, row):
+        if row not in self.features_of:
+            self.features_of[row] = Features(self.arrays[row], self.metrics[row])
+        return self.features_of[row]
+
+    def subset(self, rows):
+        """A Block of the rows selected by a mask."""
+        rows = np.nonzero(rows)[0]
+        return Block([self.arrays[row] for row in rows], [self.metrics[row] for row in rows])
+
+
+def median_absolute_deviation(block, args):
+    demedianed = np.abs(block.values - block.median(block.values)[:, None])
+    median_deviation = block.median(demedianed)
+    return (median_deviation != 0) & (demedianed[:, -1] / median_deviation > 6)
+
+
+def grubbs(block, args):
+    z_score = (block.tail_avg() - block.mean(block.values)) / block.std(block.values)
+    lengths, rows = np.unique(block.lengths, return_inverse=True)
+    return z_score > np.array([grubbs_score(n) for n in lengths])[rows]
+
+
+def first_hour_average(block, args):
+    last_hour_threshold = time.time() - (args.full_duration - 3600)
+    mask = block.valid & (block.timestamps < last_hour_threshold)
+    mean = block.mean(block.values, mask)
+    stdDev = block.std(block.values, 1, mask)
+    return np.abs(block.tail_avg() - mean) > 3 * stdDev
+
+
+def stddev_from_average(block, args):
+    mean = block.mean(block.values)
+    stdDev = block.std(block.values, 1)
+    return np.abs(block.tail_avg() - mean) > 3 * stdDev
+
+
+def stddev_from_moving_average(block, args):
+    # The last value of pandas' adjusted ewma and ewmstd is a weighted mean
+    # and bias corrected variance, with weights decaying from the end
+    decay = 1 - 1.0 / (1 + COM)
+    weights = np.where(block.valid, decay ** np.arange(block.width - 1, -1, -1, dtype=float), 0.0)
+    weight = weights.sum(axis=1)
+    weight2 = np.square(weights).sum(axis=1)
+    values = np.where(block.valid, block.values, 0.0)
+    expAverage = (weights * values).sum(axis=1) / weight
+    variance = (weights * np.square(values - expAverage[:, None])).sum(axis=1) / weight
+    stdDev = np.sqrt(variance * weight * weight / (weight * weight - weight2))
+    return np.abs(block.values[:, -1] - expAverage) > 3 * stdDev
+
+
+def mean_subtraction_cumulation(block, args):
+    previous = block.valid.copy()
+    previous[:, -1] = False
+    mean = block.mean(block.values, previous)
+    stdDev = block.std(block.values, 1, previous)
+    return np.abs(block.values[:, -1] - mean) > 3 * stdDev
+
+
+def least_squares(block, args):
+    # The closed form of the least squares line, centered for precision
+    x = block.timestamps - block.mean(block.timestamps)[:, None]
+    y = block.values - block.mean(block.values)[:, None]
+    m = block.sum(x * y) / block.sum(x * x)
+    errors = y - m[:, None] * x
+    std_dev = block.std(errors)
+    t = (errors[:, -1] + errors[:, -2] + errors[:, -3]) / 3
+    # round(v) != 0 is abs(v) >= 0.5 with python's rounding
+    return (block.lengths >= 3) & (np.abs(t) > std_dev * 3) & (np.abs(std_dev) >= 0.5) & (np.abs(t) >= 0.5)
+
+
+def histogram_bins(block, args):
+    # np.histogram(series, bins=15) of every row, computed like numpy does
+    bins = 15
+    minimum = np.where(block.valid, block.values, np.inf).min(axis=1)
+    maximum = np.where(block.valid, block.values, -np.inf).max(axis=1)
+    flat = minimum == maximum
+    minimum = np.where(flat, minimum - 0.5, minimum)
+    maximum = np.where(flat, maximum + 0.5, maximum)
+    edges = np.arange(bins + 1) * ((maximum - minimum) / bins)[:, None] + minimum[:, None]
+    edges[:, -1] = maximum
+
+    rows, columns = np.nonzero(block.valid)
+    values = block.values[rows, columns]
+    indices = ((values - minimum[rows]) * (bins / (maximum - minimum))[rows]).astype(np.intp)
+    indices[indices == bins] -= 1
+    indices[values < edges[rows, indices]] -= 1
+    indices[(values >= edges[rows, indices + 1]) & (indices != bins - 1)] += 1
+    counts = np.bincount(rows * bins + indices, minlength=len(block.lengths) * bins).reshape(-1, bins)
+
+    t = block.tail_avg()[:, None]
+    inside = (t >= edges[:, :-1]) & (t < edges[:, 1:])
+    inside[:, 0] = t[:, 0] <= edges[:, 0]
+    return ((counts <= 20) & inside).any(axis=1)
+
+
+def ks_test(block, args):
+    """
+    The two sample Kolmogorov-Smirnov test of every row at once. The
+    Augmented Dickey-Fuller test is only run, one metric at a time, on the
+    rows the KS test flags.
+    """
+    hour_ago = time.time() - 3600
+    ten_minutes_ago = time.time() - 600
+    reference = block.valid & (block.timestamps >= hour_ago) & (block.timestamps < ten_minutes_ago)
+    probe = block.valid & (block.timestamps >= ten_minutes_ago)
+    n1 = reference.sum(axis=1)
+    n2 = probe.sum(axis=1)
+    verdicts = np.zeros(len(block.lengths), dtype=bool)
+    if not ((n1 >= 20) & (n2 >= 20)).any():
+        return verdicts
+
+    # Only sort the columns holding the last hour of some row
+    start = np.nonzero((reference | probe).any(axis=0))[0][0]
+    reference = reference[:, start:]
+    probe = probe[:, start:]
+    values = np.where(reference | probe, block.values[:, start:], np.inf)
+    order = np.argsort(values, axis=1, kind='mergesort')
+    rows = block.rows[:, None]
+    ordered = values[rows, order]
+
+    # The empirical cdfs after every distinct value, like ks_2samp
+    cdf1 = np.cumsum(reference[rows, order], axis=1) / n1[:, None].astype(float)
+    cdf2 = np.cumsum(probe[rows, order], axis=1) / n2[:, None].astype(float)
+    last = np.ones(ordered.shape, dtype=bool)
+    last[:, :-1] = ordered[:, :-1] != ordered[:, 1:]
+    last &= np.isfinite(ordered)
+    ks_d = np.where(last, np.abs(cdf1 - cdf2), 0.0).max(axis=1)
+    en = np.sqrt(n1 * n2 / (n1 + n2).astype(float))
+    ks_p_value = scipy.stats.kstwobign.sf((en + 0.12 + 0.11 / en) * ks_d)
+
+    for row in np.nonzero((n1 >= 20) & (n2 >= 20) & (ks_p_value < 0.05) & (ks_d > 0.5))[0]:
+        verdicts[row] = skyline.analyzer.algorithms.ks_test(block.features(row), args)
+    return verdicts
+
+
+VECTORIZED = {
+    'first_hour_average': first_hour_average,
+    'mean_subtraction_cumulation': mean_subtraction_cumulation,
+    'stddev_from_average': stddev_from_average,
+    'stddev_from_moving_average': stddev_from_moving_average,
+    'least_squares': least_squares,
+    'grubbs': grubbs,
+    'histogram_bins': histogram_bins,
+    'median_absolute_deviation': median_absolute_deviation,
+    'ks_test': ks_test,
+}
+
+
+def blocks(arrays, metrics=None):
+    """Split the arrays into Blocks of similar lengths of up to MAX_BLOCK_SIZE datapoints, with their indexes."""
+    metrics = metrics or [None] * len(arrays)
+    order = sorted(xrange(len(arrays)), key=lambda i: len(arrays[i]))
+    start = 0
+    while start < len(order):
+        end = start + 1
+        while end < len(order) and (end + 1 - start) * len(arrays[order[end]]) <= MAX_BLOCK_SIZE:
+            end += 1
+        indexes = order[start:end]
+        yield indexes, Block([arrays[i] for i in indexes], [metrics[i] for i in indexes])
+        start = end
+
+
+def ensembles(timeseries, args, algorithms=None, consensus=None, metrics=None):
+    """
+    Run the algorithms on many timeseries at once, returning the ensemble of
+    each. With a consensus the algorithms run in the order given, and stop
+    for a timeseries once it is reached or out of reach, leaving the
+    remaining algorithms out of its ensemble. metrics names the timeseries.
+    """
+    if algorithms is None:
+        algorithms = skyline.analyzer.algorithms.ALGORITHMS
+    arrays = [np.asarray(series, dtype=float).reshape(-1, 2) for series in timeseries]
+    results = [{} for series in timeseries]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for indexes, block in blocks(arrays, metrics):
+            indexes = np.array(indexes)
+            anomalous = np.zeros(len(indexes), dtype=int)
+            for remaining, algorithm in zip(xrange(len(algorithms), 0, -1), algorithms):
+                if consensus is not None:
+                    undecided = (anomalous < consensus) & (anomalous + remaining >= consensus)
+                    if not undecided.any():
+                        break
+                    if not undecided.all():
+                        block = block.subset(undecided)
+                        indexes = indexes[undecided]
+                        anomalous = anomalous[undecided]
+
+                if algorithm in VECTORIZED:
+                    verdicts = VECTORIZED[algorithm](block, args)
+                else:
+                    verdicts = [getattr(skyline.analyzer.algorithms, algorithm)(block.features(row), args) for row in block.rows]
+                anomalous += np.asarray(verdicts, dtype=bool)
+                for i, verdict in zip(indexes, verdicts):
+                    results[i][algorithm] = verdict
+    return results
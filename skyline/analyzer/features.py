@@ -0,0 +1,101 @@
+import numpy as np
+import pandas
+
+
+class memoized(object):
+    """A property computed the first time it is read, then stored on the instance."""
+    def __init__(self, method):
+        self.method = method
+        self.__doc__ = method.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.method.__name__] = self.method(instance)
+        return value
+
+
+class Features(object):
+    """
+    A timeseries converted once to numpy arrays of its timestamps and
+    values, with the statistics the algorithms share computed the first time
+    one of them asks. It still behaves as the sequence of datapoints it was
+    built from, so algorithms written for plain timeseries keep working.
+    metric is the name of the metric, if known.
+    """
+    def __init__(self, timeseries, metric=None):
+        self.timeseries = timeseries
+        self.metric = metric
+        array = np.asarray(timeseries, dtype=float).reshape(-1, 2)
+        self.timestamps = array[:, 0]
+        self.values = array[:, 1]
+        self.ewmas = {}
+        self.ewmstds = {}
+
+    def __len__(self):
+        return len(self.timeseries)
+
+    def __getitem__(self, index):
+        return self.timeseries[index]
+
+    def __iter__(self):
+        return iter(self.timeseries)
+
+    @memoized
+    def series(self):
+        return pandas.Series(self.values)
+
+    @memoized
+    def mean(self):
+        return self.series.mean()
+
+    @memoized
+    def std(self):
+        """The sample standard deviation, like pandas."""
+        return self.series.std()
+
+    @memoized
+    def pstd(self):
+        """The population standard deviation, like numpy."""
+        return np.std(self.values)
+
+    @memoized
+    def median(self):
+        return self.series.median()
+
+    @memoized
+    def demedianed(self):
+        return np.abs(self.series - self.median)
+
+    @memoized
+    def mad(self):
+        """The median absolute deviation."""
+        return self.demedianed.median()
+
+    @memoized
+    def tail_avg(self):
+        """The average of the last three values, or the last one of shorter series."""
+        if len(self.values) < 3:
+            return self.values[-1]
+        return (self.values[-1] + self.values[-2] + self.values[-3]) / 3
+
+    @memoized
+    def histogram(self):
+        return np.histogram(self.values, bins=15)
+
+    def ewma(self, com):
+        if com not in self.ewmas:
+            self.ewmas[com] = pandas.stats.moments.ewma(self.series, com=com)
+        return self.ewmas[com]
+
+    def ewmstd(self, com):
+        if com not in self.ewmstds:
+            self.ewmstds[com] = pandas.stats.moments.ewmstd(self.series, com=com)
+        return self.ewmstds[com]
+
+
+def features(timeseries):
+    """The Features of a timeseries, which may already be one."""
+    if isinstance(timeseries, Features):
+        return timeseries
+    return Features(timeseries)
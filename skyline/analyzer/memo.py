@@ -0,0 +1,75 @@
+import numpy as np
+import scipy.stats
+import statsmodels.api as sm
+import time
+
+"""
+Memoized results of the statistical tests of the algorithms that are
+expensive and barely change from one analysis to the next: the Grubbs
+critical value of every series length, and the Augmented Dickey-Fuller
+verdict of every metric's ks_test reference window, which is kept for
+--adf-ttl seconds.
+"""
+
+
+class Memo(object):
+    """
+    A dict of computed values that expire ttl seconds after they are
+    computed, or never without a ttl, counting its hits and misses. The
+    expired values are dropped whenever it grows to max_size.
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute, ttl=None):
+        now = time.time()
+        entry = self.values.get(key)
+        if entry is not None and (entry[0] is None or entry[0] > now):
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = compute()
+        if len(self.values) >= self.max_size:
+            self.expire(now)
+        self.values[key] = (None if ttl is None else now + ttl, value)
+        return value
+
+    def expire(self, now):
+        self.values = dict((key, entry) for key, entry in self.values.iteritems() if entry[0] is None or entry[0] > now)
+        if len(self.values) >= self.max_size:
+            self.values.clear()
+
+    def pop_stats(self):
+        """The hits and misses since the last call."""
+        stats = self.hits, self.misses
+        self.hits = self.misses = 0
+        return stats
+
+
+GRUBBS = Memo()
+ADF = Memo()
+
+
+def grubbs_score(n):
+    """The critical value of Grubbs' test for a series of n datapoints."""
+    def compute():
+        threshold = scipy.stats.t.isf(.05 / (2 * n), n - 2)
+        threshold_squared = threshold * threshold
+        return ((n - 1) / np.sqrt(n)) * np.sqrt(threshold_squared / (n - 2 + threshold_squared))
+    return GRUBBS.get(int(n), compute)
+
+
+def adf_stationary(metric, reference, ttl):
+    """
+    Whether the Augmented Dickey-Fuller test finds the reference values
+    stationary. The verdict is kept for ttl seconds per metric and size of
+    the reference window, and not at all without a metric or ttl.
+    """
+    def compute():
+        return sm.tsa.stattools.adfuller(reference, 10)[1] < 0.05
+    if metric is None or not ttl:
+        return compute()
+    return ADF.get((metric, reference.size), compute, ttl)
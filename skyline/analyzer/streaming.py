@@ -0,0 +1,148 @@
+import numpy as np
+
+"""
+Streaming versions of the algorithms whose statistics can be updated with
+only the datapoints appended since the last analysis. A StreamState holds
+those running statistics for a metric and is saved in redis between
+analyses, so a metric can be analyzed by any worker.
+
+Every streaming algorithm gives the same answer as its batch version in
+skyline.analyzer.algorithms over the datapoints the state has seen, which
+are all the datapoints of the metric: the state is rebuilt from scratch
+whenever Roomba trims or rewrites the data, or it changes format.
+"""
+
+STREAMING_ALGORITHMS = [
+    'mean_subtraction_cumulation',
+    'stddev_from_average',
+    'stddev_from_moving_average',
+]
+
+# The center of mass of stddev_from_moving_average's ewma and ewmstd
+COM = 50
+
+
+class StreamState(object):
+    """
+    The running statistics of a timeseries: its count, mean and sum of
+    squared deviations (Welford), the weights, mean and biased variance of
+    pandas' adjusted ewma with COM, the last timestamp and the last few
+    values. position holds what redis needs to know which data it has seen.
+    """
+    FIELDS = ["count", "mean", "m2", "ewm_weight", "ewm_weight2", "ewm_mean", "ewm_var", "last_timestamp"]
+    POSITION = ["offset", "format", "last_cleaned_at"]
+
+    def __init__(self, tail_size=100, position=None):
+        self.tail_size = max(tail_size, 3)
+        self.position = position or {}
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.ewm_weight = 0.0
+        self.ewm_weight2 = 0.0
+        self.ewm_mean = 0.0
+        self.ewm_var = 0.0
+        self.last_timestamp = 0.0
+        self.tail = np.empty(0)
+
+    @classmethod
+    def load(cls, fields, tail_size=100):
+        """Restore a state from the fields of its redis hash, which only hold its position for a new state."""
+        state = cls(tail_size, dict((field, fields[field]) for field in cls.POSITION if field in fields))
+        if fields.get("count"):
+            state.count = int(fields["count"])
+            for field in cls.FIELDS[1:]:
+                setattr(state, field, float(fields[field]))
+            state.tail = np.frombuffer(fields["tail"], dtype='<f8')[-state.tail_size:]
+        return state
+
+    def dump(self):
+        """The fields of the redis hash of the state."""
+        fields = dict((field, repr(float(getattr(self, field)))) for field in self.FIELDS)
+        fields["count"] = self.count
+        fields["tail"] = self.tail.astype('<f8').tostring()
+        fields.update(self.position)
+        return fields
+
+    def update(self, datapoints):
+        """Fold new datapoints into the statistics in O(len(datapoints))."""
+        datapoints = np.asarray(datapoints, dtype=float).reshape(-1, 2)
+        values = datapoints[:, 1]
+        count = len(values)
+        if not count:
+            return
+
+        # Chan's combination of the Welford statistics of the old and new values
+        mean = values.mean()
+        m2 = np.square(values - mean).sum()
+        total = self.count + count
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.mean += delta * count / total
+        self.count = total
+
+        # pandas' adjusted ewm gives the i-th of the k new values weight decay ** (k - 1 - i)
+        decay = 1 - 1.0 / (1 + COM)
+        weights = decay ** np.arange(count - 1, -1, -1, dtype=float)
+        old_weight = self.ewm_weight * decay ** count
+        weight = old_weight + weights.sum()
+        ewm_mean = (old_weight * self.ewm_mean + np.dot(weights, values)) / weight
+        self.ewm_var = (old_weight * (self.ewm_var + (self.ewm_mean - ewm_mean) ** 2) +
+                        np.dot(weights, np.square(values - ewm_mean))) / weight
+        self.ewm_mean = ewm_mean
+        self.ewm_weight = weight
+        self.ewm_weight2 = self.ewm_weight2 * decay ** (2 * count) + np.square(weights).sum()
+
+        self.last_timestamp = datapoints[-1, 0]
+        self.tail = np.concatenate((self.tail, values[-self.tail_size:]))[-self.tail_size:]
+
+    @property
+    def datapoint(self):
+        return [self.last_timestamp, self.tail[-1]]
+
+    @property
+    def std(self):
+        """The sample standard deviation, like pandas."""
+        if self.count < 2:
+            return float('nan')
+        return np.sqrt(self.m2 / (self.count - 1))
+
+    @property
+    def tail_avg(self):
+        if len(self.tail) < 3:
+            return self.tail[-1]
+        return (self.tail[-1] + self.tail[-2] + self.tail[-3]) / 3
+
+    @property
+    def ewmstd(self):
+        """The bias corrected ewm standard deviation, like pandas' ewmstd."""
+        numerator = self.ewm_weight * self.ewm_weight
+        denominator = numerator - self.ewm_weight2
+        if denominator <= 0:
+            return float('nan')
+        return np.sqrt(max(self.ewm_var, 0) * numerator / denominator)
+
+
+def stddev_from_average(state, args):
+    """See skyline.analyzer.algorithms.stddev_from_average."""
+    return abs(state.tail_avg - state.mean) > 3 * state.std
+
+
+def stddev_from_moving_average(state, args):
+    """See skyline.analyzer.algorithms.stddev_from_moving_average."""
+    return abs(state.tail[-1] - state.ewm_mean) > 3 * state.ewmstd
+
+
+def mean_subtraction_cumulation(state, args):
+    """
+    See skyline.analyzer.algorithms.mean_subtraction_cumulation. The mean
+    and deviation of every value but the last are found by removing the
+    last value from the Welford statistics.
+    """
+    count = state.count - 1
+    if count < 2:
+        return False
+    last = state.tail[-1]
+    mean = (state.mean * state.count - last) / count
+    m2 = state.m2 - (last - mean) * (last - state.mean)
+    return abs(last - mean) > 3 * np.sqrt(max(m2, 0) / (count - 1))
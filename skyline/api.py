@@ -1,11 +1,262 @@
-from redis import StrictRedis
+from redis import RedisError, StrictRedis, WatchError
 from twisted.internet import reactor
 from twisted.python import log
-import msgpack
+from skyline.codecs import CODECS, DEFAULT_FORMAT
+from skyline.hashing import ConsistentHashRing
+from skyline.txredis import AsyncRedis
+from msgpack import packb, unpackb
+from twisted.internet.defer import DeferredList, gatherResults, inlineCallbacks, returnValue
+from twisted.internet.threads import deferToThread
+import itertools
 import json
+import threading
 import time
 
 
+# Append datapoints in the storage format a metric is stored in, which may
+# have changed since the publisher cached it: a migration rewrites the data
+# and its format marker atomically, so the format is read inside the script.
+# Metrics without a marker are v1 if they have data, otherwise new metrics
+# get the format given. The datapoints are packed float64 (timestamp, value)
+# pairs: they are converted to msgpack arrays of two float64 for v1, added
+# as they are to v2 metrics and the tail of gorilla metrics, and written into
+# the preallocated slots of rings starting at their head, wrapping around at
+# capacity. Returns the format they were appended in.
+# KEYS: data, info  ARGV: format for new metrics, capacity for new rings, datapoints
+APPEND = """
+local width = 16
+local storage_format = redis.call('HGET', KEYS[2], 'format')
+if not storage_format then
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        storage_format = 'v1'
+    else
+        storage_format = ARGV[1]
+    end
+end
+local data = ARGV[3]
+local count = #data / width
+
+if storage_format == 'ring' then
+    local info = redis.call('HMGET', KEYS[2], 'capacity', 'head', 'length')
+    local capacity = tonumber(info[1] or ARGV[2])
+    local head = tonumber(info[2] or 0)
+    local length = tonumber(info[3] or 0)
+
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        redis.call('SETRANGE', KEYS[1], capacity * width - 1, '\\0')
+        head = 0
+        length = 0
+    end
+    if count > capacity then
+        data = string.sub(data, (count - capacity) * width + 1)
+        count = capacity
+    end
+
+    local first = math.min(count, capacity - head)
+    redis.call('SETRANGE', KEYS[1], head * width, string.sub(data, 1, first * width))
+    if count > first then
+        redis.call('SETRANGE', KEYS[1], 0, string.sub(data, first * width + 1))
+    end
+
+    head = (head + count) % capacity
+    length = math.min(length + count, capacity)
+    redis.call('HMSET', KEYS[2], 'format', 'ring', 'capacity', capacity, 'head', head, 'length', length)
+    return storage_format
+end
+
+if storage_format == 'v1' then
+    -- msgpack floats are big-endian
+    local packed = {}
+    for pos = 1, #data, width do
+        table.insert(packed, '\\146\\203' .. string.reverse(string.sub(data, pos, pos + 7)) ..
+                             '\\203' .. string.reverse(string.sub(data, pos + 8, pos + 15)))
+    end
+    data = table.concat(packed)
+elseif storage_format ~= 'v2' and storage_format ~= 'gorilla' then
+    return redis.error_reply('can not append to ' .. storage_format .. ' metrics')
+end
+
+redis.call('APPEND', KEYS[1], data)
+redis.call('HSETNX', KEYS[2], 'format', storage_format)
+redis.call('HINCRBY', KEYS[2], 'length', count)
+return storage_format
+"""
+
+# Drop the datapoints at the start of a key that are not newer than a
+# minimum timestamp, without sending the key to the client. v1 is walked
+# one msgpack (timestamp, value) array at a time, v2 16 bytes at a time.
+# Returns the number of datapoints removed, or -1 for other formats.
+# KEYS: data, info  ARGV: minimum timestamp, now
+TRIM = """
+local storage_format = redis.call('HGET', KEYS[2], 'format') or 'v1'
+if storage_format ~= 'v1' and storage_format ~= 'v2' then
+    return -1
+end
+
+local data = redis.call('GET', KEYS[1]) or ''
+local minimum = tonumber(ARGV[1])
+local size = #data
+local pos = 1
+local removed = 0
+
+-- Sizes and struct formats of the msgpack number types
+local NUMBERS = {
+    [0xca] = {5, '>f'}, [0xcb] = {9, '>d'},
+    [0xcc] = {2, '>B'}, [0xcd] = {3, '>H'}, [0xce] = {5, '>I4'}, [0xcf] = {9, '>I8'},
+    [0xd0] = {2, '>b'}, [0xd1] = {3, '>h'}, [0xd2] = {5, '>i4'}, [0xd3] = {9, '>i8'},
+}
+
+-- Returns the number at pos and its encoded size
+local function number(pos)
+    local b = string.byte(data, pos)
+    if b < 0x80 then
+        return b, 1
+    elseif b >= 0xe0 then
+        return b - 256, 1
+    end
+    local kind = NUMBERS[b]
+    if kind == nil then
+        error('unexpected msgpack type ' .. b .. ' at ' .. pos)
+    end
+    return struct.unpack(kind[2], data, pos + 1), kind[1]
+end
+
+if storage_format == 'v2' then
+    while pos + 15 <= size and struct.unpack('<d', data, pos) <= minimum do
+        pos = pos + 16
+        removed = removed + 1
+    end
+else
+    while pos <= size do
+        if string.byte(data, pos) ~= 0x92 then
+            error('unexpected msgpack datapoint at ' .. pos)
+        end
+        local timestamp, timestamp_size = number(pos + 1)
+        if timestamp > minimum then
+            break
+        end
+        local value, value_size = number(pos + 1 + timestamp_size)
+        pos = pos + 1 + timestamp_size + value_size
+        removed = removed + 1
+    end
+end
+
+if removed > 0 then
+    redis.call('SET', KEYS[1], string.sub(data, pos))
+    redis.call('HINCRBY', KEYS[2], 'length', -removed)
+end
+redis.call('HSET', KEYS[2], 'last_cleaned_at', ARGV[2])
+return removed
+"""
+
+# Fetch what the streaming analysis of a metric needs: its info, its saved
+# state and the data appended since the state was saved. The state is
+# dropped and all the data returned when the data was trimmed, rewritten
+# or converted since, and always for rings, which overwrite their data.
+# KEYS: data, info, stream_state
+STREAM_FETCH = """
+local info = redis.call('HGETALL', KEYS[2])
+local state = redis.call('HGETALL', KEYS[3])
+local fields = {}
+for i = 1, #info, 2 do
+    fields[info[i]] = info[i + 1]
+end
+local saved = {}
+for i = 1, #state, 2 do
+    saved[state[i]] = state[i + 1]
+end
+
+local storage_format = fields['format'] or 'v1'
+local offset = tonumber(saved['offset'] or 0)
+if storage_format == 'ring' or saved['format'] ~= storage_format or
+        saved['last_cleaned_at'] ~= (fields['last_cleaned_at'] or '') or
+        offset > redis.call('STRLEN', KEYS[1]) then
+    state = {}
+    offset = 0
+end
+return {info, state, offset, redis.call('GETRANGE', KEYS[1], offset, -1)}
+"""
+
+# Claim up to a number of metrics from the work queue, whose scores are the
+# time of the first update of each metric since it was last claimed. The
+# metrics in the anomalous set (the most recent 1000 of them) are claimed
+# as if they had been queued boost seconds earlier. With schedule, claimed
+# metrics whose next analysis is scheduled later are queued again for then
+# instead of being returned, keeping the time they were first queued in the
+# queued_at hash, and the next candidates are looked at until count metrics
+# are claimed or none are left. Returns the metrics claimed and the time
+# they were first queued.
+# KEYS: queue, anomalous, schedule, queued_at  ARGV: count, now, boost, schedule
+CLAIM = """
+local count = tonumber(ARGV[1])
+local now = tonumber(ARGV[2])
+local boost = tonumber(ARGV[3])
+local claimed = {}
+local needed = count
+
+while needed > 0 do
+    local candidates = {}
+    local seen = {}
+
+    local function consider(metric, score)
+        if seen[metric] then
+            return
+        end
+        seen[metric] = true
+        local priority = score
+        if boost > 0 and redis.call('ZSCORE', KEYS[2], metric) then
+            priority = score - boost
+        end
+        table.insert(candidates, {metric, score, priority})
+    end
+
+    local oldest = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'WITHSCORES', 'LIMIT', 0, needed)
+    for i = 1, #oldest, 2 do
+        consider(oldest[i], tonumber(oldest[i + 1]))
+    end
+    if boost > 0 then
+        for i, metric in ipairs(redis.call('ZREVRANGE', KEYS[2], 0, 999)) do
+            local score = tonumber(redis.call('ZSCORE', KEYS[1], metric))
+            if score and score <= now then
+                consider(metric, score)
+            end
+        end
+    end
+    if #candidates == 0 then
+        break
+    end
+    table.sort(candidates, function(a, b) return a[3] < b[3] end)
+
+    -- Deferred metrics are queued past now, so they aren't candidates again
+    for i = 1, math.min(needed, #candidates) do
+        local metric = candidates[i][1]
+        local due = ARGV[4] == '1' and tonumber(redis.call('ZSCORE', KEYS[3], metric))
+        if due and due > now then
+            redis.call('HSETNX', KEYS[4], metric, tostring(candidates[i][2]))
+            redis.call('ZADD', KEYS[1], due, metric)
+        else
+            redis.call('ZREM', KEYS[1], metric)
+            local queued_at = redis.call('HGET', KEYS[4], metric)
+            if queued_at then
+                redis.call('HDEL', KEYS[4], metric)
+            end
+            table.insert(claimed, metric)
+            table.insert(claimed, queued_at or tostring(candidates[i][2]))
+            needed = needed - 1
+        end
+    end
+end
+return claimed
+"""
+
+# Every key of a metric
+METRIC_KEYS = ["skyline:metric:{0}:last_anomaly_results",
+               "skyline:metric:{0}:data",
+               "skyline:metric:{0}:last_analyzed_results",
+               "skyline:metric:{0}:trigger_history",
+               "skyline:metric:{0}:stream_state",
+               "skyline:metric:{0}:info"]
+
 DEFAULT_SETTINGS = [
     ("skyline:config:alerts:rules", []),
     ("skyline:config:alerts:settings", {}),
@@ -15,22 +266,175 @@ DEFAULT_SETTINGS = [
 ]
 
 
+class ShardError(RedisError):
+    """Raised when the pipelines of some shards failed, the others were still executed."""
+    def __init__(self, shards, errors):
+        RedisError.__init__(self, "{0} redis shards failed: {1}".format(len(shards), "; ".join(str(e) for e in errors)))
+        self.shards = shards
+
+
+def execute_pipelines(pipes):
+    """
+    Execute a list of (shard, pipeline) at the same time, one thread per
+    pipeline, and return the list of their results.
+    """
+    if len(pipes) == 1:
+        return [pipes[0][1].execute()]
+
+    results = [None] * len(pipes)
+    errors = {}
+
+    def execute(i, pipe):
+        try:
+            results[i] = pipe.execute()
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=execute, args=(i, pipe)) for i, (shard, pipe) in enumerate(pipes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise ShardError(set(pipes[i][0] for i in errors), errors.values())
+    return results
+
+
+class ShardedPipeline(object):
+    """
+    A pipeline for every redis shard, created as commands are routed to
+    them with shard(metric). execute() runs the pipelines in parallel.
+    """
+    def __init__(self, api, transaction=True):
+        self.api = api
+        self.transaction = transaction
+        self.pipes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __len__(self):
+        return sum(len(pipe) for pipe in self.pipes.values())
+
+    def shard(self, metric):
+        index = self.api.shard_index(metric)
+        if index not in self.pipes:
+            self.pipes[index] = self.api.shards[index].pipeline(self.transaction)
+        return self.pipes[index]
+
+    def queued(self):
+        """The (shard, pipeline) of every shard with queued commands."""
+        return [(index, pipe) for index, pipe in sorted(self.pipes.items()) if len(pipe)]
+
+    def execute(self):
+        """
+        Execute the pipeline of every shard with queued commands. The results
+        are concatenated in shard order, so callers that need them should
+        queue commands sorted by api.shard_index.
+        """
+        pipes = self.queued()
+        if not pipes:
+            return []
+        return list(itertools.chain.from_iterable(execute_pipelines(pipes)))
+
+    def reset(self):
+        for pipe in self.pipes.values():
+            pipe.reset()
+
+
+class AsyncShardedPipeline(ShardedPipeline):
+    """A ShardedPipeline of AsyncPipelines, execute() returns a Deferred."""
+    def execute(self):
+        pipes = self.queued()
+        d = DeferredList([pipe.execute() for index, pipe in pipes], consumeErrors=True)
+        d.addCallback(self.gather, pipes)
+        return d
+
+    def gather(self, results, pipes):
+        failures = [(index, failure) for (index, pipe), (success, failure) in zip(pipes, results) if not success]
+        if len(pipes) == 1 and failures:
+            failures[0][1].raiseException()
+        if failures:
+            raise ShardError(set(index for index, failure in failures), [failure.value for index, failure in failures])
+        return list(itertools.chain.from_iterable(result for success, result in results))
+
+
 class SkylineRedisApi(object):
-    def __init__(self, redis_url, *args, **kwargs):
+    def __init__(self, redis_url, storage_format=DEFAULT_FORMAT, ring_capacity=8640, *args, **kwargs):
+        """
+        Initialize the Redis API. redis_url is a comma separated list of redis
+        instances, metrics are sharded across them by a consistent hash of
+        their name and the settings are kept on the first one.
+        """
+        if isinstance(redis_url, basestring):
+            redis_url = [url.strip() for url in redis_url.split(",") if url.strip()]
+        self.shards = []
+        self.shard_indexes = {}
+        for url in redis_url:
+            log.msg("connecting to redis: {0}".format(url))
+            shard = self.connect(url)
+            name = self.shard_name(shard)
+            if name in self.shard_indexes:
+                raise ValueError("redis instance listed twice: {0}".format(url))
+            self.shard_indexes[name] = len(self.shards)
+            self.shards.append(shard)
+        self.hash_ring = ConsistentHashRing(sorted(self.shard_indexes))
+        self.redis_conn = self.shards[0]  # Where the settings are stored
+        self.popped = 0  # The shard metrics were last claimed from
+        self.storage_format = storage_format
+        self.formats = {}  # The storage format of every metric published by this process
+        self.ring_capacity = ring_capacity
+        self.append = self.redis_conn.register_script(APPEND)
+        self.trim = self.redis_conn.register_script(TRIM)
+        self.stream_fetch = self.redis_conn.register_script(STREAM_FETCH)
+        self.claim = self.redis_conn.register_script(CLAIM)
+
+    def connect(self, url):
+        return StrictRedis.from_url(url)
+
+    @staticmethod
+    def shard_name(shard):
+        """Identify a shard by its address so the hash ring doesn't depend on the url or order of the shards."""
+        kwargs = shard.connection_pool.connection_kwargs
+        address = kwargs.get('path') or "{0}:{1}".format(kwargs.get('host'), kwargs.get('port'))
+        return "{0}/{1}".format(address, kwargs.get('db', 0))
+
+    def shard_index(self, metric):
+        if len(self.shards) == 1:
+            return 0
+        return self.shard_indexes[self.hash_ring.get_node(metric)]
+
+    def conn(self, metric):
+        """The redis shard a metric is stored on."""
+        return self.shards[self.shard_index(metric)]
+
+    def route(self, metric, pipe=None):
         """
-        Initialize the Redis API
+        Return where the commands for a metric go: its shard of a
+        ShardedPipeline, the pipeline it was given or its redis shard.
         """
-        log.msg("connecting to redis: {0}".format(redis_url))
-        self.redis_conn = StrictRedis.from_url(redis_url)
-        self.pipe = self.redis_conn.pipeline()
+        if pipe is None:
+            return self.conn(metric)
+        if isinstance(pipe, ShardedPipeline):
+            return pipe.shard(metric)
+        return pipe
 
-    def pipeline(self):
-        return self.redis_conn.pipeline()
+    def pipeline(self, metric=None, transaction=True):
+        """
+        Return a ShardedPipeline, or the pipeline of the shard of a metric.
+        Only the latter can WATCH keys.
+        """
+        if metric is not None:
+            return self.conn(metric).pipeline(transaction)
+        return ShardedPipeline(self, transaction)
 
     def waitfor_connection(self):
         while reactor.running:
             try:
-                if self.redis_conn.ping():
+                if all(shard.ping() for shard in self.shards):
                     return True
                 else:
                     log.err("RedisAnalyzer ping returned false?")
@@ -39,94 +443,396 @@ class SkylineRedisApi(object):
                 log.err("RedisAnalyzer can't ping redis: {0}".format(e))
                 time.sleep(10)
 
+    def is_connected(self):
+        """Check redis once, without waiting for it to come back."""
+        try:
+            return all(shard.ping() for shard in self.shards)
+        except Exception:
+            return False
+
     def purge(self, metric):
         """Purge every reference to the metric."""
-        keys = ["skyline:metric:{0}:last_anomaly_results",
-                "skyline:metric:{0}:data",
-                "skyline:metric:{0}:last_analyzed_results",
-                "skyline:metric:{0}:info"]
-        with self.redis_conn.pipeline() as pipe:
+        with self.pipeline(metric) as pipe:
             pipe.srem("skyline:metricset:all", metric)
             pipe.zrem("skyline:metricset:anomalous", metric)
-            pipe.delete(*[k.format(metric) for k in keys])
+            pipe.zrem("skyline:metricset:queue", metric)
+            pipe.zrem("skyline:metricset:schedule", metric)
+            pipe.hdel("skyline:metricset:queued_at", metric)
+            pipe.delete(*[k.format(metric) for k in METRIC_KEYS])
             pipe.execute()
+            self.formats.pop(metric, None)
             return True
 
-    def publish(self, metric, datapoints):
-        # Append the data
+    def resolve_formats(self, metrics):
+        """
+        Find the storage format of metrics about to be published. Metrics
+        without a format marker are v1 if they already have data, otherwise
+        they are new and get storage_format. When storage_format is not v1,
+        v1 metrics are migrated to it the first time they are seen.
+        """
+        metrics = sorted(set(metric for metric in metrics if metric not in self.formats), key=self.shard_index)
+        if not metrics:
+            return
+
+        with self.pipeline(transaction=False) as pipe:
+            for metric in metrics:
+                pipe.shard(metric).hget("skyline:metric:{0}:info".format(metric), "format")
+                pipe.shard(metric).exists("skyline:metric:{0}:data".format(metric))
+            try:
+                results = pipe.execute()
+            except ShardError as e:
+                # Nothing has been published yet, the whole batch failed
+                raise RedisError(str(e))
+
+        for metric, storage_format, exists in zip(metrics, results[0::2], results[1::2]):
+            if storage_format is None:
+                storage_format = DEFAULT_FORMAT if exists else self.storage_format
+            if storage_format != self.storage_format and self.storage_format != DEFAULT_FORMAT:
+                storage_format = self.migrate_metric(metric, self.storage_format)
+            self.formats[metric] = storage_format
+
+    def migrate_metric(self, metric, storage_format):
+        """Rewrite the data of a metric in another storage format."""
         data_key = "skyline:metric:{0}:data".format(metric)
-        self.pipe.append(data_key, ''.join(map(msgpack.packb, datapoints)))
+        info_key = "skyline:metric:{0}:info".format(metric)
+        with self.pipeline(metric) as pipe:
+            while True:
+                try:
+                    pipe.watch(data_key, info_key)
+                    current = pipe.hget(info_key, "format") or DEFAULT_FORMAT
+                    if current != storage_format:
+                        datapoints = self.get_metric_data(metric, pipe)
+                        pipe.multi()
+                        self.set_metric_data(metric, datapoints, pipe, storage_format)
+                        pipe.hset(info_key, "format", storage_format)
+                        if storage_format != 'ring':
+                            pipe.hdel(info_key, "capacity", "head")
+                        if storage_format != 'gorilla':
+                            pipe.hdel(info_key, "sealed")
+                        pipe.execute()
+                        log.msg("migrated {0} from {1} to {2}".format(metric, current, storage_format))
+                    return storage_format
+                except WatchError:
+                    continue
+
+    def publish(self, metric, datapoints, pipe=None):
+        """
+        Append datapoints to a metric. When a pipeline is given the commands
+        are only queued on it, and the caller is responsible for executing it.
+        """
+        execute = pipe is None
+        if pipe is None:
+            pipe = self.pipeline()
+        if metric not in self.formats:
+            self.resolve_formats([metric])
+        storage_format = self.formats[metric]
+        shard = self.route(metric, pipe)
 
-        # Update some metadata
+        data_key = "skyline:metric:{0}:data".format(metric)
         info_key = "skyline:metric:{0}:info".format(metric)
-        self.pipe.hincrby(info_key, "length", len(datapoints))
-        self.pipe.hset(info_key, "last_updated_at", time.time())
+        # Append the data and update the metadata, the script encodes it in
+        # the format the metric is actually stored in
+        self.append(keys=[data_key, info_key], args=[storage_format, self.ring_capacity, CODECS['v2'].encode(datapoints)], client=shard)
+        shard.hset(info_key, "last_updated_at", time.time())
+
+        # Every shard keeps the sets of the metrics stored on it
+        shard.execute_command("ZADD", "skyline:metricset:queue", "NX", time.time(), metric)  # The metrics waiting for analysis, by first update
+        shard.sadd("skyline:metricset:all", metric)  # Key where the set of all known metrics is stored
+        if execute:
+            return pipe.execute()
 
-        self.pipe.sadd("skyline:metricset:updated", metric)  # Key where the set of recently updated metrics is stored
-        self.pipe.sadd("skyline:metricset:all", metric)  # Key where the set of all known metrics is stored
-        self.pipe.execute()
+    def publish_many(self, batch, pipe=None):
+        """Append the datapoints of a list of (metric, datapoints)."""
+        self.resolve_formats(metric for metric, datapoints in batch)
+        for metric, datapoints in batch:
+            self.publish(metric, datapoints, pipe)
 
     def get_metric_info(self, metric, pipe=None):
-        if pipe is None:
-            pipe = self.redis_conn
+        pipe = self.route(metric, pipe)
         return pipe.hgetall("skyline:metric:{0}:info".format(metric))
 
     def set_metric_info(self, metric, field, value, pipe=None):
-        if pipe is None:
-            pipe = self.redis_conn
-        pipe.hset("skyline:metric:{0}:info".format(metric), field, value)
+        pipe = self.route(metric, pipe)
+        return pipe.hset("skyline:metric:{0}:info".format(metric), field, value)
+
+    def get_metric_format(self, metric, pipe=None):
+        pipe = self.route(metric, pipe)
+        return pipe.hget("skyline:metric:{0}:info".format(metric), "format") or DEFAULT_FORMAT
 
     def get_metric_data(self, metric, pipe=None):
+        """
+        Return the datapoints of a metric, as a list of (timestamp, value)
+        tuples for v1 metrics or an (N, 2) array for the other formats.
+        """
+        info_key = "skyline:metric:{0}:info".format(metric)
+        data_key = "skyline:metric:{0}:data".format(metric)
         if pipe is None:
-            pipe = self.redis_conn
-        data = pipe.get("skyline:metric:{0}:data".format(metric))
-        if data:
-            packer = msgpack.Unpacker(use_list=False)
-            packer.feed(data)
-            return list(packer)
-        return []
+            # In a transaction, so the format matches the data
+            with self.pipeline(metric) as pipe:
+                pipe.hmget(info_key, "format", "head", "length", "sealed")
+                pipe.get(data_key)
+                (storage_format, head, length, sealed), data = pipe.execute()
+        else:
+            pipe = self.route(metric, pipe)
+            storage_format, head, length, sealed = pipe.hmget(info_key, "format", "head", "length", "sealed")
+            data = pipe.get(data_key)
+        return self.decode_metric_data(data, storage_format, head, length, sealed)
 
-    def set_metric_data(self, metric, data, pipe=None):
-        if pipe is None:
-            pipe = self.redis_conn
+    def get_metrics_data(self, metrics):
+        """
+        Return the (datapoints, info) of every metric, fetching them all with
+        one transaction per shard.
+        """
+        metrics = list(metrics)
+        order = sorted(xrange(len(metrics)), key=lambda i: self.shard_index(metrics[i]))
+        with self.pipeline() as pipe:
+            for i in order:
+                pipe.shard(metrics[i]).hgetall("skyline:metric:{0}:info".format(metrics[i]))
+                pipe.shard(metrics[i]).get("skyline:metric:{0}:data".format(metrics[i]))
+            results = pipe.execute()
+        return self.decode_metrics_data(order, results)
+
+    def get_metrics_stream(self, metrics):
+        """
+        Return the (datapoints, info, state) of every metric for streaming
+        analysis, with one pipeline per shard: the datapoints appended since
+        its stream state was saved, its info and the fields of that state,
+        which are empty when the state has to be rebuilt from all the
+        datapoints returned. The position of the data in the state is
+        already moved past the datapoints returned.
+        """
+        metrics = list(metrics)
+        order = sorted(xrange(len(metrics)), key=lambda i: self.shard_index(metrics[i]))
+        with self.pipeline(transaction=False) as pipe:
+            for i in order:
+                self.stream_fetch(keys=["skyline:metric:{0}:data".format(metrics[i]),
+                                        "skyline:metric:{0}:info".format(metrics[i]),
+                                        "skyline:metric:{0}:stream_state".format(metrics[i])],
+                                  client=pipe.shard(metrics[i]))
+            results = pipe.execute()
+
+        fetched = [None] * len(metrics)
+        for i, (info, state, offset, data) in zip(order, results):
+            info = dict(zip(info[0::2], info[1::2]))
+            state = dict(zip(state[0::2], state[1::2]))
+            storage_format = info.get("format", DEFAULT_FORMAT)
+            state.update(offset=offset + len(data), format=storage_format, last_cleaned_at=info.get("last_cleaned_at", ""))
+            # Only a fetch from the start of a gorilla key includes its sealed chunks
+            sealed = max(int(info.get("sealed") or 0) - offset, 0)
+            datapoints = self.decode_metric_data(data, storage_format, info.get("head"), info.get("length"), sealed)
+            fetched[i] = (datapoints, info, state)
+        return fetched
+
+    def set_stream_state(self, metric, fields, pipe=None):
+        pipe = self.route(metric, pipe)
+        return pipe.hmset("skyline:metric:{0}:stream_state".format(metric), fields)
+
+    def decode_metrics_data(self, order, results):
+        fetched = [None] * len(order)
+        for i, info, data in zip(order, results[0::2], results[1::2]):
+            fetched[i] = (self.decode_metric_data(data, info.get("format"), info.get("head"), info.get("length"), info.get("sealed")), info)
+        return fetched
+
+    def decode_metric_data(self, data, storage_format, head=None, length=None, sealed=None):
+        if not data:
+            return []
+        if storage_format == 'ring':
+            return CODECS['ring'].decode(data, int(head or 0), int(length or 0))
+        if storage_format == 'gorilla':
+            return CODECS['gorilla'].decode(data, int(sealed or 0))
+        return CODECS[storage_format or DEFAULT_FORMAT].decode(data)
+
+    def set_metric_data(self, metric, data, pipe=None, storage_format=DEFAULT_FORMAT):
+        pipe = self.route(metric, pipe)
 
-        # Serialize and turn key back into not-an-array
-        length = len(data)
-        bdata = msgpack.packb(data)
         data_key = "skyline:metric:{0}:data".format(metric)
-        if length < 16:
-            pipe.set(data_key, bdata[1:])
-        elif length < 65536:
-            pipe.set(data_key, bdata[3:])
+        info_key = "skyline:metric:{0}:info".format(metric)
+        if storage_format == 'ring':
+            data = data[-self.ring_capacity:]
+            pipe.set(data_key, CODECS['ring'].encode(data, self.ring_capacity))
+            pipe.hmset(info_key, {"capacity": self.ring_capacity, "head": len(data) % self.ring_capacity})
+        elif storage_format == 'gorilla':
+            sealed, tail = CODECS['gorilla'].seal(data)
+            pipe.set(data_key, sealed + tail)
+            pipe.hset(info_key, "sealed", len(sealed))
         else:
-            pipe.set(data_key, bdata[5:])
-        pipe.hset(info_key, "length", length)  # Set the metadata
+            pipe.set(data_key, CODECS[storage_format].encode(data))
+        pipe.hset(info_key, "length", len(data))  # Set the metadata
+
+    def trim_metric(self, metric, minimum_timestamp, now=None):
+        """
+        Atomically drop the datapoints older than minimum_timestamp inside
+        redis. Returns the number of datapoints removed, or None if the
+        storage format of the metric can't be trimmed server side.
+        """
+        removed = self.trim_metrics([metric], minimum_timestamp, now)[0]
+        if isinstance(removed, Exception):
+            raise removed
+        return removed
+
+    def trim_metrics(self, metrics, minimum_timestamp, now=None):
+        """
+        trim_metric a list of metrics in one pipeline per shard. Returns the
+        result of each metric, which is the exception raised for the metrics
+        that couldn't be trimmed.
+        """
+        if now is None:
+            now = time.time()
+        shards = {}
+        for metric in metrics:
+            shards.setdefault(self.shard_index(metric), []).append(metric)
+
+        results = {}
+        for index, shard_metrics in shards.items():
+            with self.shards[index].pipeline(transaction=False) as pipe:
+                for metric in shard_metrics:
+                    self.trim(keys=["skyline:metric:{0}:data".format(metric), "skyline:metric:{0}:info".format(metric)],
+                              args=[repr(float(minimum_timestamp)), now], client=pipe)
+                for metric, removed in zip(shard_metrics, pipe.execute(raise_on_error=False)):
+                    results[metric] = None if not isinstance(removed, Exception) and removed < 0 else removed
+        return [results[metric] for metric in metrics]
 
     def get_last_analyzed_results(self, metric, pipe=None):
-        if pipe is None:
-            pipe = self.redis_conn
+        pipe = self.route(metric, pipe)
         return pipe.hgetall("skyline:metric:{0}:last_analyzed_results".format(metric))
 
     def get_last_anomaly_results(self, metric, pipe=None):
-        if pipe is None:
-            pipe = self.redis_conn
+        pipe = self.route(metric, pipe)
         return pipe.hgetall("skyline:metric:{0}:last_anomaly_results".format(metric))
 
-    def get_metricset_all(self):
-        metrics = self.redis_conn.smembers("skyline:metricset:all")
-        if metrics is None:
+    def set_analyzed_results(self, metric, anomalous, ensemble, datapoint, pipe=None):
+        """Record the results of analyzing a metric."""
+        execute = pipe is None
+        if pipe is None:
+            pipe = self.pipeline(metric)
+        shard = self.route(metric, pipe)
+
+        now = time.time()
+        info_key = "skyline:metric:{0}:info".format(metric)
+        # Replace the results rather than merge them, the algorithms run
+        # can change from one analysis to the next
+        results_keys = ["skyline:metric:{0}:last_analyzed_results".format(metric)]
+
+        # Update the anomalous results
+        if anomalous:
+            shard.zadd("skyline:metricset:anomalous", now, metric)
+            shard.hmset(info_key, {"last_anomaly_at": now,
+                                   "last_anomaly_timestamp": datapoint[0],
+                                   "last_anomaly_value": datapoint[1]})
+            results_keys.append("skyline:metric:{0}:last_anomaly_results".format(metric))
+
+        # Update the current results
+        shard.hmset(info_key, {"is_anomalous": anomalous,
+                               "last_analyzed_at": now,
+                               "last_analyzed_timestamp": datapoint[0],
+                               "last_analyzed_value": datapoint[1]})
+        for results_key in results_keys:
+            shard.delete(results_key)
+            shard.hmset(results_key, ensemble)
+        if execute:
+            return pipe.execute()
+
+    def schedule_analysis(self, metric, interval, pipe=None):
+        """Keep a metric from being analyzed again for interval seconds."""
+        pipe = self.route(metric, pipe)
+        pipe.zadd("skyline:metricset:schedule", time.time() + interval, metric)
+        return pipe.hset("skyline:metric:{0}:info".format(metric), "analysis_interval", interval)
+
+    def get_trigger_history(self, metric):
+        history = self.conn(metric).get("skyline:metric:{0}:trigger_history".format(metric))
+        if history is None:
             return []
+        return unpackb(history)
+
+    def set_trigger_history(self, metric, history):
+        return self.conn(metric).set("skyline:metric:{0}:trigger_history".format(metric), packb(history))
+
+    def get_metrics_info(self, metrics, *fields):
+        """
+        Return a dict of some info fields of every metric, with one
+        pipelined HMGET per shard. Fields that aren't set are left out.
+        """
+        metrics = list(metrics)
+        order = sorted(xrange(len(metrics)), key=lambda i: self.shard_index(metrics[i]))
+        with self.pipeline(transaction=False) as pipe:
+            for i in order:
+                pipe.shard(metrics[i]).hmget("skyline:metric:{0}:info".format(metrics[i]), *fields)
+            results = pipe.execute()
+
+        info = [None] * len(metrics)
+        for i, values in zip(order, results):
+            info[i] = dict((field, value) for field, value in zip(fields, values) if value is not None)
+        return info
+
+    def iter_metricset_all(self, count=1000):
+        """
+        Yield the known metrics in lists of about count metrics of a single
+        shard, walking the sets with SSCAN instead of fetching them at once.
+        Metrics added or removed meanwhile may be missed or repeated.
+        """
+        for shard in self.shards:
+            cursor = 0
+            chunk = []
+            while True:
+                cursor, metrics = shard.sscan("skyline:metricset:all", cursor, count=count)
+                chunk.extend(metrics)
+                if chunk and (len(chunk) >= count or cursor == 0):
+                    yield chunk
+                    chunk = []
+                if cursor == 0:
+                    break
+
+    def get_metricset_all(self):
+        metrics = set()
+        for chunk in self.iter_metricset_all():
+            metrics.update(chunk)
         return metrics
 
-    def pop_metricset_updated(self):
-        return self.redis_conn.spop("skyline:metricset:updated")
+    def claim_metrics(self, count, boost=0, schedule=False):
+        """
+        Claim up to count metrics from the work queue, taking turns between
+        the shards until enough are found, and return them with the time
+        they were queued. The oldest come first, with anomalous metrics
+        boost seconds ahead. With schedule, metrics scheduled to be analyzed
+        later by schedule_analysis are queued again for then.
+        """
+        claimed = []
+        for i in xrange(len(self.shards)):
+            self.popped = (self.popped + 1) % len(self.shards)
+            results = self.claim(keys=["skyline:metricset:queue", "skyline:metricset:anomalous", "skyline:metricset:schedule", "skyline:metricset:queued_at"],
+                                 args=[count - len(claimed), time.time(), boost, int(schedule)], client=self.shards[self.popped])
+            claimed.extend((metric, float(queued_at)) for metric, queued_at in zip(results[0::2], results[1::2]))
+            if len(claimed) >= count:
+                break
+        return claimed
+
+    def get_queue(self, count=10000):
+        """The time every metric waiting in the work queue was queued, fetched count at a time."""
+        queued = []
+        for shard in self.shards:
+            # Deferred metrics are queued for when they are due
+            first_queued_at = shard.hgetall("skyline:metricset:queued_at")
+            start = 0
+            while True:
+                scores = shard.zrange("skyline:metricset:queue", start, start + count - 1, withscores=True)
+                queued.extend(float(first_queued_at.get(metric, score)) for metric, score in scores)
+                if len(scores) < count:
+                    break
+                start += count
+        return queued
 
     def get_anomalies(self, withscores=True):
-        return self.redis_conn.zrangebyscore("skyline:metricset:anomalous", 0, int(time.time()), withscores=withscores)
+        anomalies = []
+        for shard in self.shards:
+            anomalies.extend(shard.zrangebyscore("skyline:metricset:anomalous", 0, int(time.time()), withscores=True))
+        anomalies.sort(key=lambda anomaly: anomaly[1])
+        if withscores:
+            return anomalies
+        return [metric for metric, score in anomalies]
 
     def clear_old_anomalies(self, max_age):
         """Remove every metric who's last anomaly was over full_duration old."""
-        return self.redis_conn.zremrangebyscore("skyline:metricset:anomalous", 0, time.time() - max_age)
+        return sum(shard.zremrangebyscore("skyline:metricset:anomalous", 0, time.time() - max_age) for shard in self.shards)
 
     def import_settings(self, settings):
         for key, default in DEFAULT_SETTINGS:
@@ -163,14 +869,195 @@ class SkylineRedisApi(object):
         return {}
 
     def check_alert(self, metric, strategy):
-        return self.redis_conn.exists('skyline:alert:{}:{}'.format(strategy, metric))
+        return self.conn(metric).exists('skyline:alert:{}:{}'.format(strategy, metric))
 
     def set_alert(self, metric, strategy, timeout):
-        self.redis_conn.setex('skyline:alert:{}:{}'.format(strategy, metric), timeout, time.time())
+        return self.conn(metric).setex('skyline:alert:{}:{}'.format(strategy, metric), timeout, time.time())
 
-    def flush_data(self):
+    def flush_data(self, count=1000):
         """DANGER ZONE: Remove all metric data from the system"""
-        for i in ['skyline:metric:*', 'skyline:metricset:*']:
-            data = self.redis_conn.keys('skyline:metric:*')
-            if data:
-                self.redis_conn.delete(*data)
+        for shard in self.shards:
+            for pattern in ['skyline:metric:*', 'skyline:metricset:*', 'skyline:alert:*']:
+                keys = []
+                for key in shard.scan_iter(pattern, count):
+                    keys.append(key)
+                    if len(keys) >= count:
+                        shard.delete(*keys)
+                        keys = []
+                if keys:
+                    shard.delete(*keys)
+
+
+def in_thread(name):
+    """A method calling the blocking api's in the reactor's thread pool."""
+    def method(self, *args, **kwargs):
+        return deferToThread(getattr(self.blocking, name), *args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+class AsyncSkylineRedisApi(SkylineRedisApi):
+    """
+    The SkylineRedisApi for code running in the reactor, every method returns
+    a Deferred instead of blocking. Commands go through AsyncRedis, which
+    keeps up to max_connections pipelined connections per shard. The calls
+    that need a connection of their own for WATCH, and the rarely used ones,
+    run the blocking api in the reactor's thread pool.
+    """
+    def __init__(self, redis_url, storage_format=DEFAULT_FORMAT, ring_capacity=8640, max_connections=4, *args, **kwargs):
+        self.max_connections = max_connections
+        SkylineRedisApi.__init__(self, redis_url, storage_format, ring_capacity)
+        self.blocking = SkylineRedisApi(redis_url, storage_format, ring_capacity)
+
+    def connect(self, url):
+        return AsyncRedis.from_url(url, max_connections=self.max_connections, scripts=[APPEND, TRIM, CLAIM])
+
+    def pipeline(self, metric=None, transaction=True):
+        if metric is not None:
+            return self.conn(metric).pipeline(transaction)
+        return AsyncShardedPipeline(self, transaction)
+
+    waitfor_connection = in_thread('waitfor_connection')
+    migrate_metric = in_thread('migrate_metric')
+    trim_metric = in_thread('trim_metric')
+    import_settings = in_thread('import_settings')
+    export_settings = in_thread('export_settings')
+    get_blacklist = in_thread('get_blacklist')
+    get_whitelist = in_thread('get_whitelist')
+    get_alerts_rules = in_thread('get_alerts_rules')
+    get_alerts_settings = in_thread('get_alerts_settings')
+    flush_data = in_thread('flush_data')
+
+    def is_connected(self):
+        d = DeferredList([shard.ping() for shard in self.shards], consumeErrors=True)
+        d.addCallback(lambda results: all(success and result for success, result in results))
+        return d
+
+    def purge(self, metric):
+        self.formats.pop(metric, None)
+        with self.pipeline(metric) as pipe:
+            pipe.srem("skyline:metricset:all", metric)
+            pipe.zrem("skyline:metricset:anomalous", metric)
+            pipe.zrem("skyline:metricset:queue", metric)
+            pipe.zrem("skyline:metricset:schedule", metric)
+            pipe.hdel("skyline:metricset:queued_at", metric)
+            pipe.delete(*[k.format(metric) for k in METRIC_KEYS])
+            return pipe.execute().addCallback(lambda results: True)
+
+    @inlineCallbacks
+    def resolve_formats(self, metrics):
+        metrics = sorted(set(metric for metric in metrics if metric not in self.formats), key=self.shard_index)
+        if not metrics:
+            return
+
+        with self.pipeline(transaction=False) as pipe:
+            for metric in metrics:
+                pipe.shard(metric).hget("skyline:metric:{0}:info".format(metric), "format")
+                pipe.shard(metric).exists("skyline:metric:{0}:data".format(metric))
+            try:
+                results = yield pipe.execute()
+            except ShardError as e:
+                raise RedisError(str(e))
+
+        for metric, storage_format, exists in zip(metrics, results[0::2], results[1::2]):
+            if storage_format is None:
+                storage_format = DEFAULT_FORMAT if exists else self.storage_format
+            if storage_format != self.storage_format and self.storage_format != DEFAULT_FORMAT:
+                storage_format = yield self.migrate_metric(metric, self.storage_format)
+            self.formats[metric] = storage_format
+
+    def publish(self, metric, datapoints, pipe=None):
+        return self.publish_many([(metric, datapoints)], pipe)
+
+    def publish_many(self, batch, pipe=None):
+        """
+        Append the datapoints of a list of (metric, datapoints). The Deferred
+        fires once they are queued on pipe, or written if no pipe is given.
+        """
+        d = self.resolve_formats(metric for metric, datapoints in batch)
+        d.addCallback(lambda result: self.queue(batch, pipe))
+        return d
+
+    def queue(self, batch, pipe=None):
+        execute = pipe is None
+        if pipe is None:
+            pipe = self.pipeline()
+        for metric, datapoints in batch:
+            SkylineRedisApi.publish(self, metric, datapoints, pipe)
+        if execute:
+            return pipe.execute()
+
+    def get_metric_format(self, metric, pipe=None):
+        d = self.route(metric, pipe).hget("skyline:metric:{0}:info".format(metric), "format")
+        return d.addCallback(lambda storage_format: storage_format or DEFAULT_FORMAT)
+
+    def get_metric_data(self, metric, pipe=None):
+        with self.pipeline(metric) as pipe:
+            pipe.hmget("skyline:metric:{0}:info".format(metric), "format", "head", "length", "sealed")
+            pipe.get("skyline:metric:{0}:data".format(metric))
+            d = pipe.execute()
+
+        def decode(results):
+            (storage_format, head, length, sealed), data = results
+            return self.decode_metric_data(data, storage_format, head, length, sealed)
+        return d.addCallback(decode)
+
+    def get_metrics_data(self, metrics):
+        metrics = list(metrics)
+        order = sorted(xrange(len(metrics)), key=lambda i: self.shard_index(metrics[i]))
+        with self.pipeline() as pipe:
+            for i in order:
+                pipe.shard(metrics[i]).hgetall("skyline:metric:{0}:info".format(metrics[i]))
+                pipe.shard(metrics[i]).get("skyline:metric:{0}:data".format(metrics[i]))
+            d = pipe.execute()
+        return d.addCallback(lambda results: self.decode_metrics_data(order, results))
+
+    def set_metric_data(self, metric, data, pipe=None, storage_format=DEFAULT_FORMAT):
+        execute = pipe is None
+        if pipe is None:
+            pipe = self.pipeline(metric)
+        SkylineRedisApi.set_metric_data(self, metric, data, pipe, storage_format)
+        if execute:
+            return pipe.execute()
+
+    def get_trigger_history(self, metric):
+        d = self.conn(metric).get("skyline:metric:{0}:trigger_history".format(metric))
+        return d.addCallback(lambda history: [] if history is None else unpackb(history))
+
+    @inlineCallbacks
+    def get_metricset_all(self):
+        metrics = set()
+        for shard in self.shards:
+            cursor = None
+            while cursor != 0:
+                cursor, chunk = yield shard.sscan("skyline:metricset:all", cursor or 0, count=1000)
+                metrics.update(chunk)
+        returnValue(metrics)
+
+    @inlineCallbacks
+    def claim_metrics(self, count, boost=0, schedule=False):
+        claimed = []
+        for i in xrange(len(self.shards)):
+            self.popped = (self.popped + 1) % len(self.shards)
+            results = yield self.claim(keys=["skyline:metricset:queue", "skyline:metricset:anomalous", "skyline:metricset:schedule", "skyline:metricset:queued_at"],
+                                       args=[count - len(claimed), time.time(), boost, int(schedule)], client=self.shards[self.popped])
+            claimed.extend((metric, float(queued_at)) for metric, queued_at in zip(results[0::2], results[1::2]))
+            if len(claimed) >= count:
+                break
+        returnValue(claimed)
+
+    def get_anomalies(self, withscores=True):
+        d = gatherResults([shard.zrangebyscore("skyline:metricset:anomalous", 0, int(time.time()), withscores=True)
+                           for shard in self.shards], consumeErrors=True)
+
+        def merge(results):
+            anomalies = sorted(itertools.chain.from_iterable(results), key=lambda anomaly: anomaly[1])
+            if withscores:
+                return anomalies
+            return [metric for metric, score in anomalies]
+        return d.addCallback(merge)
+
+    def clear_old_anomalies(self, max_age):
+        d = gatherResults([shard.zremrangebyscore("skyline:metricset:anomalous", 0, time.time() - max_age)
+                           for shard in self.shards], consumeErrors=True)
+        return d.addCallback(sum)
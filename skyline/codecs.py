@@ -0,0 +1,204 @@
+import msgpack
+import numpy as np
+import struct
+
+"""
+Storage formats for the datapoints of a metric. The format of each metric is
+recorded in the "format" field of its info hash, metrics without one are v1.
+Every codec encodes a sequence of (timestamp, value) pairs to a string that
+can be appended to the data key, and decodes the whole key back.
+"""
+
+
+class MsgpackCodec(object):
+    """v1: concatenated msgpack (timestamp, value) arrays."""
+    name = 'v1'
+
+    def encode(self, datapoints):
+        if isinstance(datapoints, np.ndarray):
+            datapoints = datapoints.tolist()
+        return ''.join(map(msgpack.packb, datapoints))
+
+    def decode(self, data):
+        unpacker = msgpack.Unpacker(use_list=False)
+        unpacker.feed(data)
+        return list(unpacker)
+
+
+class Float64Codec(object):
+    """
+    v2: packed little-endian float64 (timestamp, value) pairs, decoded without
+    copying into an (N, 2) array.
+    """
+    name = 'v2'
+    dtype = np.dtype('<f8')
+    width = 16
+
+    def encode(self, datapoints):
+        return np.asarray(datapoints, dtype=self.dtype).tostring()
+
+    def decode(self, data):
+        return np.frombuffer(data, dtype=self.dtype).reshape(-1, 2)
+
+
+class RingCodec(Float64Codec):
+    """
+    ring: a preallocated key of capacity float64 (timestamp, value) slots,
+    overwritten in place at the head index kept in the info hash. Decoding
+    rotates the slots back into chronological order.
+    """
+    name = 'ring'
+
+    def encode(self, datapoints, capacity=None):
+        data = Float64Codec.encode(self, datapoints)
+        if capacity:
+            data = data[-capacity * self.width:]
+            data += '\0' * (capacity * self.width - len(data))
+        return data
+
+    def decode(self, data, head=0, length=None):
+        datapoints = Float64Codec.decode(self, data)
+        if length is not None and length < len(datapoints):
+            # The ring has not wrapped yet, slots past the head are empty
+            return datapoints[:length]
+        if head:
+            return np.concatenate((datapoints[head:], datapoints[:head]))
+        return datapoints
+
+
+
+def pack_bits(values, width):
+    """Pack each uint64 of values into width bits, padded to a whole byte."""
+    if not width or not len(values):
+        return ''
+    shifts = np.arange(width - 1, -1, -1, dtype=np.uint64)
+    bits = ((values[:, np.newaxis] >> shifts) & np.uint64(1)).astype(np.uint8)
+    return np.packbits(bits.ravel()).tostring()
+
+
+def unpack_bits(data, offset, count, width):
+    """Unpack count width-bit integers from data into an uint64 array."""
+    if not width or not count:
+        return np.zeros(count, dtype=np.uint64)
+    size = (count * width + 7) / 8
+    padded = np.zeros(size + 9, dtype=np.uint8)
+    padded[:size] = np.frombuffer(data, dtype=np.uint8, count=size, offset=offset)
+
+    # Read the 8 bytes each entry starts in as a big-endian word, and shift
+    # the entry to the bottom of it
+    starts = np.arange(count, dtype=np.uint64) * np.uint64(width)
+    index = (starts >> np.uint64(3)).astype(np.intp)
+    shift = starts & np.uint64(7)
+    words = np.ndarray((size + 1,), dtype='>u8', buffer=padded, strides=(1,))[index].astype(np.uint64)
+    values = (words << shift) >> np.uint64(64 - width)
+    if width > 57:
+        # Entries spilling into a ninth byte
+        spill = (shift + np.uint64(width)) > np.uint64(64)
+        extra = padded[index + 8].astype(np.uint64) >> (np.uint64(72 - width) - shift)
+        values[spill] |= extra[spill]
+    return values
+
+
+class GorillaCodec(Float64Codec):
+    """
+    gorilla: Gorilla-style compression, delta-of-delta timestamps and XOR'ed
+    values, in sealed chunks followed by a v2 tail.
+
+    Publishes APPEND packed float64 pairs to the tail like v2. Roomba seals
+    every whole chunk_size datapoints of the tail into a compressed chunk
+    when it cleans the metric, and the "sealed" field of the info hash holds
+    the size of the sealed chunks at the start of the key.
+
+    Each chunk is a header followed by two bit-packed columns. Unlike Gorilla
+    every entry of a column uses the same number of bits, which costs a
+    little compression but lets a whole chunk decode with vectorized NumPy
+    operations:
+
+    * count, ts_width, value_width, value_shift, first timestamp and first
+      delta in milliseconds, and the bits of the first value
+    * count - 2 zigzag encoded delta-of-deltas, ts_width bits each
+    * count - 1 XORs with the previous value, shifted right by value_shift
+      trailing zeros, value_width bits each
+
+    Sealed timestamps are kept to the millisecond.
+    """
+    name = 'gorilla'
+    header = struct.Struct('<IBBBqqQ')
+    chunk_size = 1024
+
+    def seal(self, datapoints):
+        """
+        Split datapoints into the sealed chunks of every whole chunk_size
+        datapoints and the v2 tail of the rest.
+        """
+        datapoints = np.asarray(datapoints, dtype=self.dtype).reshape(-1, 2)
+        count = len(datapoints) - len(datapoints) % self.chunk_size
+        sealed = ''.join(self.encode_chunk(datapoints[i:i + self.chunk_size])
+                         for i in xrange(0, count, self.chunk_size))
+        return sealed, Float64Codec.encode(self, datapoints[count:])
+
+    def encode(self, datapoints):
+        return ''.join(self.seal(datapoints))
+
+    def encode_chunk(self, datapoints):
+        count = len(datapoints)
+        timestamps = np.round(datapoints[:, 0] * 1000).astype(np.int64)
+        deltas = np.diff(timestamps)
+        dods = np.diff(deltas)
+        zigzag = ((dods << 1) ^ (dods >> 63)).astype(np.uint64)
+        ts_width = int(zigzag.max()).bit_length() if len(zigzag) else 0
+
+        values = np.ascontiguousarray(datapoints[:, 1]).view(np.uint64)
+        xors = values[1:] ^ values[:-1]
+        bits = int(np.bitwise_or.reduce(xors)) if len(xors) else 0
+        value_shift = (bits & -bits).bit_length() - 1 if bits else 0
+        xors = xors >> np.uint64(value_shift)
+        value_width = int(xors.max()).bit_length() if len(xors) else 0
+
+        header = self.header.pack(count, ts_width, value_width, value_shift, timestamps[0],
+                                  deltas[0] if len(deltas) else 0, values[0])
+        return header + pack_bits(zigzag, ts_width) + pack_bits(xors, value_width)
+
+    def decode_chunk(self, data, offset):
+        """Decode the chunk at offset, returning its datapoints and where the next chunk starts."""
+        count, ts_width, value_width, value_shift, first_timestamp, first_delta, first_value = self.header.unpack_from(data, offset)
+        offset += self.header.size
+
+        zigzag = unpack_bits(data, offset, max(count - 2, 0), ts_width)
+        offset += (max(count - 2, 0) * ts_width + 7) / 8
+        dods = (zigzag >> np.uint64(1)).astype(np.int64) ^ -(zigzag & np.uint64(1)).astype(np.int64)
+        deltas = np.empty(max(count - 1, 0), dtype=np.int64)
+        if count > 1:
+            deltas[0] = first_delta
+            deltas[1:] = first_delta + np.cumsum(dods)
+        timestamps = np.empty(count, dtype=np.int64)
+        timestamps[0] = first_timestamp
+        timestamps[1:] = first_timestamp + np.cumsum(deltas)
+
+        xors = unpack_bits(data, offset, count - 1, value_width) << np.uint64(value_shift)
+        offset += ((count - 1) * value_width + 7) / 8
+        values = np.empty(count, dtype=np.uint64)
+        values[0] = first_value
+        values[1:] = np.uint64(first_value) ^ np.bitwise_xor.accumulate(xors)
+
+        return np.column_stack((timestamps / 1000.0, values.view(np.float64))), offset
+
+    def decode(self, data, sealed=0):
+        chunks = []
+        offset = 0
+        while offset < sealed:
+            chunk, offset = self.decode_chunk(data, offset)
+            chunks.append(chunk)
+        tail = np.frombuffer(data, dtype=self.dtype, offset=sealed).reshape(-1, 2)
+        if not chunks:
+            return tail
+        return np.concatenate(chunks + [tail])
+
+CODECS = {
+    'v1': MsgpackCodec(),
+    'v2': Float64Codec(),
+    'ring': RingCodec(),
+    'gorilla': GorillaCodec(),
+}
+
+DEFAULT_FORMAT = 'v1'
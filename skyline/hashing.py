@@ -0,0 +1,35 @@
+import bisect
+from hashlib import md5
+
+
+class ConsistentHashRing(object):
+    """
+    Map keys onto nodes with consistent hashing, like carbon's relays, so
+    adding a node only moves the keys that now belong to it. Every node is
+    placed on the ring replica_count times to even out the distribution.
+    """
+    def __init__(self, nodes=(), replica_count=100):
+        self.ring = []
+        self.nodes = []
+        self.replica_count = replica_count
+        for node in nodes:
+            self.add_node(node)
+
+    def compute_ring_position(self, key):
+        return int(md5(key).hexdigest()[:8], 16)
+
+    def add_node(self, node):
+        self.nodes.append(node)
+        positions = set(position for position, n in self.ring)
+        for i in xrange(self.replica_count):
+            position = self.compute_ring_position("{0}:{1}".format(node, i))
+            while position in positions:
+                position += 1
+            positions.add(position)
+            bisect.insort(self.ring, (position, node))
+
+    def get_node(self, key):
+        if not self.ring:
+            raise KeyError("the ring has no nodes")
+        index = bisect.bisect_left(self.ring, (self.compute_ring_position(key), None)) % len(self.ring)
+        return self.ring[index][1]
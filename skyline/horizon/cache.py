@@ -12,15 +12,46 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
+import numpy as np
 from threading import Lock
+from zlib import crc32
 from twisted.python import log
 
-
-class MetricCache(dict):
-    def __init__(self, max_size=None):
+from . import events
+
+
+def merge(datapoints):
+    """
+    Join a list of (timestamp, value) tuples and (N, 2) float64 arrays of
+    them into a single array, without copying a lone array.
+    """
+    chunks = []
+    pending = []
+    for item in datapoints:
+        if isinstance(item, np.ndarray):
+            if pending:
+                chunks.append(np.array(pending, dtype='<f8'))
+                pending = []
+            chunks.append(item)
+        else:
+            pending.append(item)
+    if pending:
+        chunks.append(np.array(pending, dtype='<f8'))
+    if len(chunks) == 1:
+        return chunks[0]
+    return np.concatenate(chunks)
+
+
+class MetricCacheShard(dict):
+    """
+    A single lock protected slice of the MetricCache. Besides tuples, a
+    metric can hold whole (N, 2) arrays of datapoints, which are merged into
+    one array when it is popped.
+    """
+    def __init__(self):
         self.size = 0
         self.lock = Lock()
-        self.max_size = max_size
+        self.packed = set()  # Metrics holding arrays of datapoints
 
     def __setitem__(self, key, value):
         raise TypeError("Use store() method instead!")
@@ -30,15 +61,31 @@ class MetricCache(dict):
             self.setdefault(metric, []).append(datapoint)
             self.size += 1
 
-        if self.isFull():
-            log.msg("MetricCache is full: self.size=%d" % self.size)
-
-    def isFull(self):
-        return self.max_size and self.size >= self.max_size
+    def store_batch(self, batch):
+        with self.lock:
+            for metric, datapoints in batch:
+                if isinstance(datapoints, np.ndarray):
+                    self.setdefault(metric, []).append(datapoints)
+                    self.packed.add(metric)
+                else:
+                    self.setdefault(metric, []).extend(datapoints)
+                self.size += len(datapoints)
+
+    def requeue(self, metric, datapoints):
+        with self.lock:
+            size = len(datapoints)
+            if isinstance(datapoints, np.ndarray):
+                datapoints = [datapoints]
+                self.packed.add(metric)
+            dict.__setitem__(self, metric, datapoints + self.get(metric, []))
+            self.size += size
 
     def pop(self, metric):
         with self.lock:
             datapoints = dict.pop(self, metric)
+            if metric in self.packed:
+                self.packed.discard(metric)
+                datapoints = merge(datapoints)
             self.size -= len(datapoints)
             return datapoints
 
@@ -60,5 +107,94 @@ class MetricCache(dict):
             yield (metric, datapoints)
 
 
+class MetricCache(object):
+    """
+    Datapoints waiting to be published, spread over independently locked
+    shards so receivers and the Publisher rarely contend for the same lock.
+    """
+    def __init__(self, shards=16, max_size=None, low_watermark=None):
+        self.configure(shards, max_size, low_watermark)
+
+    def configure(self, shards=16, max_size=None, low_watermark=None):
+        self.shards = [MetricCacheShard() for i in xrange(max(1, shards))]
+        self.max_size = max_size
+        if low_watermark is None and max_size:
+            low_watermark = int(max_size * 0.95)
+        self.low_watermark = low_watermark
+        self.tooFull = False
+
+    def index(self, metric):
+        return (crc32(metric) & 0xffffffff) % len(self.shards)
+
+    def shard(self, metric):
+        return self.shards[self.index(metric)]
+
+    @property
+    def size(self):
+        return sum(shard.size for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __nonzero__(self):
+        return any(self.shards)
+
+    def __contains__(self, metric):
+        return metric in self.shard(metric)
+
+    def store(self, metric, datapoint):
+        self.shard(metric).store(metric, datapoint)
+        self.checkFull()
+
+    def store_batch(self, batch):
+        """
+        Store a dict of metric -> datapoints, taking the lock of every shard
+        involved only once. Datapoints can be a list of tuples or an (N, 2)
+        float64 array, which is kept as it is.
+        """
+        shards = {}
+        for metric, datapoints in batch.iteritems():
+            shards.setdefault(self.index(metric), []).append((metric, datapoints))
+        for index, items in shards.iteritems():
+            self.shards[index].store_batch(items)
+        self.checkFull()
+
+    def isFull(self):
+        return self.max_size and self.size >= self.max_size
+
+    def checkFull(self):
+        """Tell the receivers to stop reading once the cache passes max_size."""
+        if not self.tooFull and self.isFull():
+            log.msg("MetricCache is full: self.size=%d" % self.size)
+            self.tooFull = True
+            events.cacheFull()
+
+    def checkSpaceAvailable(self):
+        """
+        Let the receivers resume once the cache has been drained below the low
+        watermark. Must be called from the reactor thread.
+        """
+        if self.tooFull and self.size <= self.low_watermark:
+            log.msg("MetricCache space available: self.size=%d" % self.size)
+            self.tooFull = False
+            events.cacheSpaceAvailable()
+
+    def requeue(self, metric, datapoints):
+        """Put datapoints that could not be published back in front of newer ones."""
+        self.shard(metric).requeue(metric, datapoints)
+
+    def pop(self, metric):
+        return self.shard(metric).pop(metric)
+
+    def counts(self):
+        return [count for shard in self.shards for count in shard.counts()]
+
+    def metrics(self):
+        """Drain the cache one shard at a time, largest queues first."""
+        for shard in self.shards:
+            for metric, datapoints in shard.metrics():
+                yield (metric, datapoints)
+
+
 # Ghetto singleton
 MetricCache = MetricCache()
@@ -0,0 +1,78 @@
+from operator import itemgetter
+
+AGGREGATIONS = ['last', 'avg', 'sum', 'max']
+
+
+class Coalescer(object):
+    """
+    Merge the datapoints of each metric into fixed time buckets of
+    resolution seconds, aggregated with last, avg, sum or max.
+
+    The newest bucket of a metric stays open across publishes until a
+    datapoint for a later bucket arrives, or until it ended more than a
+    resolution ago. Datapoints arriving for a bucket that has already been
+    closed would duplicate its timestamp, so they are dropped and counted.
+    """
+    def __init__(self, resolution, aggregation='avg'):
+        if aggregation not in AGGREGATIONS:
+            raise ValueError("unknown aggregation: {0}".format(aggregation))
+        self.resolution = resolution
+        self.aggregation = aggregation
+        self.open = {}  # metric -> [bucket, count, sum, max, last]
+        self.published = {}  # metric -> start of the last closed bucket
+        self.late = 0
+
+    def __nonzero__(self):
+        return bool(self.open)
+
+    def value(self, bucket):
+        start, count, total, maximum, last = bucket
+        if self.aggregation == 'avg':
+            return (start, total / count)
+        elif self.aggregation == 'sum':
+            return (start, total)
+        elif self.aggregation == 'max':
+            return (start, maximum)
+        return (start, last)
+
+    def coalesce(self, metric, datapoints):
+        """Return the buckets closed by datapoints, keeping the newest one open."""
+        closed = []
+        current = self.open.pop(metric, None)
+        published = self.published.get(metric)
+        for timestamp, value in sorted(datapoints, key=itemgetter(0)):
+            start = timestamp - timestamp % self.resolution
+            if published is not None and start <= published:
+                self.late += 1
+                continue
+            if current is not None and start != current[0]:
+                closed.append(self.value(current))
+                published = current[0]
+                current = None
+            if current is None:
+                current = [start, 0, 0.0, value, value]
+            current[1] += 1
+            current[2] += value
+            current[3] = max(current[3], value)
+            current[4] = value
+        if current is not None:
+            self.open[metric] = current
+        if published is not None:
+            self.published[metric] = published
+        return closed
+
+    def expire(self, now):
+        """Close every bucket that ended more than a resolution ago."""
+        expired = []
+        for metric, current in self.open.items():
+            if current[0] + 2 * self.resolution <= now:
+                del self.open[metric]
+                self.published[metric] = current[0]
+                expired.append((metric, [self.value(current)]))
+        return expired
+
+    def pop_late(self):
+        """The number of datapoints dropped since the last call."""
+        late = self.late
+        self.late = 0
+        return late
@@ -0,0 +1,28 @@
+from twisted.python import log
+
+
+class Event:
+    """A named hook that calls every registered handler in turn."""
+
+    def __init__(self, name):
+        self.name = name
+        self.handlers = []
+
+    def addHandler(self, handler):
+        if handler not in self.handlers:
+            self.handlers.append(handler)
+
+    def removeHandler(self, handler):
+        if handler in self.handlers:
+            self.handlers.remove(handler)
+
+    def __call__(self, *args, **kwargs):
+        for handler in list(self.handlers):
+            try:
+                handler(*args, **kwargs)
+            except:
+                log.err(None, "Exception in %s event handler" % self.name)
+
+
+cacheFull = Event('cacheFull')
+cacheSpaceAvailable = Event('cacheSpaceAvailable')
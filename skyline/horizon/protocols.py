@@ -1,9 +1,14 @@
+import msgpack
+import numpy as np
+import struct
+from itertools import chain
 from twisted.internet.error import ConnectionDone
 from twisted.internet.protocol import DatagramProtocol, ServerFactory
 from twisted.protocols.basic import LineOnlyReceiver, Int32StringReceiver
 from twisted.python import log
 from skyline.utils import SafeUnpickler
 
+from . import events
 from .cache import MetricCache
 from .regexlist import WhiteList, BlackList
 
@@ -13,19 +18,68 @@ def emit(metric, value):
     pass
 
 
+def pack_binary(batch):
+    """
+    Build a frame for the binary protocol from a dict of metric ->
+    [(timestamp, value), ...]. The frame is an int32 length followed by a
+    msgpack array of [metric, datapoints] pairs, where datapoints are packed
+    little-endian float64 (timestamp, value) pairs.
+    """
+    payload = msgpack.packb([(metric, struct.pack('<%dd' % (2 * len(datapoints)), *chain.from_iterable(datapoints)))
+                             for metric, datapoints in batch.iteritems()])
+    return struct.pack('!I', len(payload)) + payload
+
+
+def parse_lines(lines, source):
+    """
+    Parse graphite plaintext lines in a single pass, returning a dict of
+    metric -> [(timestamp, value), ...].
+    """
+    batch = {}
+    for line in lines:
+        try:
+            metric, value, timestamp = line.strip().split()
+            datapoint = (float(timestamp), float(value))
+        except:
+            log.msg('invalid line (%s) received from %s, ignoring' % (line.strip(), source))
+            continue
+        if metric in batch:
+            batch[metric].append(datapoint)
+        else:
+            batch[metric] = [datapoint]
+    return batch
+
+
 class MetricReceiver:
     """ Base class for all metric receiving protocols, handles flow
     control events and connection state logging.
     """
     def connectionMade(self):
         self.peerName = self.transport.getPeer()
+        self.paused = False
         log.msg("%s connection with %s established" % (self.__class__.__name__, self.peerName))
+        events.cacheFull.addHandler(self.pauseReceiving)
+        events.cacheSpaceAvailable.addHandler(self.resumeReceiving)
+        if MetricCache.tooFull:
+            self.pauseReceiving()
 
     def connectionLost(self, reason):
         if reason.check(ConnectionDone):
             log.msg("%s connection with %s closed cleanly" % (self.__class__.__name__, self.peerName))
         else:
             log.msg("%s connection with %s lost: %s" % (self.__class__.__name__, self.peerName, reason.value))
+        events.cacheFull.removeHandler(self.pauseReceiving)
+        events.cacheSpaceAvailable.removeHandler(self.resumeReceiving)
+
+    def pauseReceiving(self):
+        if not self.paused:
+            self.transport.pauseProducing()
+            self.paused = True
+
+    def resumeReceiving(self):
+        if self.paused:
+            self.transport.resumeProducing()
+            self.paused = False
 
     def metricReceived(self, metric, datapoint):
         if BlackList and metric in BlackList:
@@ -36,10 +90,35 @@ class MetricReceiver:
             return
         MetricCache.store(metric, datapoint)
 
+    def metricsReceived(self, batch):
+        """Filter a dict of metric -> datapoints and store it in one go."""
+        for metric in batch.keys():
+            if BlackList and metric in BlackList:
+                emit('skyline.horizon.blacklistMatches', metric)
+                del batch[metric]
+            elif WhiteList and metric not in WhiteList:
+                emit('skyline.horizon.whiteListRejects', metric)
+                del batch[metric]
+        if batch:
+            MetricCache.store_batch(batch)
+
 
 class MetricLineReceiver(MetricReceiver, LineOnlyReceiver):
     delimiter = '\n'
 
+    def dataReceived(self, data):
+        """Parse every complete line of the chunk as a single batch."""
+        lines = (self._buffer + data).split(self.delimiter)
+        self._buffer = lines.pop(-1)
+        if self.transport.disconnecting:
+            return
+        if lines:
+            if max(map(len, lines)) > self.MAX_LENGTH:
+                return self.lineLengthExceeded(max(lines, key=len))
+            self.metricsReceived(parse_lines(lines, 'client %s' % self.peerName))
+        if len(self._buffer) > self.MAX_LENGTH:
+            return self.lineLengthExceeded(self._buffer)
+
     def lineReceived(self, line):
         try:
             metric, value, timestamp = line.strip().split()
@@ -63,23 +142,76 @@ class MetricPickleReceiver(MetricReceiver, Int32StringReceiver):
             log.msg('invalid pickle received from %s, ignoring' % self.peerName)
             return
 
+        batch = {}
         for (metric, datapoint) in datapoints:
             try:
                 datapoint = (float(datapoint[0]), float(datapoint[1]))  # force proper types
             except:
                 continue
 
-            self.metricReceived(metric, datapoint)
+            batch.setdefault(metric, []).append(datapoint)
+
+        self.metricsReceived(batch)
+
+
+class MetricBinaryReceiver(MetricReceiver, Int32StringReceiver):
+    """
+    Receives frames built by pack_binary. The datapoints of each metric are
+    kept packed, as an (N, 2) float64 array over the frame, all the way to
+    the publisher instead of being unpacked into tuples.
+    """
+    MAX_LENGTH = 2 ** 24
+
+    def stringReceived(self, data):
+        try:
+            frame = msgpack.unpackb(data)
+            if not isinstance(frame, (list, tuple)):
+                raise ValueError("not a list of metrics")
+            frame = [(metric, datapoints) for metric, datapoints in frame]
+        except:
+            log.msg('invalid binary frame received from %s, ignoring' % self.peerName)
+            return
+
+        batch = {}
+        for metric, datapoints in frame:
+            # Every datapoint is a pair of little-endian doubles
+            if not isinstance(metric, str) or not isinstance(datapoints, str) or len(datapoints) % 16:
+                log.msg('invalid datapoints for %s received from %s, ignoring' % (metric, self.peerName))
+                continue
+
+            datapoints = np.frombuffer(datapoints, dtype='<f8').reshape(-1, 2)
+            if metric in batch:
+                datapoints = np.concatenate((batch[metric], datapoints))
+            batch[metric] = datapoints
+
+        self.metricsReceived(batch)
 
 
 class MetricDatagramReceiver(MetricReceiver, DatagramProtocol):
+    """
+    UDP has no flow control, so datagrams are counted and dropped while the
+    MetricCache is full.
+    """
+    dropped = 0
+
+    def startProtocol(self):
+        events.cacheSpaceAvailable.addHandler(self.droppingStopped)
+
+    def stopProtocol(self):
+        events.cacheSpaceAvailable.removeHandler(self.droppingStopped)
+
+    def droppingStopped(self):
+        if self.dropped:
+            log.msg("%s dropped %d datapoints while the MetricCache was full" % (self.__class__.__name__, self.dropped))
+            self.dropped = 0
+
     def datagramReceived(self, data, (host, port)):
-        for line in data.splitlines():
-            try:
-                metric, value, timestamp = line.strip().split()
-                self.metricReceived(metric, (float(timestamp), float(value)))
-            except:
-                log.msg('invalid line (%s) received from %s, ignoring' % (line, host))
+        if MetricCache.tooFull:
+            dropped = len(data.splitlines())
+            self.dropped += dropped
+            emit('skyline.horizon.udpDrops', dropped)
+            return
+        self.metricsReceived(parse_lines(data.splitlines(), host))
 
 
 class MetricLineFactory(ServerFactory):
@@ -88,3 +220,7 @@ class MetricLineFactory(ServerFactory):
 
 class MetricPickleFactory(ServerFactory):
     protocol = MetricPickleReceiver
+
+
+class MetricBinaryFactory(ServerFactory):
+    protocol = MetricBinaryReceiver
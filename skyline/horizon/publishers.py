@@ -1,37 +1,243 @@
+import numpy as np
+import os
 import time
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from twisted.python import log
 
 from .cache import MetricCache
+from .coalesce import Coalescer
 from .regexlist import BlackList, WhiteList
+from .spool import Spool
+
+
+def recent(datapoints, max_age):
+    """The datapoints not older than max_age, as a list of tuples or an array."""
+    if isinstance(datapoints, np.ndarray):
+        return datapoints[datapoints[:, 0] >= max_age]
+    return filter(lambda x: x[0] >= max_age, datapoints)
 
 
 class Publisher(object):
-    def __init__(self, api, arguments, *args, **kwargs):
+    def __init__(self, api, arguments, worker=None, *args, **kwargs):
         self.api = api
         self.args = arguments
+        self.batch_size = max(1, arguments.publish_batch_size)
+        self.batch_timeout = arguments.publish_batch_timeout
+        self.spool = None
+        self.spool_dir = arguments.spool_dir
+        if self.spool_dir and worker is not None:
+            # Every worker spools to its own subdirectory
+            self.spool_dir = os.path.join(self.spool_dir, str(worker))
+        if self.spool_dir:
+            self.spool = Spool(self.spool_dir, arguments.spool_segment_size)
+        self.replayed_at = time.time()
+        self.coalescer = None
+        if arguments.coalesce_resolution:
+            self.coalescer = Coalescer(arguments.coalesce_resolution, arguments.coalesce_aggregation)
+        self.retries = []  # Coalesced (metric, datapoints) to publish again
         BlackList.load(self.api.get_blacklist())
         WhiteList.load(self.api.get_whitelist())
 
+    def flush(self, pipe, batch):
+        """
+        Publish a batch of (metric, datapoints) in a single pipeline round
+        trip per redis shard. If the batch fails the datapoints of the shards
+        that failed are requeued.
+        """
+        if not batch:
+            return True
+        try:
+            self.api.publish_many(batch, pipe)
+            pipe.execute()
+            if MetricCache.tooFull:
+                reactor.callFromThread(MetricCache.checkSpaceAvailable)
+            return True
+        except Exception as e:
+            log.err("can't publish {0} metrics to datastore: {1}".format(len(batch), e))
+            failed = getattr(e, 'shards', None)
+            for metric, datapoints in batch:
+                if failed is None or self.api.shard_index(metric) in failed:
+                    self.requeue(metric, datapoints)
+            return False
+        finally:
+            pipe.reset()
+            del batch[:]
+
+    def requeue(self, metric, datapoints):
+        """
+        Put datapoints that couldn't be published back to publish again.
+        Coalesced buckets were already closed, so the coalescer would drop
+        them as late; they are kept aside and published as they are.
+        """
+        if self.coalescer is None:
+            MetricCache.requeue(metric, datapoints)
+        else:
+            self.retries.append((metric, datapoints))
+
+    def drain(self, max_age):
+        """
+        Yield every metric and datapoints ready to be published, coalescing
+        them first if enabled.
+        """
+        retries, self.retries = self.retries, []
+        for metric, datapoints in retries:
+            datapoints = recent(datapoints, max_age)
+            if len(datapoints):
+                yield (metric, datapoints)
+
+        for metric, datapoints in MetricCache.metrics():
+            datapoints = recent(datapoints, max_age)
+            if self.coalescer is not None:
+                datapoints = self.coalescer.coalesce(metric, datapoints)
+                if not datapoints:
+                    continue
+            yield (metric, datapoints)
+
+        if self.coalescer is not None:
+            for metric, datapoints in self.coalescer.expire(time.time()):
+                yield (metric, datapoints)
+            late = self.coalescer.pop_late()
+            if late:
+                log.msg("dropped {0} datapoints for coalesced buckets already published".format(late))
+
+    def spill(self, max_age):
+        """Move everything in the MetricCache to the spool."""
+        spilled = 0
+        for metric, datapoints in self.drain(max_age):
+            if len(datapoints):
+                self.spool.write(metric, datapoints)
+                spilled += len(datapoints)
+        self.spool.flush()
+        if spilled and MetricCache.tooFull:
+            reactor.callFromThread(MetricCache.checkSpaceAvailable)
+        return spilled
+
+    def replay(self):
+        """
+        Publish the oldest spooled datapoints, at most --spool-replay-rate
+        datapoints per second. Returns whether anything was written.
+        """
+        now = time.time()
+        limit = int(min(now - self.replayed_at, 1.0) * self.args.spool_replay_rate)
+        if limit <= 0:
+            return False
+        self.replayed_at = now
+
+        records = self.spool.read(limit)
+        if records:
+            try:
+                with self.api.pipeline() as pipe:
+                    self.api.publish_many(records, pipe)
+                    pipe.execute()
+            except Exception as e:
+                log.err("can't replay {0} spooled metrics to datastore: {1}".format(len(records), e))
+                return False
+        self.spool.commit()
+        return bool(records)
+
     def run(self):
         "Write datapoints until the MetricCache is completely empty"
 
-        max_age = time.time() - self.args.max_resolution
-
-        while MetricCache:
+        while MetricCache or self.spool or self.coalescer or self.retries:
             dataWritten = False
+            max_age = time.time() - self.args.max_resolution
 
-            self.api.waitfor_connection()
+            if self.spool is None:
+                self.api.waitfor_connection()
+            elif not self.api.is_connected():
+                if self.spill(max_age):
+                    log.msg("can't connect to redis, spooling datapoints to {0}".format(self.spool_dir))
+                time.sleep(1)
+                return
+            elif self.spool or (self.args.spool_threshold and MetricCache.size > self.args.spool_threshold):
+                # Once anything is spooled, every datapoint goes through the
+                # spool until it is empty so the series stay in order
+                self.spill(max_age)
+                if not self.replay():
+                    time.sleep(0.1)
+                continue
 
-            for metric, datapoints in MetricCache.metrics():
-                dataWritten = True
+            batch = []
+            with self.api.pipeline() as pipe:
+                for metric, datapoints in self.drain(max_age):
+                    dataWritten = True
 
-                try:
-                    self.api.publish(metric, filter(lambda x: x[0] >= max_age, datapoints))
-                except Exception as e:
-                    log.err("can't publish {0} to datastore: {1}".format(metric, e))
-                    # TODO add metrics back to MetricCache
-                    break
+                    if not batch:
+                        deadline = time.time() + self.batch_timeout
+                    batch.append((metric, datapoints))
+
+                    if len(batch) >= self.batch_size or time.time() >= deadline:
+                        if not self.flush(pipe, batch):
+                            break
+                else:
+                    self.flush(pipe, batch)
 
             # Avoid churning CPU when only new metrics are in the cache
             if not dataWritten:
                 time.sleep(0.1)
+
+
+class AsyncPublisher(Publisher):
+    """
+    Publish from the reactor with an AsyncSkylineRedisApi, keeping up to
+    --publish-concurrency batches in flight instead of waiting for each
+    round trip. Spooling isn't supported.
+    """
+    def __init__(self, api, arguments, *args, **kwargs):
+        Publisher.__init__(self, api.blocking, arguments)
+        self.api = api
+        self.concurrency = arguments.publish_concurrency
+        self.in_flight = 0
+        self.pending = None
+        self.retry_at = 0
+        self.task = LoopingCall(self.publish)
+
+    def start(self):
+        self.task.start(self.batch_timeout)
+
+    def batches(self):
+        """Drain the MetricCache into batches of at most --publish-batch-size metrics."""
+        batch = []
+        for metric, datapoints in self.drain(time.time() - self.args.max_resolution):
+            batch.append((metric, datapoints))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def publish(self):
+        """Send batches until enough are in flight or the MetricCache is drained."""
+        if time.time() < self.retry_at:
+            return
+        while self.in_flight < self.concurrency:
+            if self.pending is None:
+                if not MetricCache and not self.coalescer and not self.retries:
+                    return
+                self.pending = self.batches()
+            batch = next(self.pending, None)
+            if batch is None:
+                self.pending = None
+                return
+
+            self.in_flight += 1
+            d = self.api.publish_many(batch)
+            d.addCallbacks(self.published, self.failed, errbackArgs=(batch,))
+            d.addBoth(self.done)
+
+    def published(self, results):
+        if MetricCache.tooFull:
+            MetricCache.checkSpaceAvailable()
+
+    def failed(self, failure, batch):
+        log.err("can't publish {0} metrics to datastore: {1}".format(len(batch), failure.getErrorMessage()))
+        shards = getattr(failure.value, 'shards', None)
+        for metric, datapoints in batch:
+            if shards is None or self.api.shard_index(metric) in shards:
+                self.requeue(metric, datapoints)
+        self.retry_at = time.time() + 1
+
+    def done(self, result):
+        self.in_flight -= 1
+        self.publish()
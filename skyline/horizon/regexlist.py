@@ -4,17 +4,28 @@ import re
 class RegexList:
     """ Maintain a list of regex for matching"""
 
-    def __init__(self):
+    def __init__(self, max_cache_size=100000):
         self.regex_list = []
+        self.max_cache_size = max_cache_size
+        self.cache = {}
 
     def load(self, regex_list):
+        # The patterns are matched one at a time: joined into a single
+        # alternation, inline flags, backreferences and named groups of one
+        # pattern would change the meaning of the others
         self.regex_list = map(lambda r: re.compile(r), regex_list)
+        # Forget any decisions made with the previous list
+        self.cache = {}
 
     def __contains__(self, value):
-        for regex in self.regex_list:
-            if regex.search(value):
-                return True
-        return False
+        matched = self.cache.get(value)
+        if matched is None:
+            matched = any(regex.search(value) for regex in self.regex_list)
+            if len(self.cache) >= self.max_cache_size:
+                # Start over rather than track which decisions are in use
+                self.cache.clear()
+            self.cache[value] = matched
+        return matched
 
     def __nonzero__(self):
         return bool(self.regex_list)
@@ -0,0 +1,151 @@
+import fcntl
+import mmap
+import msgpack
+import numpy as np
+import os
+import struct
+from twisted.python import log
+
+RECORD_HEADER = struct.Struct('<I')
+
+
+class Spool(object):
+    """
+    An append-only spool of datapoints on disk, used by the Publisher to keep
+    memory flat while redis is unreachable or too slow.
+
+    The spool is a directory of numbered segment files. Each record is a
+    little-endian uint32 length followed by a msgpack (metric, datapoints)
+    pair. Segments are replayed oldest first through mmap and deleted once
+    they have been consumed. The replay position is saved in an offset file
+    so a restart carries on where it stopped. A spool directory can only be
+    used by one process at a time.
+    """
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = open(os.path.join(directory, 'lock'), 'a')
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.lock.close()
+            raise IOError("spool directory {0} is used by another process".format(directory))
+
+        self.segments = sorted(int(name.split('.')[0]) for name in os.listdir(directory) if name.endswith('.spool'))
+        self.writer = None
+        self.offset = 0
+        self.pending = None
+        self.load_offset()
+        if self.segments:
+            log.msg("found {0} spool segments in {1}".format(len(self.segments), directory))
+
+    def __nonzero__(self):
+        return bool(self.segments)
+
+    def close(self):
+        """Close the newest segment and let another process use the directory."""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.lock.close()
+
+    def path(self, segment):
+        return os.path.join(self.directory, '{0:012d}.spool'.format(segment))
+
+    def load_offset(self):
+        try:
+            with open(os.path.join(self.directory, 'offset')) as f:
+                segment, offset = map(int, f.read().split())
+        except (IOError, ValueError):
+            return
+        if self.segments and self.segments[0] == segment:
+            self.offset = offset
+
+    def save_offset(self):
+        path = os.path.join(self.directory, 'offset')
+        with open(path + '.tmp', 'w') as f:
+            f.write('{0} {1}'.format(self.segments[0] if self.segments else 0, self.offset))
+        os.rename(path + '.tmp', path)
+
+    def write(self, metric, datapoints):
+        """Append datapoints for a metric to the newest segment."""
+        if self.writer is None or self.writer.tell() >= self.segment_size:
+            self.rotate()
+        if isinstance(datapoints, np.ndarray):
+            datapoints = datapoints.tolist()
+        payload = msgpack.packb((metric, datapoints))
+        self.writer.write(RECORD_HEADER.pack(len(payload)))
+        self.writer.write(payload)
+
+    def rotate(self):
+        if self.writer is not None:
+            self.writer.close()
+        segment = self.segments[-1] + 1 if self.segments else 0
+        self.writer = open(self.path(segment), 'ab')
+        self.segments.append(segment)
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def read(self, limit):
+        """
+        Return records from the oldest segment until limit datapoints have
+        been read, without consuming them. Call commit() once they have been
+        published.
+        """
+        if not self.segments:
+            return []
+        segment = self.segments[0]
+        writing = self.writer is not None and self.writer.name == self.path(segment)
+        if writing:
+            self.writer.flush()
+
+        records = []
+        count = 0
+        offset = self.offset
+        with open(self.path(segment), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size > offset:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    while offset + RECORD_HEADER.size <= size and count < limit:
+                        length, = RECORD_HEADER.unpack_from(data, offset)
+                        end = offset + RECORD_HEADER.size + length
+                        if end > size:
+                            log.msg("truncated record in spool segment {0} at {1}, skipping the rest".format(segment, offset))
+                            offset = size
+                            break
+                        metric, datapoints = msgpack.unpackb(data[offset + RECORD_HEADER.size:end], use_list=False)
+                        records.append((metric, datapoints))
+                        count += len(datapoints)
+                        offset = end
+                finally:
+                    data.close()
+
+        self.pending = (segment, offset, offset >= size and not writing)
+        return records
+
+    def commit(self):
+        """Consume the records returned by the last read()."""
+        if self.pending is None:
+            return
+        segment, offset, finished = self.pending
+        self.pending = None
+        if not self.segments or self.segments[0] != segment:
+            return
+
+        self.offset = offset
+        if not finished and self.writer is not None and self.writer.name == self.path(segment) and self.writer.tell() <= offset:
+            # Everything written has been replayed, start over with a fresh segment
+            self.writer.close()
+            self.writer = None
+            finished = True
+
+        if finished:
+            os.unlink(self.path(segment))
+            self.segments.pop(0)
+            self.offset = 0
+        self.save_offset()
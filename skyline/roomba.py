@@ -1,7 +1,6 @@
-import os
+import numpy as np
 import time
-import time
-from redis import WatchError
+from redis import ResponseError, WatchError
 from twisted.python import log
 from twisted.internet import reactor
 
@@ -13,14 +12,16 @@ class Roomba(object):
         self.full_duration = args.full_duration
         self.clean_timeout = args.clean_timeout
         self.sleep_timeout = args.sleep_timeout
+        self.scan_count = args.scan_count
         self.sleep_period = 5
 
     def run(self):
         """Trim metrics that are older than full_duration and purge old metrics."""
         self.api.clear_old_anomalies(self.full_duration)
-        for metric in self.api.get_metricset_all():
-            if reactor.running:
-                self.clean(metric)
+        for metrics in self.api.iter_metricset_all(self.scan_count):
+            if not reactor.running:
+                return
+            self.clean(metrics)
         if reactor.running:
             if self.sleep_timeout < self.sleep_period:
                 time.sleep(self.sleep_timeout)
@@ -30,45 +31,85 @@ class Roomba(object):
                     if not reactor.running:
                         return
 
-    def clean(self, metric):
+    def clean(self, metrics):
+        """Clean a chunk of metrics, fetching their info and trimming them a pipeline at a time."""
         now = time.time()
-        info = self.api.get_metric_info(metric)
-        last_updated_at = float(info.get("last_updated_at", 0))
-        last_cleaned_at = float(info.get("last_cleaned_at", 0))
-
         minimum_timestamp = now - self.full_duration
+        infos = self.api.get_metrics_info(metrics, "last_updated_at", "last_cleaned_at", "format")
+
+        rings = []
+        trim = []
+        for metric, info in zip(metrics, infos):
+            last_updated_at = float(info.get("last_updated_at", 0))
+            last_cleaned_at = float(info.get("last_cleaned_at", 0))
+
+            log.msg("cleaning: {} {} {}".format(metric, last_cleaned_at, now - self.clean_timeout))
+
+            # Check if we can purge the whole metric
+            if last_updated_at < minimum_timestamp:
+                log.msg("purging old metric: {}".format(metric))
+                self.api.purge(metric)
 
-        log.msg("cleaning: {} {} {}".format(metric, last_cleaned_at, now - self.clean_timeout))
+            # Check if we can skip the metric
+            elif int(last_cleaned_at) != 0 and last_cleaned_at > (now - self.clean_timeout):
+                continue
 
-        # Check if we can purge the whole metric
-        if last_updated_at < minimum_timestamp:
-            log.msg("purging old metric: {}".format(metric))
-            return self.api.purge(metric)
+            # Ring buffers never grow, so there is nothing to trim
+            elif info.get("format") == "ring":
+                rings.append(metric)
 
-        # Check if we can skip the metric
-        if int(last_cleaned_at) != 0 and last_cleaned_at > (now - self.clean_timeout):
-            return
+            else:
+                trim.append(metric)
+
+        if rings:
+            with self.api.pipeline(transaction=False) as pipe:
+                for metric in rings:
+                    self.api.set_metric_info(metric, "last_cleaned_at", now, pipe)
+                pipe.execute()
 
-        with self.api.pipeline() as pipe:
+        for metric, removed in zip(trim, self.api.trim_metrics(trim, minimum_timestamp, now)):
+            if isinstance(removed, ResponseError):
+                # If something bad happens, zap the key and hope it goes away
+                log.msg(removed)
+                log.msg("purging bad metric: {}".format(metric))
+                self.api.purge(metric)
+            elif isinstance(removed, Exception):
+                raise removed
+            elif removed is None:
+                self.rewrite(metric, minimum_timestamp, now)
+            else:
+                log.msg('trimmed {} datapoints from {}'.format(removed, metric))
+        log.msg('cleaned {} metrics in {} seconds'.format(len(metrics), time.time() - now))
+
+    def rewrite(self, metric, minimum_timestamp, now):
+        """
+        Trim a metric client side, for storage formats redis can't trim
+        itself. This is also where gorilla metrics have their tail sealed.
+        """
+        with self.api.pipeline(metric) as pipe:
             while True:
                 try:
-                    # WATCH the key
-                    pipe.watch("skyline:metric:{0}:data".format(metric))
+                    # WATCH the keys
+                    pipe.watch("skyline:metric:{0}:data".format(metric), "skyline:metric:{0}:info".format(metric))
 
                     # Everything below NEEDS to happen before another datapoint
                     # comes in. If your data has a very small resolution (<.1s),
                     # this technique may not suit you.
+                    storage_format = self.api.get_metric_format(metric, pipe)
                     datapoints = self.api.get_metric_data(metric, pipe)
 
                     # Put pipe back in multi mode
                     pipe.multi()
 
                     # Remove old datapoints
-                    trimmed = [p for p in datapoints if p[0] > minimum_timestamp]
-                    self.api.set_metric_data(metric, trimmed, pipe)
+                    if isinstance(datapoints, np.ndarray):
+                        trimmed = datapoints[datapoints[:, 0] > minimum_timestamp]
+                    else:
+                        trimmed = [p for p in datapoints if p[0] > minimum_timestamp]
+                    self.api.set_metric_data(metric, trimmed, pipe, storage_format)
 
                     # Finalize processing
-                    self.api.set_metric_info(metric, "last_cleaned_at", now)
+                    self.api.set_metric_info(metric, "last_cleaned_at", now, pipe)
                     pipe.execute()
 
                     log.msg('operated on {} in {} seconds'.format(metric, time.time() - now))
@@ -77,11 +118,11 @@ class Roomba(object):
                 except WatchError:
                     log.msg("blocked: {}".format(metric))
                     continue
-                    self.blocked += 1
                 except Exception as e:
                     # If something bad happens, zap the key and hope it goes away
                     log.msg(e)
                     log.msg("purging bad metric: {}".format(metric))
                     self.api.purge(metric)
+                    return
                 finally:
                     pipe.reset()
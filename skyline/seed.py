@@ -7,12 +7,27 @@ import time
 def verify_metric_exists(api, metric):
     if metric not in api.get_metricset_all():
         raise Exception("Missing metric in set: {0}".format(metric))
-    if not api.get_metric_data(metric):
+    if not len(api.get_metric_data(metric)):
         raise Exception("Missing metric data: {0}".format(metric))
     if not api.get_metric_info(metric):
         raise Exception("Missing metric info: {0}".format(metric))
 
 
+def wait_for_metric(api, metric, timeout=10):
+    """
+    Horizon only publishes what it received at its next flush, so check the
+    metric again until it shows up or timeout seconds have passed.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return verify_metric_exists(api, metric)
+        except Exception:
+            if time.time() >= deadline:
+                raise
+        time.sleep(0.5)
+
+
 def seed_line(host, port, metric, timeseries, initial):
     sock = socket.socket()
     sock.connect((host, port))
@@ -33,7 +48,21 @@ def seed_udp(host, port, metric, timeseries, initial):
     return metric
 
 
-def seed_data(api, data_file, max_resolution, host, prefix='horizon', line_port=0, udp_port=0, verify=True):
+def seed_binary(host, port, metric, timeseries, initial):
+    from skyline.horizon.protocols import pack_binary
+    sock = socket.socket()
+    sock.connect((host, port))
+    datapoints = []
+    for datapoint in timeseries:
+        datapoint[0] = initial
+        initial += 1
+        datapoints.append((float(datapoint[0]), float(datapoint[1])))
+    sock.sendall(pack_binary({metric: datapoints}))
+    sock.close()
+    return metric
+
+
+def seed_data(api, data_file, max_resolution, host, prefix='horizon', line_port=0, udp_port=0, binary_port=0, verify=True):
     try:
         timeseries = []
         with open(data_file, 'r') as f:
@@ -46,12 +75,18 @@ def seed_data(api, data_file, max_resolution, host, prefix='horizon', line_port=
             metric = '{0}.test.line'.format(prefix)
             seed_line(host, line_port, metric, timeseries, initial)
             if verify:
-                verify_metric_exists(api, metric)
+                wait_for_metric(api, metric)
         if udp_port:
             print('Loading data over udp via Horizon...')
             metric = '{0}.test.udp'.format(prefix)
             seed_udp(host, udp_port, metric, timeseries, initial)
             if verify:
-                verify_metric_exists(api, metric)
+                wait_for_metric(api, metric)
+        if binary_port:
+            print('Loading data over binary via Horizon...')
+            metric = '{0}.test.binary'.format(prefix)
+            seed_binary(host, binary_port, metric, timeseries, initial)
+            if verify:
+                wait_for_metric(api, metric)
     except Exception as e:
         print(e)
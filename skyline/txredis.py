@@ -0,0 +1,277 @@
+from collections import deque
+from hashlib import sha1
+from redis import ConnectionPool, StrictRedis, WatchError
+from redis.connection import BaseParser, Connection
+from redis.exceptions import ConnectionError, ResponseError
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, succeed
+from twisted.internet.protocol import ClientCreator, Protocol
+
+"""
+A redis client for the reactor. AsyncRedis is a StrictRedis whose commands
+return Deferreds instead of blocking, so every redis-py command and its
+response parsing is available, sent over a small pool of connections that
+pipeline requests.
+"""
+
+INCOMPLETE = object()
+PARSER = BaseParser()
+PACKER = Connection()
+
+
+def parse_reply(data, pos):
+    """
+    Parse the RESP reply at pos, returning it and the position after it, or
+    INCOMPLETE if data doesn't hold all of it yet. Error replies are returned
+    as exceptions.
+    """
+    end = data.find('\r\n', pos)
+    if end < 0:
+        return INCOMPLETE, pos
+    kind = data[pos]
+    line = data[pos + 1:end]
+    pos = end + 2
+
+    if kind == '+':
+        return line, pos
+    if kind == '-':
+        return PARSER.parse_error(line), pos
+    if kind == ':':
+        return int(line), pos
+    if kind == '$':
+        length = int(line)
+        if length < 0:
+            return None, pos
+        if len(data) < pos + length + 2:
+            return INCOMPLETE, pos
+        return data[pos:pos + length], pos + length + 2
+    if kind == '*':
+        length = int(line)
+        if length < 0:
+            return None, pos
+        items = []
+        for i in xrange(length):
+            item, pos = parse_reply(data, pos)
+            if item is INCOMPLETE:
+                return INCOMPLETE, pos
+            items.append(item)
+        return items, pos
+    raise ResponseError("unexpected reply type {0!r}".format(kind))
+
+
+class RedisProtocol(Protocol):
+    """
+    A redis connection. Commands are written as soon as they are sent and
+    their Deferreds fire in order as the replies come back.
+    """
+    def __init__(self):
+        self.buffer = ''
+        self.replies = deque()
+        self.lost = Deferred()
+
+    def __len__(self):
+        return len(self.replies)
+
+    def send(self, commands):
+        """Write a list of commands at once, returning a Deferred for each of their replies."""
+        if self.transport is None or not self.connected:
+            raise ConnectionError("not connected to redis")
+        replies = [Deferred() for command in commands]
+        self.replies.extend(replies)
+        self.transport.writeSequence(PACKER.pack_commands(commands))
+        return replies
+
+    def dataReceived(self, data):
+        self.buffer += data
+        pos = 0
+        while pos < len(self.buffer):
+            reply, end = parse_reply(self.buffer, pos)
+            if reply is INCOMPLETE:
+                break
+            pos = end
+            d = self.replies.popleft()
+            if isinstance(reply, ResponseError):
+                d.errback(reply)
+            else:
+                d.callback(reply)
+        self.buffer = self.buffer[pos:]
+
+    def connectionLost(self, reason):
+        self.connected = 0
+        replies, self.replies = self.replies, deque()
+        for d in replies:
+            d.errback(ConnectionError("lost the connection to redis: {0}".format(reason.getErrorMessage())))
+        self.lost.callback(self)
+
+
+class AsyncPipeline(StrictRedis):
+    """
+    Queue commands and send them in a single write, wrapped in MULTI/EXEC
+    when transaction is set. execute() returns a Deferred of the results.
+    WATCH isn't supported, the connections are shared.
+    """
+    def __init__(self, client, transaction=True):
+        self.client = client
+        self.transaction = transaction
+        self.response_callbacks = client.response_callbacks
+        self.command_stack = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def reset(self):
+        self.command_stack = []
+
+    def execute_command(self, *args, **options):
+        self.command_stack.append((args, options))
+        return self
+
+    def execute(self):
+        stack, self.command_stack = self.command_stack, []
+        if not stack:
+            return succeed([])
+
+        commands = [args for args, options in stack]
+        if self.transaction:
+            commands = [('MULTI',)] + commands + [('EXEC',)]
+        d = self.client.connection()
+        d.addCallback(lambda connection: DeferredList(connection.send(commands), consumeErrors=True))
+        d.addCallback(self.parse_replies, stack)
+        return d
+
+    def parse_replies(self, replies, stack):
+        failures = [reply for success, reply in replies if not success]
+        if self.transaction:
+            success, results = replies[-1]
+            if not success:
+                # A command was refused while queueing, which aborted the EXEC
+                failures[0].raiseException()
+            if results is None:
+                raise WatchError("watched variable changed")
+        else:
+            if failures:
+                failures[0].raiseException()
+            results = [reply for success, reply in replies]
+
+        parsed = []
+        for result, (args, options) in zip(results, stack):
+            if isinstance(result, ResponseError):
+                raise result
+            parsed.append(self.client.parse_result(result, args[0], options))
+        return parsed
+
+
+class AsyncRedis(StrictRedis):
+    """
+    A StrictRedis whose commands return Deferreds. Requests are spread over
+    up to max_connections connections, each of which pipelines them, and a
+    new connection is only opened while all the others are busy. The
+    sources of the lua scripts given are loaded on every connection.
+    """
+    def __init__(self, connection_pool, max_connections=4, scripts=()):
+        # The pool only describes the server, the reactor makes the connections
+        self.connection_pool = connection_pool
+        self.response_callbacks = self.__class__.RESPONSE_CALLBACKS.copy()
+        self.max_connections = max_connections
+        self.scripts = list(scripts)
+        self.connections = []
+        self.connecting = 0
+        self.waiting = []
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        return cls(ConnectionPool.from_url(url), **kwargs)
+
+    def register_script(self, script):
+        """Register a lua script, which is loaded on every connection so EVALSHA can be pipelined."""
+        if script not in self.scripts:
+            self.scripts.append(script)
+            for connection in self.connections:
+                d = connection.send([('SCRIPT', 'LOAD', script)])[0]
+                d.addErrback(lambda failure, connection=connection: connection.transport.loseConnection())
+        script = super(AsyncRedis, self).register_script(script)
+        script.sha = sha1(script.script).hexdigest()
+        return script
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return AsyncPipeline(self, transaction)
+
+    def execute_command(self, *args, **options):
+        d = self.connection()
+        d.addCallback(lambda connection: connection.send([args])[0])
+        d.addCallback(self.parse_result, args[0], options)
+        return d
+
+    def parse_result(self, result, command_name, options):
+        if command_name in self.response_callbacks:
+            return self.response_callbacks[command_name](result, **options)
+        return result
+
+    def connection(self):
+        """
+        Return a Deferred of the least busy connection, opening another one
+        when it is busy and the pool isn't full.
+        """
+        connection = min(self.connections, key=len) if self.connections else None
+        if len(self.connections) + self.connecting < self.max_connections and (connection is None or len(connection)):
+            self.connect()
+        if connection is not None:
+            return succeed(connection)
+        d = Deferred()
+        self.waiting.append(d)
+        return d
+
+    def connect(self):
+        self.connecting += 1
+        kwargs = self.connection_pool.connection_kwargs
+        creator = ClientCreator(reactor, RedisProtocol)
+        if kwargs.get('path'):
+            d = creator.connectUNIX(kwargs['path'])
+        else:
+            d = creator.connectTCP(kwargs.get('host', 'localhost'), kwargs.get('port', 6379))
+        d.addCallback(self.prepare)
+        d.addCallbacks(self.connected, self.connectFailed)
+
+    def prepare(self, connection):
+        """Authenticate, select the database and load the scripts before the connection is used."""
+        kwargs = self.connection_pool.connection_kwargs
+        commands = []
+        if kwargs.get('password'):
+            commands.append(('AUTH', kwargs['password']))
+        if kwargs.get('db'):
+            commands.append(('SELECT', kwargs['db']))
+        for script in self.scripts:
+            commands.append(('SCRIPT', 'LOAD', script))
+        if not commands:
+            return connection
+
+        d = DeferredList(connection.send(commands), fireOnOneErrback=True, consumeErrors=True)
+        d.addCallback(lambda results: connection)
+        d.addErrback(lambda failure: (connection.transport.loseConnection(), failure.value.subFailure)[1])
+        return d
+
+    def connected(self, connection):
+        self.connecting -= 1
+        self.connections.append(connection)
+        connection.lost.addCallback(self.connections.remove)
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(connection)
+
+    def connectFailed(self, failure):
+        self.connecting -= 1
+        if self.connecting or self.connections:
+            return
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.errback(ConnectionError("can't connect to redis: {0}".format(failure.getErrorMessage())))
+
+    def disconnect(self):
+        for connection in list(self.connections):
+            connection.transport.loseConnection()
@@ -1,9 +1,11 @@
 import json
+import numpy as np
 import socket
 import time
 from io import BytesIO
 
 from .analyzer import Analyzer
+from .codecs import DEFAULT_FORMAT
 
 try:
     import cPickle as pickle
@@ -94,6 +96,15 @@ def check_anomalies(api, timestamp=True):
             print("{0}".format(anomaly[0]))
 
 
+def check_queue(api):
+    now = time.time()
+    ages = [now - queued_at for queued_at in api.get_queue()]
+    print("{0} metrics queued".format(len(ages)))
+    if ages:
+        percentiles = np.percentile(ages, [50, 90, 99])
+        print("age p50 {0:.1f}s, p90 {1:.1f}s, p99 {2:.1f}s, max {3:.1f}s".format(*(percentiles.tolist() + [max(ages)])))
+
+
 def settings(api, import_file=None, export=True):
     if import_file:
         with open(import_file) as f:
@@ -104,7 +115,7 @@ def settings(api, import_file=None, export=True):
 
 def print_metric_data(api, metric, interval):
     data = api.get_metric_data(metric)
-    if not data:
+    if not len(data):
         print("data not found for {0}".format(args.metric))
         return
 
@@ -160,6 +171,17 @@ def print_metric_last_anomaly_results(api, metric):
             print("  {0}: {1}".format(k, v))
 
 
+def migrate(api, storage_format):
+    """Convert the data of every metric to storage_format."""
+    migrated = 0
+    for metrics in api.iter_metricset_all():
+        for metric, info in zip(metrics, api.get_metrics_info(metrics, "format")):
+            if info.get("format", DEFAULT_FORMAT) != storage_format:
+                api.migrate_metric(metric, storage_format)
+                migrated += 1
+    print("Migrated {0} metrics to {1}".format(migrated, storage_format))
+
+
 def check_metric(api, metric, interval):
     print_metric_data(api, metric, interval)
     print("")
@@ -1,13 +1,12 @@
 import argparse
-import redis
 import logging
 import json
 import sys
-from msgpack import Unpacker
 from flask import Flask, request, render_template
 from os.path import dirname, abspath
+from skyline.api import SkylineRedisApi
 
-REDIS_CONN = None
+API = None
 
 app = Flask(__name__)
 app.config['PROPAGATE_EXCEPTIONS'] = True
@@ -36,18 +35,15 @@ def anomalies():
 def data():
     metric = request.args.get('metric', None)
     try:
-        raw_series = REDIS_CONN.get(metric)
-        if not raw_series:
+        timeseries = API.get_metric_data(metric)
+        if not len(timeseries):
             resp = json.dumps({'results': 'Error: No metric by that name'})
             return resp, 404
         else:
-            unpacker = Unpacker(use_list=False)
-            unpacker.feed(raw_series)
-            timeseries = [item[:2] for item in unpacker]
-            resp = json.dumps({'results': timeseries})
+            resp = json.dumps({'results': [list(item[:2]) for item in timeseries]})
             return resp, 200
     except Exception as e:
-        error = "Error: " + e
+        error = "Error: " + str(e)
         resp = json.dumps({'results': error})
         return resp, 500
 
@@ -57,12 +53,12 @@ if __name__ == "__main__":
     Start the server
     """
     parser = argparse.ArgumentParser(description='Webapp to display anomalies.')
-    parser.add_argument("-r", "--redis", default="redis://localhost:6379/", help="Redis instance to connect to")
+    parser.add_argument("-r", "--redis", default="redis://localhost:6379/", help="Redis instance to connect to, separate several urls with commas when metrics are sharded")
     parser.add_argument("-H", "--host", default="0.0.0.0", help="The IP address for the webapp")
     parser.add_argument("-p", "--port", type=int, default=1500, help="The port for the webapp")
     args = parser.parse_args()
 
-    REDIS_CONN = redis.StrictRedis.from_url(args.redis)
+    API = SkylineRedisApi(args.redis)
 
     logging.basicConfig(level=logging.DEBUG)
     logger = logging.getLogger("AppLog")
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+# Run in a fresh interpreter, as the test runner may already have installed
+# the reactor. Each worker listens on a port, so its reactor registers the
+# socket with its epoll instance, then checks that every file descriptor in
+# that instance is one of its own.
+WORKERS = """
+import json, os, re, sys, time
+from skyline.agents import run_workers
+
+directory = sys.argv[1]
+imported = 'twisted.internet.reactor' in sys.modules
+
+def target(worker):
+    inherited = 'twisted.internet.reactor' in sys.modules
+    from twisted.internet import reactor
+    from twisted.internet.protocol import ServerFactory
+    reactor.listenTCP(0, ServerFactory(), interface='127.0.0.1')
+    open(os.path.join(directory, 'ready.{0}'.format(worker)), 'w').close()
+    while len([name for name in os.listdir(directory) if name.startswith('ready.')]) < 2:
+        time.sleep(0.05)
+
+    registered = []
+    with open('/proc/self/fdinfo/{0}'.format(reactor._poller.fileno())) as fdinfo:
+        for line in fdinfo:
+            match = re.match(r'tfd:\s*(\d+) .* ino:([0-9a-f]+)', line)
+            if match:
+                registered.append((int(match.group(1)), int(match.group(2), 16)))
+    own = all(os.fstat(fd).st_ino == ino for fd, ino in registered)
+    with open(os.path.join(directory, 'worker.{0}'.format(worker)), 'w') as f:
+        json.dump({"imported": imported, "inherited": inherited, "registered": len(registered), "own": own}, f)
+    time.sleep(60)
+
+run_workers(2, target)
+"""
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), "epoll is only available on Linux")
+class TestRunWorkers(unittest.TestCase):
+    """
+    Test the worker processes are forked before the reactor is installed
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def results(self, timeout=30):
+        names = ['worker.0', 'worker.1']
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if all(os.path.exists(os.path.join(self.directory, name)) for name in names):
+                time.sleep(0.1)  # Let the last one finish writing
+                return [json.load(open(os.path.join(self.directory, name))) for name in names]
+            time.sleep(0.1)
+        self.fail("the workers didn't start")
+
+    def test_workers_have_their_own_epoll(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        supervisor = subprocess.Popen([sys.executable, '-c', WORKERS, self.directory], env=env)
+        try:
+            results = self.results()
+        finally:
+            supervisor.send_signal(signal.SIGTERM)
+            supervisor.wait()
+
+        for result in results:
+            self.assertFalse(result["imported"])
+            self.assertFalse(result["inherited"])
+            self.assertTrue(result["registered"] >= 1)
+            self.assertTrue(result["own"])
+
+
+if __name__ == '__main__':
+    unittest.main()
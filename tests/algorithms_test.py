@@ -10,7 +10,7 @@ import sys
 from os.path import dirname, abspath
 
 from skyline.analyzer import algorithms
-from skyline.analyzer.analyzer import Analyzer
+from skyline.analyzer.analyzer import Analyzer, SKIPPED
 
 class TestAlgorithms(unittest.TestCase):
     """
@@ -65,7 +65,7 @@ class TestAlgorithms(unittest.TestCase):
     @patch('skyline.api.SkylineRedisApi')
     def test_run_selected_algorithm(self, ApiMock, timeMock):
         timeMock.return_value, timeseries = self.data(time())
-        args = Namespace(min_tolerable_length=1, stale_period=500, max_tolerable_boredom=100, boredom_set_size=1, full_duration=86400, consensus=6)
+        args = Namespace(min_tolerable_length=1, stale_period=500, max_tolerable_boredom=100, boredom_set_size=1, full_duration=86400, consensus=6, short_circuit=False, adf_ttl=0)
         result, ensemble, datapoint = Analyzer(ApiMock(), args).is_anomalous(timeseries, "test.metric")
         self.assertTrue(result)
         self.assertTrue(collections.Counter(ensemble.values())[True] >= 4)
@@ -88,16 +88,124 @@ class TestAlgorithms(unittest.TestCase):
         timeMock.return_value, timeseries = self.data(time())
 
         alwaysTrue = Mock(return_value=True)
-        args = Namespace(min_tolerable_length=1, stale_period=500, max_tolerable_boredom=100, boredom_set_size=1, full_duration=86400, consensus=1, enable_second_order=False)
+        args = Namespace(min_tolerable_length=1, stale_period=500, max_tolerable_boredom=100, boredom_set_size=1, full_duration=86400, consensus=1, enable_second_order=False, short_circuit=False)
         with patch.dict(algorithms.__dict__, {'alwaysTrue': alwaysTrue}):
             result, ensemble, datapoint = Analyzer(ApiMock(), args).is_anomalous(timeseries, "test.metric")
 
 
-        alwaysTrue.assert_called_with(timeseries, args)
+        # Custom algorithms get the Features of the timeseries, which still behaves like it
+        features, called_args = alwaysTrue.call_args[0]
+        self.assertTrue(features.timeseries is timeseries)
+        self.assertEqual(list(features), timeseries)
+        self.assertTrue(called_args is args)
         self.assertTrue(result)
         self.assertEqual(ensemble, {'alwaysTrue': True})
         self.assertEqual(algorithms.tail_avg(timeseries, Namespace()), 334)
 
+    @patch.object(algorithms, 'ALGORITHMS')
+    @patch.object(algorithms.time, 'time')
+    @patch('skyline.api.SkylineRedisApi')
+    def test_analyze_counts_stats(self, ApiMock, timeMock, algorithmsListMock):
+        algorithmsListMock.__iter__.return_value = ['alwaysTrue']
+        timeMock.return_value, timeseries = self.data(time())
+
+        args = Namespace(min_tolerable_length=10, stale_period=500, max_tolerable_boredom=100, boredom_set_size=1, full_duration=86400, consensus=1, enable_second_order=False, short_circuit=False, stats_interval=60)
+        analyzer = Analyzer(ApiMock(), args, worker=1)
+        with patch.dict(algorithms.__dict__, {'alwaysTrue': Mock(return_value=True)}):
+            self.assertTrue(analyzer.analyze("test.metric", timeseries)[0])
+            self.assertEqual(analyzer.analyze("test.metric", timeseries[:5]), None)
+
+        self.assertEqual(analyzer.stats["analyzed"], 1)
+        self.assertEqual(analyzer.stats["anomalous"], 1)
+        self.assertEqual(analyzer.stats["skipped"], 1)
+        analyzer.stats_started -= 1
+        analyzer.log_stats(force=True)
+        self.assertEqual(analyzer.stats["analyzed"], 0)
+
+    @patch.object(algorithms, 'ALGORITHMS')
+    @patch.object(algorithms.time, 'time')
+    @patch('skyline.api.SkylineRedisApi')
+    def test_process_many_batches_redis(self, ApiMock, timeMock, algorithmsListMock):
+        algorithmsListMock.__iter__.return_value = ['alwaysFalse']
+        timeMock.return_value, timeseries = self.data(time())
+
+        api = ApiMock()
+        api.get_metrics_data.return_value = [(timeseries, {}), (timeseries[:5], {}), (timeseries, {})]
+        pipe = api.pipeline.return_value.__enter__.return_value
+        args = Namespace(min_tolerable_length=10, stale_period=500, max_tolerable_boredom=100, boredom_set_size=1, full_duration=86400, consensus=1, enable_second_order=False, streaming=False, vectorized=False, short_circuit=False, max_latency=0)
+        with patch.dict(algorithms.__dict__, {'alwaysFalse': Mock(return_value=False)}):
+            Analyzer(api, args).process_many(["a", "b", "c"])
+
+        api.get_metrics_data.assert_called_once_with(["a", "b", "c"])
+        self.assertEqual([c[0][0] for c in api.set_analyzed_results.call_args_list], ["a", "c"])
+        self.assertTrue(all(c[1]["pipe"] is pipe for c in api.set_analyzed_results.call_args_list))
+        pipe.execute.assert_called_once_with()
+
+    @patch('skyline.analyzer.analyzer.log')
+    @patch('skyline.api.SkylineRedisApi')
+    def test_queue_ages(self, ApiMock, logMock):
+        analyzer = Analyzer(ApiMock(), Namespace(stats_interval=60))
+        now = time()
+        analyzer.queued([("a", now - 10), ("b", now - 30)])
+        self.assertEqual([round(age) for age in analyzer.queue_ages], [10, 30])
+        analyzer.stats_started -= 1
+        analyzer.log_stats(force=True)
+        self.assertTrue(logMock.msg.call_args[0][0].startswith("analyzer: queue age p50 20.0s"))
+        self.assertEqual(analyzer.queue_ages, [])
+
+    @patch('skyline.api.SkylineRedisApi')
+    def test_interval(self, ApiMock):
+        args = Namespace(min_interval=10, max_latency=300)
+        analyzer = Analyzer(ApiMock(), args)
+        calm = (False, {'a': False, 'b': SKIPPED}, [0, 1])
+        volatile = (False, {'a': True, 'b': False}, [0, 1])
+        anomalous = (True, {'a': True, 'b': True}, [0, 1])
+        self.assertEqual(analyzer.interval({}, calm), 20)
+        self.assertEqual(analyzer.interval({"analysis_interval": "80"}, calm), 160)
+        self.assertEqual(analyzer.interval({"analysis_interval": "200"}, None), 300)
+        self.assertEqual(analyzer.interval({"analysis_interval": "80"}, volatile), 40)
+        self.assertEqual(analyzer.interval({"analysis_interval": "15"}, volatile), 10)
+        self.assertEqual(analyzer.interval({"analysis_interval": "300"}, anomalous), 10)
+
+    @patch.object(algorithms, 'ALGORITHMS')
+    @patch.object(algorithms.time, 'time')
+    @patch('skyline.api.SkylineRedisApi')
+    def test_process_many_schedules(self, ApiMock, timeMock, algorithmsListMock):
+        algorithmsListMock.__iter__.return_value = ['alwaysFalse']
+        timeMock.return_value, timeseries = self.data(time())
+
+        api = ApiMock()
+        api.get_metrics_data.return_value = [(timeseries, {"analysis_interval": "40"}), (timeseries[:5], {})]
+        pipe = api.pipeline.return_value.__enter__.return_value
+        args = Namespace(min_tolerable_length=10, stale_period=500, max_tolerable_boredom=100, boredom_set_size=1, full_duration=86400, consensus=1, enable_second_order=False, streaming=False, vectorized=False, short_circuit=False,
+                         max_latency=300, min_interval=10)
+        with patch.dict(algorithms.__dict__, {'alwaysFalse': Mock(return_value=False)}):
+            Analyzer(api, args).process_many(["a", "b"])
+
+        self.assertEqual([c[0] for c in api.schedule_analysis.call_args_list], [("a", 80, pipe), ("b", 20, pipe)])
+
+    @patch.object(algorithms, 'ALGORITHMS')
+    @patch.object(algorithms.time, 'time')
+    @patch('skyline.api.SkylineRedisApi')
+    def test_short_circuit_runs_cheapest_first(self, ApiMock, timeMock, algorithmsListMock):
+        algorithmsListMock.__iter__.return_value = ['expensive', 'cheap', 'medium']
+        timeMock.return_value, timeseries = self.data(time())
+
+        called = []
+        def algorithm(name, result):
+            return Mock(side_effect=lambda timeseries, args: called.append(name) or result)
+
+        args = Namespace(min_tolerable_length=1, stale_period=500, max_tolerable_boredom=100, boredom_set_size=1, full_duration=86400, consensus=2, enable_second_order=False, short_circuit=True,
+                         algorithm_costs={'expensive': 1.0, 'cheap': 0.001, 'medium': 0.01})
+        algorithmsDict = {'expensive': algorithm('expensive', True), 'cheap': algorithm('cheap', False), 'medium': algorithm('medium', False)}
+        with patch.dict(algorithms.__dict__, algorithmsDict):
+            result, ensemble, datapoint = Analyzer(ApiMock(), args).is_anomalous(timeseries, "test.metric")
+
+        # Two False out of three can't reach a consensus of 2
+        self.assertEqual(called, ['cheap', 'medium'])
+        self.assertFalse(result)
+        self.assertEqual(ensemble, {'cheap': False, 'medium': False, 'expensive': SKIPPED})
+
 
 if __name__ == '__main__':
     unittest.main()
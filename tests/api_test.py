@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+
+import numpy as np
+import time
+import unittest
+from mock import MagicMock
+from redis.exceptions import ConnectionError, ResponseError
+
+from skyline.api import SkylineRedisApi
+from skyline.codecs import CODECS
+
+
+class TestSharding(unittest.TestCase):
+    """
+    Test metrics are routed to their shard
+    """
+
+    def test_single_shard(self):
+        api = SkylineRedisApi("redis://localhost:6379/")
+        self.assertEqual(len(api.shards), 1)
+        self.assertIs(api.conn("horizon.test"), api.redis_conn)
+
+    def test_route(self):
+        api = SkylineRedisApi("redis://localhost:6379/0, redis://localhost:6380/0")
+        self.assertEqual(len(api.shards), 2)
+        metrics = ["horizon.test.{0}".format(i) for i in range(100)]
+        self.assertEqual(set(api.shard_index(metric) for metric in metrics), set([0, 1]))
+
+        # The same metric always lands on the same shard, whatever the order of the urls
+        reverse = SkylineRedisApi("redis://localhost:6380/0,redis://localhost:6379/0")
+        for metric in metrics:
+            self.assertEqual(api.shard_name(api.conn(metric)), reverse.shard_name(reverse.conn(metric)))
+
+        pipe = api.pipeline()
+        for metric in metrics:
+            self.assertIs(api.route(metric, pipe), pipe.shard(metric))
+            self.assertIs(api.route(metric), api.conn(metric))
+        self.assertEqual(sorted(pipe.pipes), [0, 1])
+
+    def test_duplicate_shard(self):
+        self.assertRaises(ValueError, SkylineRedisApi, "redis://localhost:6379/,redis://localhost:6379/0")
+
+    def test_iter_metricset_all(self):
+        api = SkylineRedisApi("redis://localhost:6379/0,redis://localhost:6380/0")
+        api.shards[0].sscan = MagicMock(side_effect=[(5, ["a", "b"]), (9, ["c"]), (12, []), (0, ["d", "e", "f"])])
+        api.shards[1].sscan = MagicMock(side_effect=[(0, [])])
+
+        # Chunks of at least count metrics, except the last of each shard
+        self.assertEqual(list(api.iter_metricset_all(count=3)), [["a", "b", "c"], ["d", "e", "f"]])
+        self.assertEqual([call[0][1] for call in api.shards[0].sscan.call_args_list], [0, 5, 9, 12])
+        api.shards[1].sscan.assert_called_once_with("skyline:metricset:all", 0, count=3)
+
+        api.shards[0].sscan = MagicMock(side_effect=[(4, ["a"]), (0, ["b"])])
+        api.shards[1].sscan = MagicMock(side_effect=[(2, ["c", "d", "e"]), (0, ["f"])])
+        self.assertEqual(list(api.iter_metricset_all(count=2)), [["a", "b"], ["c", "d", "e"], ["f"]])
+
+        api.shards[0].sscan = MagicMock(side_effect=[(4, ["a"]), (0, ["b"])])
+        api.shards[1].sscan = MagicMock(side_effect=[(0, ["c"])])
+        self.assertEqual(api.get_metricset_all(), set(["a", "b", "c"]))
+
+
+class RedisTestCase(unittest.TestCase):
+    """
+    Tests running the api against a local redis, in a database they flush.
+    They are skipped when redis isn't available.
+    """
+    url = "redis://localhost:6379/15"
+
+    def setUp(self):
+        self.api = SkylineRedisApi(self.url)
+        try:
+            self.api.redis_conn.flushdb()
+        except ConnectionError:
+            self.skipTest("redis is not available at {0}".format(self.url))
+        self.addCleanup(self.api.redis_conn.flushdb)
+
+    def data(self, metric):
+        return self.api.redis_conn.get("skyline:metric:{0}:data".format(metric))
+
+    def info(self, metric):
+        return self.api.get_metric_info(metric)
+
+
+class TestAppend(RedisTestCase):
+    """
+    Test datapoints are appended in the format the metric is stored in
+    """
+
+    def test_v1_matches_the_codec(self):
+        datapoints = [(1420070400.0, 1.5), (1420070410.0, -2.0), (1420070420.25, 1e300)]
+        self.api.publish("a", datapoints[:1])
+        self.api.publish("a", datapoints[1:])
+        self.assertEqual(self.data("a"), CODECS['v1'].encode(datapoints))
+        self.assertEqual(self.info("a")["format"], "v1")
+        self.assertEqual(self.info("a")["length"], "3")
+        self.assertEqual(self.api.get_metric_data("a"), datapoints)
+
+    def test_publish_after_migration(self):
+        # A publisher still believing the metric is stored in v1
+        self.api.publish("a", [(1.0, 1.0)])
+        SkylineRedisApi(self.url).migrate_metric("a", "v2")
+        self.assertEqual(self.api.formats["a"], "v1")
+        self.api.publish("a", [(2.0, 2.0)])
+        self.assertEqual(self.info("a")["format"], "v2")
+        self.assertEqual(self.api.get_metric_data("a").tolist(), [[1.0, 1.0], [2.0, 2.0]])
+
+        # And back
+        publisher = SkylineRedisApi(self.url, "v2")
+        publisher.publish("b", [(1.0, 1.0)])
+        SkylineRedisApi(self.url).migrate_metric("b", "v1")
+        publisher.publish("b", [(2.0, 2.0)])
+        self.assertEqual(self.data("b"), CODECS['v1'].encode([(1.0, 1.0), (2.0, 2.0)]))
+        self.assertEqual(self.info("b")["length"], "2")
+
+    def test_publish_during_migration(self):
+        self.api.publish("a", [(1.0, 1.0)])
+        migrator = SkylineRedisApi(self.url)
+        get_metric_data = migrator.get_metric_data
+
+        def publish_while_reading(metric, pipe=None):
+            # A publish between the read and the write of the migration
+            datapoints = get_metric_data(metric, pipe)
+            if len(datapoints) == 1:
+                self.api.publish("a", [(2.0, 2.0)])
+            return datapoints
+        migrator.get_metric_data = publish_while_reading
+        migrator.migrate_metric("a", "v2")
+
+        self.assertEqual(self.info("a")["format"], "v2")
+        self.assertEqual(self.info("a")["length"], "2")
+        self.assertTrue(np.array_equal(self.api.get_metric_data("a"), [[1.0, 1.0], [2.0, 2.0]]))
+
+    def test_ring(self):
+        publisher = SkylineRedisApi(self.url, "ring", ring_capacity=3)
+        publisher.publish("a", [(1.0, 1.0), (2.0, 2.0)])
+        self.assertEqual(len(self.data("a")), 3 * 16)
+        publisher.publish("a", [(3.0, 3.0), (4.0, 4.0)])
+        self.assertEqual(self.info("a")["head"], "1")
+        self.assertEqual(self.api.get_metric_data("a").tolist(), [[2.0, 2.0], [3.0, 3.0], [4.0, 4.0]])
+
+    def test_ring_publish_after_migration(self):
+        # Into a ring, from a publisher that cached v2
+        publisher = SkylineRedisApi(self.url, "v2", ring_capacity=3)
+        publisher.publish("a", [(1.0, 1.0)])
+        migrator = SkylineRedisApi(self.url, ring_capacity=3)
+        migrator.migrate_metric("a", "ring")
+        publisher.publish("a", [(2.0, 2.0), (3.0, 3.0), (4.0, 4.0)])
+        self.assertEqual(self.info("a")["format"], "ring")
+        self.assertEqual(len(self.data("a")), 3 * 16)
+        self.assertEqual(self.api.get_metric_data("a").tolist(), [[2.0, 2.0], [3.0, 3.0], [4.0, 4.0]])
+
+        # Out of a ring, from a publisher that cached ring
+        migrator.migrate_metric("a", "v2")
+        publisher.publish("a", [(5.0, 5.0)])
+        self.assertEqual(self.info("a")["format"], "v2")
+        self.assertEqual(self.api.get_metric_data("a").tolist(), [[2.0, 2.0], [3.0, 3.0], [4.0, 4.0], [5.0, 5.0]])
+
+    def test_gorilla(self):
+        datapoints = [(1420070400.0 + t * 10, float(t % 7)) for t in range(CODECS['gorilla'].chunk_size + 10)]
+        publisher = SkylineRedisApi(self.url, "gorilla")
+        publisher.publish("a", datapoints[:-1])
+        self.assertEqual(self.data("a"), CODECS['v2'].encode(datapoints[:-1]))
+        self.assertEqual(self.info("a")["format"], "gorilla")
+
+        # Rewriting the metric seals a chunk, publishes still append to the tail
+        self.api.set_metric_data("a", self.api.get_metric_data("a"), storage_format="gorilla")
+        sealed = int(self.info("a")["sealed"])
+        self.assertLess(sealed, CODECS['gorilla'].chunk_size * 16)
+        publisher.publish("a", datapoints[-1:])
+        self.assertEqual(len(self.data("a")), sealed + 10 * 16)
+        self.assertEqual(self.api.get_metric_data("a").tolist(), [list(d) for d in datapoints])
+        self.assertEqual(self.api.get_metrics_data(["a"])[0][0].tolist(), [list(d) for d in datapoints])
+
+        self.api.migrate_metric("a", "v2")
+        self.assertFalse("sealed" in self.info("a"))
+        self.assertEqual(self.api.get_metric_data("a").tolist(), [list(d) for d in datapoints])
+
+    def test_new_metrics_get_the_format_given(self):
+        SkylineRedisApi(self.url, "v2").publish("a", [(1.0, 1.0)])
+        self.assertEqual(self.data("a"), CODECS['v2'].encode([(1.0, 1.0)]))
+        self.assertEqual(self.api.get_metrics_data(["a"])[0][1]["format"], "v2")
+
+
+class TestTrim(RedisTestCase):
+    """
+    Test the datapoints older than a timestamp are dropped inside redis
+    """
+
+    def datapoints(self):
+        return [(float(t), float(t) * 10) for t in range(1, 6)]
+
+    def test_partial_removal(self):
+        for storage_format in ("v1", "v2"):
+            metric = "trim." + storage_format
+            self.api.set_metric_data(metric, self.datapoints(), storage_format=storage_format)
+            self.api.set_metric_info(metric, "format", storage_format)
+
+            self.assertEqual(self.api.trim_metric(metric, 3.0, now=100), 3)
+            self.assertEqual(self.data(metric), CODECS[storage_format].encode(self.datapoints()[3:]))
+            self.assertEqual(self.info(metric)["length"], "2")
+            self.assertEqual(self.info(metric)["last_cleaned_at"], "100")
+
+            # Nothing older is left
+            self.assertEqual(self.api.trim_metric(metric, 3.0, now=101), 0)
+            self.assertEqual(self.info(metric)["length"], "2")
+            self.assertEqual(self.api.trim_metric(metric, 10.0, now=102), 2)
+            self.assertEqual(self.data(metric), "")
+
+    def test_v1_integers(self):
+        # msgpack packs integral numbers in the smallest type that fits them
+        datapoints = [(1, -1), (200, 1.5), (70000, -200), (2 ** 40, 2 ** 33), (2 ** 40 + 1, 0)]
+        self.api.set_metric_data("a", datapoints)
+        self.assertEqual(self.api.trim_metrics(["a"], 2 ** 40), [4])
+        self.assertEqual(self.api.get_metric_data("a"), datapoints[4:])
+
+    def test_other_formats(self):
+        publisher = SkylineRedisApi(self.url, "ring", ring_capacity=3)
+        publisher.publish("ring", self.datapoints())
+        self.api.redis_conn.set("skyline:metric:bad:data", "\x01" + CODECS['v1'].encode(self.datapoints()))
+
+        ring, bad = self.api.trim_metrics(["ring", "bad"], 3.0)
+        # Rings can't be trimmed in redis, and are left alone
+        self.assertIsNone(ring)
+        self.assertEqual(self.api.get_metric_data("ring").tolist(), [list(d) for d in self.datapoints()[2:]])
+        self.assertIsInstance(bad, ResponseError)
+
+
+class TestStreamFetch(RedisTestCase):
+    """
+    Test the streaming analysis only fetches the datapoints appended since
+    its state was saved, and starts over when the data was changed
+    """
+
+    def fetch(self, metric):
+        datapoints, info, state = self.api.get_metrics_stream([metric])[0]
+        return [tuple(d) for d in datapoints], state
+
+    def save(self, metric, state):
+        state["count"] = state.get("count", 0)
+        self.api.set_stream_state(metric, state)
+
+    def test_appended_datapoints(self):
+        self.api.publish("a", [(1.0, 1.0), (2.0, 2.0)])
+        datapoints, state = self.fetch("a")
+        self.assertEqual(datapoints, [(1.0, 1.0), (2.0, 2.0)])
+        self.assertFalse("count" in state)
+        self.assertEqual(state["offset"], len(self.data("a")))
+        self.assertEqual(state["format"], "v1")
+        self.save("a", state)
+
+        self.api.publish("a", [(3.0, 3.0)])
+        datapoints, state = self.fetch("a")
+        self.assertEqual(datapoints, [(3.0, 3.0)])
+        self.assertEqual(state["count"], "0")
+        self.assertEqual(state["offset"], len(self.data("a")))
+        self.save("a", state)
+
+        datapoints, state = self.fetch("a")
+        self.assertEqual(datapoints, [])
+        self.assertEqual(state["count"], "0")
+
+    def test_reset_after_trim(self):
+        self.api.publish("a", [(1.0, 1.0), (2.0, 2.0), (3.0, 3.0)])
+        self.save("a", self.fetch("a")[1])
+        self.api.trim_metric("a", 1.0)
+        datapoints, state = self.fetch("a")
+        self.assertEqual(datapoints, [(2.0, 2.0), (3.0, 3.0)])
+        self.assertFalse("count" in state)
+        self.assertEqual(state["last_cleaned_at"], self.info("a")["last_cleaned_at"])
+
+        # The data got shorter without being cleaned
+        self.save("a", state)
+        self.api.set_metric_data("a", [(3.0, 3.0)])
+        datapoints, state = self.fetch("a")
+        self.assertEqual(datapoints, [(3.0, 3.0)])
+        self.assertFalse("count" in state)
+
+    def test_reset_after_format_change(self):
+        self.api.publish("a", [(1.0, 1.0), (2.0, 2.0)])
+        self.save("a", self.fetch("a")[1])
+        self.api.migrate_metric("a", "v2")
+        datapoints, state = self.fetch("a")
+        self.assertEqual(datapoints, [(1.0, 1.0), (2.0, 2.0)])
+        self.assertFalse("count" in state)
+        self.assertEqual(state["format"], "v2")
+        self.assertEqual(state["offset"], 32)
+
+    def test_gorilla(self):
+        datapoints = [(float(t), float(t)) for t in range(CODECS['gorilla'].chunk_size + 2)]
+        self.api.set_metric_data("a", datapoints[:-1], storage_format="gorilla")
+        self.api.set_metric_info("a", "format", "gorilla")
+        fetched, state = self.fetch("a")
+        self.assertEqual(fetched, datapoints[:-1])
+        self.save("a", state)
+
+        # Only the tail is fetched once the sealed chunks are in the state
+        self.api.publish("a", datapoints[-1:])
+        self.assertEqual(self.fetch("a")[0], datapoints[-1:])
+
+    def test_rings_are_always_fetched_whole(self):
+        publisher = SkylineRedisApi(self.url, "ring", ring_capacity=3)
+        publisher.publish("a", [(1.0, 1.0), (2.0, 2.0)])
+        self.save("a", self.fetch("a")[1])
+        publisher.publish("a", [(3.0, 3.0), (4.0, 4.0)])
+        datapoints, state = self.fetch("a")
+        self.assertEqual(datapoints, [(2.0, 2.0), (3.0, 3.0), (4.0, 4.0)])
+        self.assertFalse("count" in state)
+
+
+class TestAnalyzedResults(RedisTestCase):
+    """
+    Test the results of an analysis replace those of the previous one
+    """
+
+    def test_results_are_replaced(self):
+        self.api.set_analyzed_results("a", True, {"first_hour_average": True, "ks_test": False}, (1.0, 1.0))
+        self.api.set_analyzed_results("a", False, {"stddev_from_average": False}, (2.0, 2.0))
+        self.assertEqual(self.api.get_last_analyzed_results("a"), {"stddev_from_average": "False"})
+        self.assertEqual(self.api.get_last_anomaly_results("a"), {"first_hour_average": "True", "ks_test": "False"})
+        self.assertEqual(self.info("a")["last_anomaly_timestamp"], "1.0")
+        self.assertEqual(self.info("a")["last_analyzed_timestamp"], "2.0")
+
+        self.api.set_analyzed_results("a", True, {"ks_test": True}, (3.0, 3.0))
+        self.assertEqual(self.api.get_last_anomaly_results("a"), {"ks_test": "True"})
+
+
+class TestClaim(RedisTestCase):
+    """
+    Test metrics are claimed from the work queue oldest first
+    """
+
+    def queue(self, *ages):
+        self.now = time.time()
+        for i, age in enumerate(ages):
+            self.api.redis_conn.zadd("skyline:metricset:queue", self.now - age, "m{0}".format(i))
+
+    def claim(self, count, boost=0, schedule=False):
+        return [metric for metric, queued_at in self.api.claim_metrics(count, boost, schedule)]
+
+    def test_oldest_first(self):
+        self.queue(10, 30, 20, -60)
+        claimed = self.api.claim_metrics(2)
+        self.assertEqual([metric for metric, queued_at in claimed], ["m1", "m2"])
+        self.assertAlmostEqual(claimed[0][1], self.now - 30, places=2)
+        self.assertEqual(self.claim(10), ["m0"])
+        # Metrics queued in the future wait until then
+        self.assertEqual(self.claim(10), [])
+        self.assertEqual(self.api.get_queue(), [self.api.redis_conn.zscore("skyline:metricset:queue", "m3")])
+
+    def test_queued_at_first_update(self):
+        self.api.publish("a", [(1.0, 1.0)])
+        queued_at = self.api.get_queue()
+        self.api.publish("a", [(2.0, 2.0)])
+        self.assertEqual(self.api.get_queue(), queued_at)
+        self.assertEqual(self.claim(10), ["a"])
+        self.api.publish("a", [(3.0, 3.0)])
+        self.assertTrue(self.api.get_queue()[0] > queued_at[0])
+
+    def test_anomalous_boost(self):
+        self.queue(30, 10, 20)
+        self.api.redis_conn.zadd("skyline:metricset:anomalous", self.now, "m1")
+        self.api.redis_conn.zadd("skyline:metricset:anomalous", self.now, "unqueued")
+        self.assertEqual(self.claim(1), ["m0"])
+
+        self.queue(30, 10, 20)
+        self.assertEqual(self.claim(1, boost=60), ["m1"])
+        self.assertEqual(self.claim(10, boost=60), ["m0", "m2"])
+
+        # The boosted metrics are also found beyond the count oldest ones
+        self.queue(30, 10, 20)
+        self.assertEqual(self.claim(1, boost=25), ["m1"])
+
+    def test_schedule(self):
+        self.queue(30, 20)
+        self.api.schedule_analysis("m0", 100)
+        self.assertEqual(self.api.get_metric_info("m0")["analysis_interval"], "100")
+
+        # Ignored unless asked for
+        self.assertEqual(self.claim(1), ["m0"])
+
+        self.queue(30, 20)
+        self.assertEqual(self.claim(10, schedule=True), ["m1"])
+        # Queued again for when it is due
+        due = self.api.redis_conn.zscore("skyline:metricset:schedule", "m0")
+        self.assertEqual(self.api.redis_conn.zscore("skyline:metricset:queue", "m0"), due)
+        self.assertTrue(due > self.now + 99)
+        self.assertEqual(self.claim(10, schedule=True), [])
+        self.assertAlmostEqual(self.api.get_queue()[0], self.now - 30, places=2)
+
+        # Once due it is claimed, with the time it was first queued
+        self.api.redis_conn.zadd("skyline:metricset:schedule", self.now - 1, "m0")
+        self.api.redis_conn.zadd("skyline:metricset:queue", self.now - 1, "m0")
+        claimed = self.api.claim_metrics(10, schedule=True)
+        self.assertEqual([metric for metric, queued_at in claimed], ["m0"])
+        self.assertAlmostEqual(claimed[0][1], self.now - 30, places=2)
+        self.assertFalse(self.api.redis_conn.exists("skyline:metricset:queued_at"))
+
+    def test_deferred_metrics_dont_count(self):
+        # The oldest metrics are all deferred, the due ones behind them are claimed
+        self.queue(50, 40, 30, 20, 10)
+        for metric in ("m0", "m1", "m2"):
+            self.api.schedule_analysis(metric, 100)
+        self.assertEqual(self.claim(2, schedule=True), ["m3", "m4"])
+        self.assertEqual(self.claim(2, schedule=True), [])
+
+        # Including boosted ones
+        self.api.redis_conn.zrem("skyline:metricset:schedule", "m1", "m2")
+        self.queue(50, 40, 30)
+        self.api.redis_conn.zadd("skyline:metricset:anomalous", self.now, "m0")
+        self.assertEqual(self.claim(1, boost=60, schedule=True), ["m1"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy
+from argparse import Namespace
+from mock import patch
+
+from skyline.analyzer import algorithms, batch
+from skyline.analyzer.features import Features
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.now = 1420070400.0
+        self.args = Namespace(full_duration=86400, adf_ttl=0)
+        random = numpy.random.RandomState(0)
+        self.timeseries = []
+        for i in xrange(60):
+            length = random.randint(1, 8000) if i % 4 else random.randint(1, 6)
+            timestamps = self.now - numpy.arange(length)[::-1] * random.choice([1, 10, 60])
+            values = numpy.round(numpy.cumsum(random.randn(length)) * random.choice([1, 1000]), 2)
+            if i % 3 == 0:
+                values[-random.randint(1, 4):] += random.choice([10, -50, 5000])
+            if i % 7 == 0:
+                values = numpy.round(values / 100)
+            self.timeseries.append(map(list, zip(timestamps, values)))
+
+    def assertSameEnsembles(self, timeseries):
+        with patch.object(algorithms.time, 'time', return_value=self.now), \
+                patch.object(batch.time, 'time', return_value=self.now):
+            ensembles = batch.ensembles(timeseries, self.args)
+            for series, ensemble in zip(timeseries, ensembles):
+                features = Features(series)
+                expected = dict((algorithm, bool(getattr(algorithms, algorithm)(features, self.args)))
+                                for algorithm in algorithms.ALGORITHMS)
+                self.assertEqual(dict((k, bool(v)) for k, v in ensemble.items()), expected,
+                                 "{0} datapoints".format(len(series)))
+        return ensembles
+
+    def test_matches_per_metric(self):
+        ensembles = self.assertSameEnsembles(self.timeseries)
+        self.assertTrue(any(any(ensemble.values()) for ensemble in ensembles))
+
+    @patch.object(batch, 'MAX_BLOCK_SIZE', 10000)
+    def test_blocks(self):
+        self.assertSameEnsembles(self.timeseries)
+        arrays = [numpy.zeros((n, 2)) for n in (5000, 10, 3000, 20000)]
+        sizes = [[len(arrays[i]) for i in indexes] for indexes, block in batch.blocks(arrays)]
+        self.assertEqual(sizes, [[10, 3000], [5000], [20000]])
+
+    def test_short_circuit(self):
+        order = list(reversed(algorithms.ALGORITHMS))
+        with patch.object(algorithms.time, 'time', return_value=self.now), \
+                patch.object(batch.time, 'time', return_value=self.now):
+            full = batch.ensembles(self.timeseries, self.args)
+            for consensus in (1, 3, 6):
+                short = batch.ensembles(self.timeseries, self.args, order, consensus)
+                for complete, ensemble in zip(full, short):
+                    # The algorithms that ran agree, and decide the same verdict
+                    self.assertEqual(ensemble, dict((k, complete[k]) for k in ensemble))
+                    self.assertEqual(sum(ensemble.values()) >= consensus, sum(complete.values()) >= consensus)
+                    self.assertEqual(set(ensemble), set(order[:len(ensemble)]))
+            self.assertTrue(any(len(ensemble) < len(order) for ensemble in short))
+
+    def test_flat_series(self):
+        self.assertSameEnsembles([[[self.now - i, 5.0] for i in xrange(100)][::-1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
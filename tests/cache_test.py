@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import numpy as np
+import unittest
+
+from skyline.horizon.cache import MetricCache
+
+
+class TestMetricCache(unittest.TestCase):
+    """
+    Test the sharded MetricCache
+    """
+
+    def setUp(self):
+        self.cache = MetricCache.__class__(shards=4, max_size=10)
+
+    def test_store_routes_to_one_shard(self):
+        self.cache.store("a.b.c", (1.0, 1.0))
+        self.cache.store("a.b.c", (2.0, 2.0))
+        self.assertEqual(sum(1 for shard in self.cache.shards if shard), 1)
+        self.assertTrue("a.b.c" in self.cache.shard("a.b.c"))
+        self.assertEqual(self.cache.size, 2)
+
+    def test_metrics_drains_every_shard(self):
+        for i in range(20):
+            self.cache.store("metric.{0}".format(i % 5), (float(i), 1.0))
+        drained = dict(self.cache.metrics())
+        self.assertEqual(len(drained), 5)
+        self.assertEqual(sum(len(d) for d in drained.values()), 20)
+        self.assertFalse(self.cache)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_is_full(self):
+        for i in range(9):
+            self.cache.store("metric.{0}".format(i), (float(i), 1.0))
+        self.assertFalse(self.cache.isFull())
+        self.cache.store("metric.9", (9.0, 1.0))
+        self.assertTrue(self.cache.isFull())
+
+    def test_requeue_goes_before_newer_datapoints(self):
+        self.cache.store("a.b.c", (3.0, 3.0))
+        self.cache.requeue("a.b.c", [(1.0, 1.0), (2.0, 2.0)])
+        self.assertEqual(self.cache.size, 3)
+        self.assertEqual(self.cache.pop("a.b.c"), [(1.0, 1.0), (2.0, 2.0), (3.0, 3.0)])
+
+    def test_arrays_are_merged_when_popped(self):
+        self.cache.store("a.b.c", (1.0, 1.0))
+        self.cache.store_batch({"a.b.c": np.array([[2.0, 2.0], [3.0, 3.0]]), "d.e.f": np.array([[4.0, 4.0]])})
+        self.cache.requeue("a.b.c", np.array([[0.0, 0.0]]))
+        self.assertEqual(self.cache.size, 5)
+        self.assertEqual(self.cache.pop("a.b.c").tolist(), [[0.0, 0.0], [1.0, 1.0], [2.0, 2.0], [3.0, 3.0]])
+        self.assertEqual(self.cache.pop("d.e.f").tolist(), [[4.0, 4.0]])
+        self.assertEqual(self.cache.size, 0)
+
+    def test_setitem_is_forbidden(self):
+        self.assertRaises(TypeError, self.cache.shard("a").__setitem__, "a", [])
+
+
+if __name__ == '__main__':
+    unittest.main()
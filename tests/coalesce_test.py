@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import unittest
+
+from skyline.horizon.coalesce import Coalescer
+
+
+class TestCoalescer(unittest.TestCase):
+    """
+    Test merging datapoints into fixed time buckets
+    """
+
+    def datapoints(self):
+        return [(100.0, 1.0), (101.0, 5.0), (109.0, 3.0), (110.0, 2.0), (111.0, 4.0)]
+
+    def test_aggregations(self):
+        expected = {'last': 3.0, 'avg': 3.0, 'sum': 9.0, 'max': 5.0}
+        for aggregation, value in expected.items():
+            coalescer = Coalescer(10, aggregation)
+            self.assertEqual(coalescer.coalesce("a", self.datapoints()), [(100.0, value)])
+
+    def test_newest_bucket_stays_open(self):
+        coalescer = Coalescer(10, 'sum')
+        self.assertEqual(coalescer.coalesce("a", self.datapoints()), [(100.0, 9.0)])
+        self.assertEqual(coalescer.coalesce("a", [(112.0, 1.0)]), [])
+        self.assertEqual(coalescer.coalesce("a", [(120.0, 1.0)]), [(110.0, 7.0)])
+
+    def test_late_datapoints_are_dropped(self):
+        coalescer = Coalescer(10, 'sum')
+        coalescer.coalesce("a", self.datapoints())
+        # The bucket at 100 has been published
+        self.assertEqual(coalescer.coalesce("a", [(105.0, 8.0), (115.0, 1.0)]), [])
+        self.assertEqual(coalescer.pop_late(), 1)
+        self.assertEqual(coalescer.coalesce("a", [(120.0, 1.0)]), [(110.0, 7.0)])
+
+        # Including after the open bucket expired
+        self.assertEqual(coalescer.expire(140.0), [("a", [(120.0, 1.0)])])
+        self.assertEqual(coalescer.coalesce("a", [(118.0, 1.0), (125.0, 2.0), (131.0, 3.0)]), [])
+        self.assertEqual(coalescer.pop_late(), 2)
+        self.assertEqual(coalescer.pop_late(), 0)
+        self.assertEqual(coalescer.expire(150.0), [("a", [(130.0, 3.0)])])
+
+        # Other metrics are unaffected
+        self.assertEqual(coalescer.coalesce("b", [(105.0, 8.0), (115.0, 1.0)]), [(100.0, 8.0)])
+
+    def test_expire(self):
+        coalescer = Coalescer(10, 'avg')
+        coalescer.coalesce("a", self.datapoints())
+        self.assertEqual(coalescer.expire(125.0), [])
+        self.assertEqual(coalescer.expire(130.0), [("a", [(110.0, 3.0)])])
+        self.assertFalse(coalescer)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy as np
+
+from skyline.codecs import CODECS
+
+
+class TestCodecs(unittest.TestCase):
+    """
+    Test the storage formats round trip and can be appended to
+    """
+
+    datapoints = [(1420070400.0, 1.5), (1420070401.0, -2.0), (1420070402.5, 0.0)]
+
+    def test_round_trip(self):
+        for name, codec in CODECS.items():
+            decoded = codec.decode(codec.encode(self.datapoints))
+            self.assertEqual([tuple(d) for d in decoded], self.datapoints, name)
+
+    def test_append(self):
+        for name, codec in CODECS.items():
+            data = codec.encode(self.datapoints[:1]) + codec.encode(self.datapoints[1:])
+            self.assertEqual([tuple(d) for d in codec.decode(data)], self.datapoints, name)
+
+    def test_encode_array(self):
+        for name, codec in CODECS.items():
+            self.assertEqual(codec.encode(np.array(self.datapoints)), codec.encode(self.datapoints), name)
+
+    def test_v2_decodes_to_array(self):
+        codec = CODECS['v2']
+        decoded = codec.decode(codec.encode(self.datapoints))
+        self.assertEqual(decoded.shape, (3, 2))
+        self.assertEqual(decoded.dtype, np.float64)
+
+    def test_ring_decodes_in_order(self):
+        codec = CODECS['ring']
+        data = codec.encode(self.datapoints[:2], 3)
+        self.assertEqual(len(data), 3 * codec.width)
+        self.assertEqual(codec.decode(data, 2, 2).tolist(), [list(d) for d in self.datapoints[:2]])
+
+        # The oldest slot is overwritten and the head points at the next oldest
+        wrapped = codec.encode([self.datapoints[2], self.datapoints[0], self.datapoints[1]], 3)
+        self.assertEqual(codec.decode(wrapped, 1, 3).tolist(), [list(d) for d in self.datapoints])
+
+
+    def series(self, count):
+        random = np.random.RandomState(0)
+        timestamps = 1420070400 + np.arange(count) * 10.0
+        timestamps[::7] += 0.25
+        values = np.round(np.cumsum(random.randn(count)), 2)
+        values[3:6] = [float('inf'), -0.0, 1e300]
+        return np.column_stack((timestamps, values))
+
+    def test_gorilla_is_lossless(self):
+        codec = CODECS['gorilla']
+        datapoints = self.series(2 * codec.chunk_size)
+        sealed, tail = codec.seal(datapoints)
+        self.assertEqual(tail, '')
+        self.assertLess(len(sealed), datapoints.nbytes)
+        decoded = codec.decode(sealed, len(sealed))
+        self.assertTrue(np.array_equal(decoded.view(np.uint64), datapoints.view(np.uint64)))
+
+    def test_gorilla_tail(self):
+        codec = CODECS['gorilla']
+        datapoints = self.series(codec.chunk_size + 100)
+        sealed, tail = codec.seal(datapoints[:-10])
+        # Whatever doesn't fill a chunk stays v2, and publishes append to it
+        self.assertEqual(tail, CODECS['v2'].encode(datapoints[codec.chunk_size:-10]))
+        data = sealed + tail + CODECS['v2'].encode(datapoints[-10:])
+        self.assertEqual(codec.decode(data, len(sealed)).tolist(), datapoints.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
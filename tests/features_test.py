@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy
+import pandas
+
+from skyline.analyzer.features import Features, features
+
+
+class TestFeatures(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.values = numpy.round(numpy.cumsum(random.randn(1000)), 2)
+        self.timeseries = [[1420070400.0 + i, v] for i, v in enumerate(self.values)]
+
+    def test_arrays(self):
+        f = Features(self.timeseries)
+        self.assertEqual(f.timestamps[0], 1420070400.0)
+        numpy.testing.assert_array_equal(f.values, self.values)
+        numpy.testing.assert_array_equal(Features(numpy.array(self.timeseries)).values, self.values)
+
+    def test_behaves_like_the_timeseries(self):
+        f = Features(self.timeseries)
+        self.assertEqual(len(f), 1000)
+        self.assertEqual(f[-1], self.timeseries[-1])
+        self.assertEqual(list(f)[:2], self.timeseries[:2])
+        self.assertTrue(features(f) is f)
+
+    def test_statistics(self):
+        f = Features(self.timeseries)
+        series = pandas.Series(self.values)
+        self.assertAlmostEqual(f.mean, series.mean())
+        self.assertAlmostEqual(f.std, series.std())
+        self.assertAlmostEqual(f.pstd, numpy.std(self.values))
+        self.assertAlmostEqual(f.median, series.median())
+        self.assertAlmostEqual(f.mad, (series - series.median()).abs().median())
+        self.assertAlmostEqual(f.tail_avg, sum(self.values[-3:]) / 3)
+        self.assertEqual(Features(self.timeseries[:2]).tail_avg, self.values[1])
+
+    def test_memoized(self):
+        f = Features(self.timeseries)
+        self.assertTrue(f.series is f.series)
+        self.assertTrue(f.histogram is f.histogram)
+        self.assertTrue(f.ewma(50) is f.ewma(50))
+        self.assertFalse(f.ewma(50) is f.ewma(15))
+
+
+if __name__ == '__main__':
+    unittest.main()
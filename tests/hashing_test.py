@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import unittest
+
+from skyline.hashing import ConsistentHashRing
+
+
+class TestConsistentHashRing(unittest.TestCase):
+    """
+    Test metrics are spread evenly and stay put when nodes are added
+    """
+
+    metrics = ["horizon.test.{0}".format(i) for i in range(10000)]
+
+    def test_distribution(self):
+        ring = ConsistentHashRing(["a:6379/0", "b:6379/0", "c:6379/0"])
+        counts = {}
+        for metric in self.metrics:
+            node = ring.get_node(metric)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(sorted(counts), sorted(ring.nodes))
+        for count in counts.values():
+            self.assertGreater(count, len(self.metrics) / 3 * 0.7)
+
+    def test_node_order(self):
+        ring = ConsistentHashRing(["a:6379/0", "b:6379/0"])
+        reverse = ConsistentHashRing(["b:6379/0", "a:6379/0"])
+        for metric in self.metrics[:100]:
+            self.assertEqual(ring.get_node(metric), reverse.get_node(metric))
+
+    def test_add_node(self):
+        ring = ConsistentHashRing(["a:6379/0", "b:6379/0"])
+        before = [ring.get_node(metric) for metric in self.metrics]
+        ring.add_node("c:6379/0")
+        after = [ring.get_node(metric) for metric in self.metrics]
+        for old, new in zip(before, after):
+            if old != new:
+                self.assertEqual(new, "c:6379/0")
+
+    def test_empty(self):
+        self.assertRaises(KeyError, ConsistentHashRing().get_node, "metric")
+
+
+if __name__ == '__main__':
+    unittest.main()
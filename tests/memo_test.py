@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy
+import scipy.stats
+from argparse import Namespace
+from mock import patch
+
+from skyline.analyzer import algorithms, memo
+from skyline.analyzer.features import Features
+from skyline.analyzer.memo import Memo
+
+
+class TestMemo(unittest.TestCase):
+    @patch.object(memo.time, 'time')
+    def test_ttl(self, timeMock):
+        timeMock.return_value = 1000
+        m = Memo()
+        self.assertEqual(m.get("a", lambda: 1, 60), 1)
+        self.assertEqual(m.get("a", lambda: 2, 60), 1)
+        timeMock.return_value = 1060
+        self.assertEqual(m.get("a", lambda: 3, 60), 3)
+        self.assertEqual(m.get("b", lambda: 4), 4)
+        timeMock.return_value = 1000000
+        self.assertEqual(m.get("b", lambda: 5), 4)
+        self.assertEqual(m.pop_stats(), (2, 3))
+        self.assertEqual(m.pop_stats(), (0, 0))
+
+    @patch.object(memo.time, 'time')
+    def test_max_size(self, timeMock):
+        timeMock.return_value = 1000
+        m = Memo(max_size=3)
+        m.get("old", lambda: 0, 10)
+        m.get("a", lambda: 1)
+        m.get("b", lambda: 2)
+        timeMock.return_value = 1010
+        # The expired value makes room
+        m.get("c", lambda: 3)
+        self.assertEqual(sorted(m.values), ["a", "b", "c"])
+        m.get("d", lambda: 4)
+        self.assertEqual(sorted(m.values), ["d"])
+
+    def test_grubbs_score(self):
+        for n in (3, 10, 86400):
+            threshold = scipy.stats.t.isf(.05 / (2 * n), n - 2)
+            expected = ((n - 1) / numpy.sqrt(n)) * numpy.sqrt(threshold ** 2 / (n - 2 + threshold ** 2))
+            self.assertEqual(memo.grubbs_score(n), expected)
+        hits = memo.GRUBBS.hits
+        memo.grubbs_score(10)
+        self.assertEqual(memo.GRUBBS.hits, hits + 1)
+
+    def test_ks_test_keeps_adf_verdict(self):
+        now = 1420070400.0
+        values = numpy.concatenate((numpy.random.RandomState(0).randn(3000), numpy.zeros(600) + 10))
+        timeseries = numpy.column_stack((now - numpy.arange(3600)[::-1], values))
+        with patch.object(algorithms.time, 'time', return_value=now), \
+                patch.object(memo.sm.tsa.stattools, 'adfuller', return_value=(0, 0.01)) as adfuller:
+            for metric in ("a", "a", "b", None):
+                self.assertTrue(algorithms.ks_test(Features(timeseries, metric), Namespace(adf_ttl=60)))
+            self.assertTrue(algorithms.ks_test(Features(timeseries, "c"), Namespace(adf_ttl=0)))
+        self.assertEqual(adfuller.call_count, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import msgpack
+import numpy as np
+import struct
+import unittest
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
+from skyline.horizon import protocols
+from skyline.horizon.cache import MetricCache
+
+
+class TestProtocols(unittest.TestCase):
+    """
+    Test the Horizon receiving protocols
+    """
+
+    def setUp(self):
+        MetricCache.configure()
+
+    def test_parse_lines_groups_by_metric(self):
+        batch = protocols.parse_lines(["a.b 1 10", "c.d 2 11", "a.b 3 12", "garbage"], "test")
+        self.assertEqual(batch, {"a.b": [(10.0, 1.0), (12.0, 3.0)], "c.d": [(11.0, 2.0)]})
+
+    def test_line_receiver_keeps_partial_lines(self):
+        protocol = protocols.MetricLineReceiver()
+        protocol.makeConnection(StringTransport())
+        protocol.dataReceived("a.b 1 10\na.b 2 1")
+        self.assertEqual(MetricCache.pop("a.b"), [(10.0, 1.0)])
+        protocol.dataReceived("1\n")
+        self.assertEqual(MetricCache.pop("a.b"), [(11.0, 2.0)])
+
+    def test_datagram_receiver(self):
+        protocols.MetricDatagramReceiver().datagramReceived("a.b 1 10\nc.d 2 11\n", ("127.0.0.1", 2025))
+        self.assertEqual(MetricCache.size, 2)
+
+    def test_binary_receiver(self):
+        protocol = protocols.MetricBinaryReceiver()
+        protocol.makeConnection(StringTransport())
+        frame = protocols.pack_binary({"a.b": [(10.0, 1.0), (11.0, 2.5)], "c.d": [(12.0, -1.0)]})
+        protocol.dataReceived(frame[:7])
+        protocol.dataReceived(frame[7:])
+        # The datapoints stay packed
+        datapoints = MetricCache.pop("a.b")
+        self.assertTrue(isinstance(datapoints, np.ndarray))
+        self.assertEqual(datapoints.tolist(), [[10.0, 1.0], [11.0, 2.5]])
+        self.assertEqual(MetricCache.pop("c.d").tolist(), [[12.0, -1.0]])
+        self.assertEqual(MetricCache.size, 0)
+
+    def test_binary_receiver_rejects_invalid_frames(self):
+        protocol = protocols.MetricBinaryReceiver()
+        protocol.makeConnection(StringTransport())
+
+        def send(frame):
+            payload = msgpack.packb(frame)
+            protocol.dataReceived(struct.pack('!I', len(payload)) + payload)
+
+        # Frames that aren't a list of [metric, datapoints] pairs
+        send(42)
+        send({"a.b": struct.pack('<2d', 10.0, 1.0)})
+        send([["a.b"]])
+        send([["a.b", "x", "y"]])
+        self.assertEqual(MetricCache.size, 0)
+        self.assertTrue(protocol.transport.connected)
+
+        # Only the metrics with whole datapoints are kept
+        send([["a.b", struct.pack('<2d', 10.0, 1.0) + "\x00" * 8], ["c.d", 5], ["e.f", struct.pack('<2d', 11.0, 2.0)]])
+        self.assertFalse("a.b" in MetricCache)
+        self.assertFalse("c.d" in MetricCache)
+        self.assertEqual(MetricCache.pop("e.f").tolist(), [[11.0, 2.0]])
+
+    def test_flow_control(self):
+        MetricCache.configure(max_size=3, low_watermark=1)
+        protocol = protocols.MetricLineReceiver()
+        protocol.makeConnection(StringTransport())
+        udp = protocols.MetricDatagramReceiver()
+        udp.startProtocol()
+        try:
+            protocol.dataReceived("a.b 1 10\na.b 2 11\na.b 3 12\n")
+            self.assertEqual(protocol.transport.producerState, 'paused')
+
+            udp.datagramReceived("c.d 1 10\nc.d 2 11\n", ("127.0.0.1", 2025))
+            self.assertEqual(udp.dropped, 2)
+            self.assertFalse("c.d" in MetricCache)
+
+            MetricCache.checkSpaceAvailable()
+            self.assertEqual(protocol.transport.producerState, 'paused')
+            MetricCache.pop("a.b")
+            MetricCache.checkSpaceAvailable()
+            self.assertEqual(protocol.transport.producerState, 'producing')
+            self.assertEqual(udp.dropped, 0)
+        finally:
+            protocol.connectionLost(Failure(ConnectionDone()))
+            udp.stopProtocol()
+
+
+if __name__ == '__main__':
+    unittest.main()
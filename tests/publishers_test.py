@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import numpy as np
+import struct
+import unittest
+from argparse import Namespace
+from mock import MagicMock, patch
+from redis.exceptions import ConnectionError
+
+from skyline.api import SkylineRedisApi
+from skyline.horizon.cache import MetricCache
+from skyline.horizon.coalesce import Coalescer
+from skyline.horizon.publishers import Publisher
+
+
+class TestPublisher(unittest.TestCase):
+    """
+    Test batches are flushed with one pipeline per shard, and requeued when they fail
+    """
+
+    def setUp(self):
+        self.api = SkylineRedisApi("redis://localhost:6379/0,redis://localhost:6380/0")
+        self.api.get_blacklist = lambda: []
+        self.api.get_whitelist = lambda: []
+        self.pipes = {}
+        for index, shard in enumerate(self.api.shards):
+            shard.pipeline = MagicMock(side_effect=lambda transaction=True, index=index: self.pipes.setdefault(index, self.pipeline()))
+        self.metrics = ["horizon.test.{0}".format(i) for i in range(20)]
+        self.api.formats.update((metric, 'v1') for metric in self.metrics)
+        self.cache = MetricCache.__class__()
+        patcher = patch('skyline.horizon.publishers.MetricCache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        args = Namespace(publish_batch_size=100, publish_batch_timeout=1, spool_dir=None, coalesce_resolution=0)
+        self.publisher = Publisher(self.api, args)
+
+    def pipeline(self):
+        pipe = MagicMock()
+        pipe.__len__.return_value = 1
+        return pipe
+
+    def batch(self):
+        return [(metric, [(1420070400.0, float(i))]) for i, metric in enumerate(self.metrics)]
+
+    def test_one_round_trip_per_shard(self):
+        self.assertTrue(self.publisher.flush(self.api.pipeline(), self.batch()))
+        self.assertEqual(sorted(self.pipes), [0, 1])
+        for shard in self.api.shards:
+            shard.pipeline.assert_called_once_with(True)
+        for pipe in self.pipes.values():
+            pipe.execute.assert_called_once_with()
+        self.assertFalse(self.cache)
+
+    def test_requeue_failed_shard(self):
+        self.pipes[1] = self.pipeline()
+        self.pipes[1].execute.side_effect = ConnectionError("down")
+        self.cache.store("horizon.test.0", (1420070401.0, 5.0))
+
+        self.assertFalse(self.publisher.flush(self.api.pipeline(), self.batch()))
+        failed = [metric for metric in self.metrics if self.api.shard_index(metric) == 1]
+        self.assertTrue(failed)
+        self.assertEqual(sorted(metric for metric, count in self.cache.counts()), sorted(set(failed + ["horizon.test.0"])))
+        for i, metric in enumerate(self.metrics):
+            if metric in failed:
+                # The requeued datapoints come before the newer ones
+                self.assertEqual(self.cache.pop(metric)[0], (1420070400.0, float(i)))
+
+    def test_requeue_whole_batch(self):
+        for index in (0, 1):
+            self.pipes[index] = self.pipeline()
+            self.pipes[index].execute.side_effect = ConnectionError("down")
+        self.assertFalse(self.publisher.flush(self.api.pipeline(), self.batch()))
+        self.assertEqual(self.cache.size, len(self.metrics))
+
+
+    def test_requeued_buckets_skip_the_coalescer(self):
+        self.publisher.coalescer = Coalescer(10, 'avg')
+        for datapoint in [(1000.0, 2.0), (1005.0, 4.0), (1010.0, 1.0)]:
+            self.cache.store("horizon.test.0", datapoint)
+        batch = list(self.publisher.drain(0))
+        self.assertEqual(batch, [("horizon.test.0", [(1000.0, 3.0)]), ("horizon.test.0", [(1010.0, 1.0)])])
+
+        for index in (0, 1):
+            self.pipes[index] = self.pipeline()
+            self.pipes[index].execute.side_effect = ConnectionError("down")
+        self.assertFalse(self.publisher.flush(self.api.pipeline(), list(batch)))
+        self.assertEqual(list(self.publisher.drain(0)), batch)
+        self.assertEqual(self.publisher.coalescer.pop_late(), 0)
+        self.assertEqual(list(self.publisher.drain(0)), [])
+
+
+    def test_packed_datapoints_are_published_as_they_are(self):
+        datapoints = np.array([[1420070400.0, 1.0], [1420070500.0, 2.0]])
+        self.cache.store_batch({"horizon.test.0": datapoints})
+        batch = list(self.publisher.drain(1420070450.0))
+        self.assertEqual(len(batch), 1)
+        self.assertTrue(isinstance(batch[0][1], np.ndarray))
+        self.assertEqual(batch[0][1].tolist(), [[1420070500.0, 2.0]])
+
+        self.assertTrue(self.publisher.flush(self.api.pipeline(), batch))
+        pipe = self.pipes[self.api.shard_index("horizon.test.0")]
+        args = [c[0] for c in pipe.evalsha.call_args_list]
+        self.assertEqual(args[0][-1], struct.pack('<2d', 1420070500.0, 2.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
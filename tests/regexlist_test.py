@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import unittest
+
+from skyline.horizon.regexlist import RegexList
+
+
+class TestRegexList(unittest.TestCase):
+    """
+    Test the regex matcher and its decision cache
+    """
+
+    def test_matches_any_pattern(self):
+        regex_list = RegexList()
+        regex_list.load([r"^carbon\.", r"\.count$"])
+        self.assertTrue("carbon.agents.a" in regex_list)
+        self.assertTrue("stats.requests.count" in regex_list)
+        self.assertFalse("stats.requests.mean" in regex_list)
+
+    def test_patterns_are_independent(self):
+        regex_list = RegexList()
+        # An inline flag only applies to its own pattern
+        regex_list.load([r"^foo", r"(?i)BAR"])
+        self.assertFalse("FOO" in regex_list)
+        self.assertTrue("bar" in regex_list)
+
+        # Backreferences refer to the groups of their own pattern
+        regex_list.load([r"^(a)\.", r"^(b)-\1$"])
+        self.assertTrue("b-b" in regex_list)
+        self.assertFalse("b-a" in regex_list)
+
+        # The same group name can be used by several patterns
+        regex_list.load([r"^(?P<prefix>carbon)\.", r"^(?P<prefix>stats)\."])
+        self.assertTrue("stats.a" in regex_list)
+        self.assertFalse("statsd.a" in regex_list)
+
+    def test_load_clears_decisions(self):
+        regex_list = RegexList()
+        regex_list.load([r"^carbon\."])
+        self.assertFalse("stats.a" in regex_list)
+        regex_list.load([r"^stats\."])
+        self.assertTrue("stats.a" in regex_list)
+
+    def test_cache_is_bounded(self):
+        regex_list = RegexList(max_cache_size=2)
+        regex_list.load([r"^a"])
+        for metric in ("a.1", "b.1", "a.1"):
+            self.assertEqual(metric in regex_list, metric == "a.1")
+        self.assertEqual(regex_list.cache, {"a.1": True, "b.1": False})
+        # Once full the decisions are forgotten
+        self.assertFalse("b.2" in regex_list)
+        self.assertEqual(regex_list.cache, {"b.2": False})
+
+    def test_empty_list(self):
+        regex_list = RegexList()
+        self.assertFalse(regex_list)
+        self.assertFalse("a" in regex_list)
+
+
+if __name__ == '__main__':
+    unittest.main()
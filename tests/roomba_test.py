@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import time
+import unittest
+from argparse import Namespace
+from mock import MagicMock, call
+from redis import ResponseError
+
+from api_test import RedisTestCase
+from skyline.api import SkylineRedisApi
+from skyline.codecs import CODECS
+from skyline.roomba import Roomba
+
+
+class TestGrouping(unittest.TestCase):
+    """
+    Test Roomba sorts each chunk of metrics into purges, rings and trims
+    """
+
+    def test_clean(self):
+        now = time.time()
+        api = MagicMock()
+        api.get_metrics_info.return_value = [
+            {"last_updated_at": now - 500, "format": "v1"},  # too old
+            {"last_updated_at": now, "last_cleaned_at": now - 5},  # recently cleaned
+            {"last_updated_at": now, "format": "ring"},
+            {"last_updated_at": now, "last_cleaned_at": now - 50, "format": "v2"},
+            {"last_updated_at": now},
+            {"last_updated_at": now},
+            {"last_updated_at": now},
+        ]
+        api.trim_metrics.return_value = [3, 0, None, ResponseError("bad")]
+        roomba = Roomba(api, Namespace(full_duration=100, clean_timeout=10, sleep_timeout=0, scan_count=10))
+        roomba.rewrite = MagicMock()
+
+        roomba.clean(["old", "recent", "ring", "v2", "v1", "rewrite", "bad"])
+        api.get_metrics_info.assert_called_once_with(["old", "recent", "ring", "v2", "v1", "rewrite", "bad"],
+                                                     "last_updated_at", "last_cleaned_at", "format")
+        self.assertEqual(api.purge.call_args_list, [call("old"), call("bad")])
+        self.assertEqual([c[0][:2] for c in api.set_metric_info.call_args_list], [("ring", "last_cleaned_at")])
+        self.assertEqual(api.trim_metrics.call_args[0][0], ["v2", "v1", "rewrite", "bad"])
+        self.assertEqual(roomba.rewrite.call_args[0][0], "rewrite")
+        self.assertEqual(roomba.rewrite.call_count, 1)
+
+
+class TestClean(RedisTestCase):
+    """
+    Test Roomba trims metrics inside redis, and rewrites those it can't
+    """
+
+    def setUp(self):
+        RedisTestCase.setUp(self)
+        self.now = time.time()
+        self.roomba = Roomba(self.api, Namespace(full_duration=100, clean_timeout=10, sleep_timeout=0, scan_count=10))
+
+    def publish(self, metric, storage_format="v1"):
+        publisher = SkylineRedisApi(self.url, storage_format, ring_capacity=300)
+        publisher.publish(metric, [(self.now - age, float(age)) for age in (250, 200, 150, 50, 0)])
+
+    def test_trim(self):
+        self.publish("v1")
+        self.publish("v2", "v2")
+        self.roomba.clean(["v1", "v2"])
+        for metric in ("v1", "v2"):
+            self.assertEqual([value for timestamp, value in self.api.get_metric_data(metric)], [50.0, 0.0])
+            self.assertEqual(self.info(metric)["length"], "2")
+            self.assertTrue(float(self.info(metric)["last_cleaned_at"]) >= self.now)
+
+    def test_rings_and_recent_metrics_are_left_alone(self):
+        self.publish("ring", "ring")
+        self.publish("cleaned")
+        self.api.set_metric_info("cleaned", "last_cleaned_at", self.now - 5)
+        self.roomba.clean(["ring", "cleaned"])
+        self.assertEqual(len(self.api.get_metric_data("ring")), 5)
+        self.assertTrue(float(self.info("ring")["last_cleaned_at"]) >= self.now)
+        self.assertEqual(len(self.api.get_metric_data("cleaned")), 5)
+
+    def test_old_and_bad_metrics_are_purged(self):
+        self.publish("old")
+        self.api.set_metric_info("old", "last_updated_at", self.now - 200)
+        self.publish("bad")
+        self.api.redis_conn.set("skyline:metric:bad:data", "\x01")
+        self.roomba.clean(["old", "bad"])
+        self.assertEqual(self.api.get_metricset_all(), set())
+        self.assertFalse(self.api.redis_conn.exists("skyline:metric:old:data"))
+        self.assertFalse(self.api.redis_conn.exists("skyline:metric:bad:data"))
+
+    def test_rewrite_fallback(self):
+        # Redis can't trim gorilla metrics, so they are rewritten, which
+        # seals whole chunks of their tail
+        publisher = SkylineRedisApi(self.url, "gorilla")
+        size = CODECS['gorilla'].chunk_size + 10
+        publisher.publish("gorilla", [(self.now - 150 - size + i, float(i)) for i in range(size)])
+        self.publish("gorilla", "gorilla")
+        self.roomba.clean(["gorilla"])
+        self.assertEqual(self.api.get_metric_data("gorilla").tolist(), [[self.now - 50, 50.0], [self.now, 0.0]])
+        self.assertEqual(self.info("gorilla")["format"], "gorilla")
+        self.assertEqual(self.info("gorilla")["length"], "2")
+        self.assertEqual(self.info("gorilla")["sealed"], "0")
+        self.assertTrue(float(self.info("gorilla")["last_cleaned_at"]) >= self.now)
+
+        # Once they are long enough
+        publisher.publish("gorilla", [(self.now + 1 + i, float(i)) for i in range(size)])
+        self.api.set_metric_info("gorilla", "last_cleaned_at", self.now - 50)
+        self.roomba.clean(["gorilla"])
+        self.assertEqual(len(self.api.get_metric_data("gorilla")), size + 2)
+        self.assertTrue(int(self.info("gorilla")["sealed"]) > 0)
+
+if __name__ == '__main__':
+    unittest.main()
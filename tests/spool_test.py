@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from skyline.horizon.spool import Spool
+
+
+class TestSpool(unittest.TestCase):
+    """
+    Test the on-disk spool used during redis outages
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replays_in_order(self):
+        spool = Spool(self.directory, segment_size=64)
+        for i in range(10):
+            spool.write("metric.{0}".format(i), [(float(i), 1.0), (float(i), 2.0)])
+        spool.flush()
+        self.assertTrue(len(spool.segments) > 1)
+
+        replayed = []
+        while spool:
+            records = spool.read(3)
+            spool.commit()
+            replayed.extend(metric for metric, datapoints in records)
+        self.assertEqual(replayed, ["metric.{0}".format(i) for i in range(10)])
+        self.assertFalse([name for name in os.listdir(self.directory) if name.endswith('.spool')])
+
+    def test_uncommitted_records_are_read_again(self):
+        spool = Spool(self.directory)
+        spool.write("a", [(1.0, 1.0)])
+        spool.write("b", [(2.0, 2.0)])
+        spool.flush()
+        self.assertEqual(spool.read(1), [("a", ((1.0, 1.0),))])
+        self.assertEqual(spool.read(1), [("a", ((1.0, 1.0),))])
+        spool.commit()
+        self.assertEqual(spool.read(1), [("b", ((2.0, 2.0),))])
+
+    def test_restart_resumes_from_offset(self):
+        spool = Spool(self.directory)
+        spool.write("a", [(1.0, 1.0)])
+        spool.write("b", [(2.0, 2.0)])
+        spool.flush()
+        spool.read(1)
+        spool.commit()
+        spool.close()
+
+        spool = Spool(self.directory)
+        self.assertTrue(spool)
+        self.assertEqual(spool.read(10), [("b", ((2.0, 2.0),))])
+        spool.commit()
+        self.assertFalse(spool)
+
+    def test_directory_is_locked(self):
+        spool = Spool(self.directory)
+        spool.write("a", [(1.0, 1.0)])
+        spool.flush()
+        self.assertRaises(IOError, Spool, self.directory)
+
+        # Each worker spools to its own directory
+        other = Spool(os.path.join(self.directory, "1"))
+        other.write("b", [(2.0, 2.0)])
+        other.flush()
+        self.assertEqual(spool.read(10), [("a", ((1.0, 1.0),))])
+        self.assertEqual(other.read(10), [("b", ((2.0, 2.0),))])
+        other.close()
+
+        spool.close()
+        self.assertEqual(Spool(self.directory).read(10), [("a", ((1.0, 1.0),))])
+
+
+if __name__ == '__main__':
+    unittest.main()
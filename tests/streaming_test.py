@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy
+import pandas
+from argparse import Namespace
+
+from skyline.analyzer import algorithms, streaming
+from skyline.analyzer.streaming import StreamState
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.random = random
+        values = numpy.round(1000 + numpy.cumsum(random.randn(5000)), 2)
+        self.datapoints = numpy.column_stack((1420070400.0 + numpy.arange(5000) * 10, values))
+
+    def stream(self, datapoints, chunks):
+        """Fold datapoints into a state in chunks, saving and loading it between them like the analyzer."""
+        fields = {}
+        for chunk in numpy.array_split(datapoints, chunks):
+            state = StreamState.load(fields, 100)
+            state.update(chunk)
+            fields = state.dump()
+        return StreamState.load(fields, 100)
+
+    def test_statistics_match_batch(self):
+        state = self.stream(self.datapoints, 37)
+        series = pandas.Series(self.datapoints[:, 1])
+        self.assertEqual(state.count, 5000)
+        self.assertEqual(state.last_timestamp, self.datapoints[-1, 0])
+        numpy.testing.assert_array_equal(state.tail, self.datapoints[-100:, 1])
+        numpy.testing.assert_allclose(state.mean, series.mean(), rtol=1e-9)
+        numpy.testing.assert_allclose(state.std, series.std(), rtol=1e-9)
+        numpy.testing.assert_allclose(state.ewm_mean, pandas.stats.moments.ewma(series, com=50).iget(-1), rtol=1e-9)
+        numpy.testing.assert_allclose(state.ewmstd, pandas.stats.moments.ewmstd(series, com=50).iget(-1), rtol=1e-9)
+
+    def test_one_datapoint_at_a_time(self):
+        state = StreamState()
+        for datapoint in self.datapoints[:300]:
+            state.update([datapoint])
+        series = pandas.Series(self.datapoints[:300, 1])
+        numpy.testing.assert_allclose(state.std, series.std(), rtol=1e-9)
+        numpy.testing.assert_allclose(state.ewmstd, pandas.stats.moments.ewmstd(series, com=50).iget(-1), rtol=1e-9)
+
+    def test_algorithms_match_batch(self):
+        args = Namespace()
+        for i in xrange(20):
+            datapoints = self.datapoints[:self.random.randint(2, 5000)].copy()
+            datapoints[-1, 1] += self.random.choice([0, 20, -50, 200])
+            state = self.stream(datapoints, self.random.randint(1, 10))
+            for algorithm in streaming.STREAMING_ALGORITHMS:
+                self.assertEqual(bool(getattr(streaming, algorithm)(state, args)),
+                                 bool(getattr(algorithms, algorithm)(datapoints, args)),
+                                 "{0} on {1} datapoints".format(algorithm, len(datapoints)))
+
+    def test_position(self):
+        state = StreamState.load({"offset": 160, "format": "v2", "last_cleaned_at": ""})
+        self.assertEqual(state.count, 0)
+        state.update(self.datapoints[:10])
+        fields = state.dump()
+        self.assertEqual(fields["offset"], 160)
+        self.assertEqual(fields["format"], "v2")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import unittest
+from redis import ConnectionPool
+from redis.exceptions import ConnectionError, NoScriptError, ResponseError
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
+from skyline.txredis import INCOMPLETE, AsyncRedis, RedisProtocol, parse_reply
+
+
+class TestParseReply(unittest.TestCase):
+    """
+    Test RESP replies are parsed, and partial replies wait for more data
+    """
+
+    def test_types(self):
+        self.assertEqual(parse_reply('+OK\r\n', 0), ('OK', 5))
+        self.assertEqual(parse_reply(':-12\r\n', 0), (-12, 6))
+        self.assertEqual(parse_reply('$3\r\na\r\n\r\n', 0), ('a\r\n', 9))
+        self.assertEqual(parse_reply('$-1\r\n', 0), (None, 5))
+        self.assertEqual(parse_reply('*2\r\n$1\r\na\r\n:1\r\n', 0), (['a', 1], 15))
+        self.assertEqual(parse_reply('*-1\r\n', 0), (None, 5))
+
+    def test_errors(self):
+        error, pos = parse_reply('-NOSCRIPT No matching script\r\n', 0)
+        self.assertIsInstance(error, NoScriptError)
+        error, pos = parse_reply('*1\r\n-ERR wrong\r\n', 0)
+        self.assertIsInstance(error[0], ResponseError)
+
+    def test_incomplete(self):
+        for data in ['+OK', '$5\r\nab', '*2\r\n:1\r\n', '*2\r\n$1\r\n']:
+            self.assertIs(parse_reply(data, 0)[0], INCOMPLETE)
+
+
+class TestAsyncRedis(unittest.TestCase):
+    """
+    Test commands and pipelines over a fake connection
+    """
+
+    def setUp(self):
+        self.protocol = RedisProtocol()
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.client = AsyncRedis(ConnectionPool.from_url("redis://localhost:6379/"))
+        self.client.connecting = 1
+        self.client.connected(self.protocol)
+        self.results = []
+        self.failures = []
+
+    def collect(self, d):
+        d.addCallbacks(self.results.append, self.failures.append)
+
+    def test_command(self):
+        self.collect(self.client.hgetall("info"))
+        self.assertEqual(self.transport.value(), "*2\r\n$7\r\nHGETALL\r\n$4\r\ninfo\r\n")
+        self.protocol.dataReceived("*2\r\n$1\r\na\r")
+        self.assertEqual(self.results, [])
+        self.protocol.dataReceived("\n$1\r\nb\r\n")
+        self.assertEqual(self.results, [{"a": "b"}])
+
+    def test_error(self):
+        self.collect(self.client.get("key"))
+        self.protocol.dataReceived("-WRONGTYPE Operation against a key\r\n")
+        self.assertEqual(len(self.failures), 1)
+        self.assertTrue(self.failures[0].check(ResponseError))
+
+    def test_transaction(self):
+        pipe = self.client.pipeline()
+        pipe.set("key", 1)
+        pipe.exists("key")
+        self.collect(pipe.execute())
+        self.assertTrue(self.transport.value().startswith("*1\r\n$5\r\nMULTI\r\n"))
+        self.protocol.dataReceived("+OK\r\n+QUEUED\r\n+QUEUED\r\n*2\r\n+OK\r\n:1\r\n")
+        self.assertEqual(self.results, [[True, True]])
+
+    def test_transaction_error(self):
+        pipe = self.client.pipeline()
+        pipe.set("key", 1)
+        pipe.incr("key")
+        self.collect(pipe.execute())
+        self.protocol.dataReceived("+OK\r\n+QUEUED\r\n+QUEUED\r\n*2\r\n+OK\r\n-ERR not an integer\r\n")
+        self.assertTrue(self.failures[0].check(ResponseError))
+
+    def test_connection_lost(self):
+        self.collect(self.client.get("key"))
+        self.protocol.connectionLost(Failure(Exception("gone")))
+        self.assertTrue(self.failures[0].check(ConnectionError))
+        self.assertEqual(self.client.connections, [])
+
+
+if __name__ == '__main__':
+    unittest.main()